@@ -0,0 +1 @@
+default_app_config = 'report_builder.apps.ReportBuilderConfig'
@@ -24,7 +24,8 @@ class StarredFilter(SimpleListFilter):
 class ReportAdmin(admin.ModelAdmin):
     list_display = ('ajax_starred', 'edit', 'name', 'description', 'root_model', 'created', 'modified', 'user_created', 'download_xlsx','copy_report',)
     readonly_fields = ['slug', ]
-    fields = ['name', 'description', 'root_model', 'slug',]
+    fields = ['name', 'description', 'root_model', 'slug', 'refresh_schedule',
+              'change_tracking_field', 'tombstone_field',]
     search_fields = ('name', 'description')
     list_filter = (StarredFilter, 'root_model', 'created', 'modified', 'root_model__app_label')
     list_display_links = []
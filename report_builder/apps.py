@@ -0,0 +1,23 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_delete
+
+from .data_versions import tracking_enabled, connect_data_versions
+from .incremental import delete_report_snapshot
+from .plan import plans_shared, connect_report_plans
+from .utils import warm_introspection_cache
+
+
+class ReportBuilderConfig(AppConfig):
+    name = 'report_builder'
+    verbose_name = 'Report Builder'
+
+    def ready(self):
+        if plans_shared():
+            connect_report_plans()
+        post_delete.connect(delete_report_snapshot, sender=self.get_model('Report'),
+                            dispatch_uid='report_builder_report_snapshot_deleted')
+        if tracking_enabled():
+            connect_data_versions()
+        if getattr(settings, 'REPORT_BUILDER_WARM_INTROSPECTION_CACHE', False):
+            warm_introspection_cache()
@@ -0,0 +1,12 @@
+"""
+Benchmarks of the report pipeline on synthetic data
+
+Add 'report_builder.benchmarks' to INSTALLED_APPS of a settings module used
+for benchmarking, create its tables, then run
+
+    python manage.py report_builder_benchmark --scale 100000 --output results.json
+
+and later compare a run against those results with --baseline results.json.
+Timings over --tolerance slower than the baseline fail the command.
+"""
+default_app_config = 'report_builder.benchmarks.apps.BenchmarksConfig'
@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class BenchmarksConfig(AppConfig):
+    name = 'report_builder.benchmarks'
+    label = 'report_builder_benchmarks'
+    verbose_name = 'Report Builder Benchmarks'
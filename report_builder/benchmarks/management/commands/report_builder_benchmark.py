@@ -0,0 +1,54 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from report_builder.benchmarks.models import BenchmarkItem
+from report_builder.benchmarks.results import make_results, write_results, load_results, compare_results
+from report_builder.benchmarks.runner import run_benchmarks
+from report_builder.benchmarks.seed import seed, create_reports
+
+
+class Command(BaseCommand):
+    help = 'Time the report pipeline on synthetic data, optionally against a baseline'
+    option_list = BaseCommand.option_list + (
+        make_option('--scale', type='int', default=10000,
+                    help='Items to seed, e.g. 10000, 100000 or 1000000'),
+        make_option('--repeat', type='int', default=3, help='Runs of each benchmark'),
+        make_option('--only', default='', help='Comma separated prefixes of the benchmarks to run'),
+        make_option('--output', help='Write the results to this JSON file'),
+        make_option('--baseline', help='Compare against results in this JSON file'),
+        make_option('--tolerance', type='float', default=0.25,
+                    help='Fraction slower than the baseline that counts as a regression'),
+        make_option('--no-seed', action='store_false', dest='seed', default=True,
+                    help='Reuse data seeded before at the same scale'),
+    )
+
+    def handle(self, *args, **options):
+        scale = options['scale']
+        if options['seed']:
+            self.stdout.write('Seeding %s items' % scale)
+            seed(scale)
+        elif BenchmarkItem.objects.count() != scale:
+            raise CommandError('There are no %s seeded items to reuse' % scale)
+
+        User = get_user_model()
+        user = User.objects.filter(**{User.USERNAME_FIELD: 'report_builder_benchmark'}).first()
+        if user is None:
+            user = User.objects.create_superuser('report_builder_benchmark', '', None)
+
+        only = [prefix for prefix in options['only'].split(',') if prefix]
+        benchmarks = run_benchmarks(
+            create_reports(), user, repeat=options['repeat'], only=only, log=self.stdout.write)
+        results = make_results(scale, benchmarks)
+        if options['output']:
+            write_results(options['output'], results)
+
+        if options['baseline']:
+            try:
+                regressions = compare_results(results, load_results(options['baseline']), options['tolerance'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            for name, base_seconds, seconds in regressions:
+                self.stderr.write('%s regressed from %.4fs to %.4fs' % (name, base_seconds, seconds))
+            if regressions:
+                raise CommandError('%s benchmarks regressed' % len(regressions))
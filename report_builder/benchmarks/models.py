@@ -0,0 +1,47 @@
+from django.db import models
+
+
+class BenchmarkCategory(models.Model):
+    """ End of the item -> supplier -> category foreign key chain """
+    name = models.CharField(max_length=100)
+    code = models.CharField(max_length=10)
+
+
+class BenchmarkSupplier(models.Model):
+    name = models.CharField(max_length=100)
+    country = models.CharField(max_length=2)
+    category = models.ForeignKey(BenchmarkCategory)
+
+
+class BenchmarkTag(models.Model):
+    name = models.CharField(max_length=50)
+
+
+class BenchmarkItem(models.Model):
+    """ A wide row with fields of most types, choices, relations and properties """
+    STATUS_CHOICES = (
+        ('new', 'New'),
+        ('active', 'Active'),
+        ('retired', 'Retired'),
+    )
+
+    name = models.CharField(max_length=100)
+    description = models.TextField(blank=True)
+    sku = models.CharField(max_length=20)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES)
+    quantity = models.IntegerField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    weight = models.FloatField()
+    is_active = models.BooleanField(default=True)
+    created = models.DateField()
+    updated = models.DateTimeField()
+    supplier = models.ForeignKey(BenchmarkSupplier)
+    tags = models.ManyToManyField(BenchmarkTag, blank=True)
+
+    @property
+    def stock_value(self):
+        return self.quantity * self.price
+
+    @property
+    def label(self):
+        return '%s (%s)' % (self.name, self.sku)
@@ -0,0 +1,55 @@
+"""
+Benchmark results files and comparisons against a baseline
+"""
+import datetime
+import json
+import platform
+
+
+def get_environment():
+    import django
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+    }
+
+
+def make_results(scale, benchmarks):
+    """ benchmarks: dict of name to {'median', 'min', 'rows'} """
+    return {
+        'scale': scale,
+        'created': datetime.datetime.now().isoformat(),
+        'environment': get_environment(),
+        'benchmarks': benchmarks,
+    }
+
+
+def write_results(path, results):
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def compare_results(results, baseline, tolerance=0.25, min_seconds=0.005):
+    """ Benchmarks of results more than tolerance slower than in baseline
+    Timings below min_seconds in both are too noisy to compare.
+    Returns a list of (name, baseline median, median) tuples
+    """
+    if results['scale'] != baseline['scale']:
+        raise ValueError('Results of scale %s can not be compared to a baseline of scale %s' % (
+            results['scale'], baseline['scale']))
+    regressions = []
+    for name, timing in sorted(results['benchmarks'].items()):
+        base_timing = baseline['benchmarks'].get(name)
+        if base_timing is None:
+            continue
+        if max(timing['median'], base_timing['median']) < min_seconds:
+            continue
+        if timing['median'] > base_timing['median'] * (1 + tolerance):
+            regressions.append((name, base_timing['median'], timing['median']))
+    return regressions
@@ -0,0 +1,133 @@
+"""
+Timed benchmark cases of the report pipeline
+"""
+from django.test.client import RequestFactory
+from openpyxl.workbook import Workbook
+from timeit import default_timer
+
+from report_builder.mixins import DataExportMixin, GetFieldsMixin
+from report_builder.models import FilterField
+from report_builder.utils import filter_property, compile_property_filter, clear_introspection_cache
+from report_builder.views import AjaxGetFields, AjaxGetRelated, AjaxPreview
+from .models import BenchmarkItem
+
+
+def time_call(func, repeat):
+    """ Timings of repeat calls of func and the last call's result """
+    timings = []
+    result = None
+    for i in range(repeat):
+        start = default_timer()
+        result = func()
+        timings.append(default_timer() - start)
+    return timings, result
+
+
+def report_to_list_case(report, user):
+    def run():
+        plan = report.compile()
+        queryset, message = plan.get_query()
+        rows, message = DataExportMixin().report_to_list(
+            queryset, plan.display_fields, user, property_filters=plan.property_filters)
+        return len(rows)
+    return run
+
+
+def get_report_list(report, user):
+    plan = report.compile()
+    queryset, message = plan.get_query()
+    rows, message = DataExportMixin().report_to_list(queryset, plan.display_fields, user)
+    return rows, list(plan.header)
+
+
+def view_case(view, request):
+    def run():
+        response = view(request)
+        if hasattr(response, 'render'):
+            response.render()
+        return None
+    return run
+
+
+def get_cases(reports, user):
+    """ (name, callable) of every benchmark, the callables return a row count or None """
+    cases = []
+    for name, report in sorted(reports.items()):
+        cases.append(('report_to_list.%s' % name, report_to_list_case(report, user)))
+
+    rows, header = get_report_list(reports['wide'], user)
+    mixin = DataExportMixin()
+
+    def build_sheet():
+        mixin.build_sheet(rows, Workbook().worksheets[0], header=header)
+        return len(rows)
+
+    def list_to_xlsx_file():
+        mixin.list_to_xlsx_file(rows, header=header)
+        return len(rows)
+
+    def list_to_xlsx_stream():
+        mixin.list_to_xlsx_stream(rows, header=header).close()
+        return len(rows)
+
+    cases += [
+        ('build_sheet', build_sheet),
+        ('list_to_xlsx_file', list_to_xlsx_file),
+        ('list_to_xlsx_stream', list_to_xlsx_stream),
+    ]
+
+    values = list(BenchmarkItem.objects.values_list('quantity', flat=True))
+    filter_field = FilterField(filter_type='gt', filter_value='500')
+    compiled_filter = compile_property_filter(filter_field)
+    cases += [
+        ('filter_property', lambda: [filter_property(filter_field, value) for value in values].count(False)),
+        ('compile_property_filter.batch', lambda: compiled_filter.batch(values).count(False)),
+    ]
+
+    def get_fields_cold():
+        clear_introspection_cache()
+        GetFieldsMixin().get_fields(BenchmarkItem)
+
+    def get_fields_warm():
+        GetFieldsMixin().get_fields(BenchmarkItem)
+
+    cases += [
+        ('get_fields.cold', get_fields_cold),
+        ('get_fields.warm', get_fields_warm),
+    ]
+
+    factory = RequestFactory()
+    model_id = reports['wide'].root_model_id
+    request = factory.get('/report_builder/ajax_get_fields/', {
+        'model': model_id, 'field': '', 'path': '', 'path_verbose': ''})
+    request.user = user
+    cases.append(('ajax_get_fields', view_case(AjaxGetFields.as_view(), request)))
+    request = factory.get('/report_builder/ajax_get_related/', {
+        'model': model_id, 'field': 'supplier', 'path': '', 'path_verbose': ''})
+    request.user = user
+    cases.append(('ajax_get_related', view_case(AjaxGetRelated.as_view(), request)))
+    for name, report in sorted(reports.items()):
+        request = factory.post('/report_builder/ajax_preview/', {'report_id': report.pk})
+        request.user = user
+        cases.append(('ajax_preview.%s' % name, view_case(AjaxPreview.as_view(), request)))
+    return cases
+
+
+def run_benchmarks(reports, user, repeat=3, only=None, log=None):
+    """ Run the cases whose names start with one of only (all by default)
+    Returns a dict of name to {'median', 'min', 'rows'}
+    """
+    benchmarks = {}
+    for name, func in get_cases(reports, user):
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        timings, rows = time_call(func, repeat)
+        timings.sort()
+        benchmarks[name] = {
+            'median': timings[len(timings) // 2],
+            'min': timings[0],
+            'rows': rows,
+        }
+        if log is not None:
+            log('%-40s %10.4fs' % (name, benchmarks[name]['median']))
+    return benchmarks
@@ -0,0 +1,118 @@
+"""
+Synthetic data and reports for the benchmarks
+"""
+from django.contrib.contenttypes.models import ContentType
+from decimal import Decimal
+import datetime
+import random
+
+from report_builder.models import Report, DisplayField, FilterField, Format
+from .models import BenchmarkCategory, BenchmarkSupplier, BenchmarkTag, BenchmarkItem
+
+SCALES = (10000, 100000, 1000000)
+REPORT_PREFIX = 'benchmark '
+
+
+def seed(scale, batch_size=5000, seed_value=0):
+    """ Replace the benchmark data with scale items, made the same way every time """
+    rng = random.Random(seed_value)
+    Through = BenchmarkItem.tags.through
+    for model in (Through, BenchmarkItem, BenchmarkTag, BenchmarkSupplier, BenchmarkCategory):
+        model.objects.all().delete()
+
+    BenchmarkCategory.objects.bulk_create([
+        BenchmarkCategory(name='Category %s' % i, code='C%02d' % i) for i in range(20)])
+    category_ids = list(BenchmarkCategory.objects.values_list('pk', flat=True))
+    BenchmarkSupplier.objects.bulk_create([
+        BenchmarkSupplier(name='Supplier %s' % i, country=rng.choice(['DE', 'FR', 'US', 'JP']),
+                          category_id=rng.choice(category_ids))
+        for i in range(max(scale // 100, 1))], batch_size=batch_size)
+    supplier_ids = list(BenchmarkSupplier.objects.values_list('pk', flat=True))
+    BenchmarkTag.objects.bulk_create([BenchmarkTag(name='tag %s' % i) for i in range(50)])
+    tag_ids = list(BenchmarkTag.objects.values_list('pk', flat=True))
+
+    start = datetime.datetime(2014, 1, 1)
+    statuses = [key for key, label in BenchmarkItem.STATUS_CHOICES]
+    for offset in range(0, scale, batch_size):
+        BenchmarkItem.objects.bulk_create([
+            BenchmarkItem(
+                name='Item %s' % i,
+                description='Description of item %s' % i,
+                sku='SKU%08d' % i,
+                status=rng.choice(statuses),
+                quantity=rng.randint(0, 1000),
+                price=Decimal(rng.randint(1, 100000)) / 100,
+                weight=rng.random() * 50,
+                is_active=rng.random() < 0.8,
+                created=(start + datetime.timedelta(days=rng.randint(0, 1000))).date(),
+                updated=start + datetime.timedelta(seconds=rng.randint(0, 10 ** 8)),
+                supplier_id=rng.choice(supplier_ids))
+            for i in range(offset, min(offset + batch_size, scale))])
+    item_ids = BenchmarkItem.objects.values_list('pk', flat=True).order_by('pk').iterator()
+    links = []
+    for item_id in item_ids:
+        for tag_id in rng.sample(tag_ids, rng.randint(0, 3)):
+            links.append(Through(benchmarkitem_id=item_id, benchmarktag_id=tag_id))
+        if len(links) >= batch_size:
+            Through.objects.bulk_create(links)
+            links = []
+    Through.objects.bulk_create(links)
+
+
+def add_display_fields(report, fields):
+    """ fields: (path, field, field_verbose, options) tuples """
+    for position, (path, field, field_verbose, options) in enumerate(fields):
+        DisplayField.objects.create(
+            report=report,
+            path=path,
+            field=field,
+            field_verbose=field_verbose,
+            name=path + field,
+            position=position + 1,
+            **options)
+
+
+def create_reports():
+    """ Replace the benchmark reports, returns a dict of name to Report """
+    Report.objects.filter(name__startswith=REPORT_PREFIX).delete()
+    root_model = ContentType.objects.get_for_model(BenchmarkItem)
+    money = Format.objects.get_or_create(name='benchmark money', string='${:,.2f}')[0]
+
+    definitions = {
+        'wide': [
+            ('', field.name, '%s [%s]' % (field.name, field.get_internal_type()), {})
+            for field in BenchmarkItem._meta.fields],
+        'fk_chain': [
+            ('', 'name', 'name [CharField]', {'sort': 1}),
+            ('supplier__', 'name', 'name [CharField]', {}),
+            ('supplier__category__', 'name', 'name [CharField]', {}),
+            ('supplier__category__', 'code', 'code [CharField]', {}),
+        ],
+        'm2m': [
+            ('', 'sku', 'sku [CharField]', {}),
+            ('tags__', 'name', 'name [CharField]', {}),
+        ],
+        'properties': [
+            ('', 'label', 'label [property]', {}),
+            ('', 'stock_value', 'stock_value [property]', {'total': True}),
+        ],
+        'choices_formats': [
+            ('', 'status', 'status [CharField]', {}),
+            ('', 'price', 'price [DecimalField]', {'display_format': money, 'total': True}),
+            ('', 'weight', 'weight [FloatField]', {'total': True, 'sort': 1, 'sort_reverse': True}),
+        ],
+    }
+    reports = {}
+    for name, fields in definitions.items():
+        report = Report.objects.create(name=REPORT_PREFIX + name, root_model=root_model)
+        add_display_fields(report, fields)
+        reports[name] = report
+
+    FilterField.objects.create(
+        report=reports['properties'],
+        field='stock_value',
+        field_verbose='stock_value [property]',
+        filter_type='gt',
+        filter_value='1000',
+        position=1)
+    return reports
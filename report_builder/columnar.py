@@ -0,0 +1,131 @@
+"""
+Columnar report rows backed by NumPy
+
+NumPy is optional; numpy is None when it is not installed and
+DataExportMixin then keeps rows as lists.
+"""
+from six import integer_types
+import datetime
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INT64_MAX = 2 ** 63 - 1
+# dtype kinds numpy can sort the way sort_helper does: integers, floats,
+# booleans and dates
+SORTABLE_KINDS = 'ifbM'
+
+
+def column_array(values):
+    """ An array of values, typed when every value has the same simple type """
+    value_types = set(type(value) for value in values)
+    if value_types and value_types <= set(integer_types):
+        if max(abs(value) for value in values) <= INT64_MAX:
+            return numpy.array(values, dtype=numpy.int64)
+    elif value_types == set([float]):
+        return numpy.array(values, dtype=numpy.float64)
+    elif value_types == set([bool]):
+        return numpy.array(values, dtype=numpy.bool_)
+    elif value_types == set([datetime.date]):
+        return numpy.array(values, dtype='datetime64[D]')
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def concatenate_columns(arrays):
+    if len(set(array.dtype for array in arrays)) > 1:
+        arrays = [array.astype(object) for array in arrays]
+    return numpy.concatenate(arrays)
+
+
+class ColumnarRows(object):
+    """
+    Report rows held as one array per column
+    Iterating gives rows as lists, with formatters applied a column at a
+    time and trailing_rows (the TOTALS rows) last, so exporters take it like
+    a list of rows.
+    """
+    chunk_size = 10000
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.formatters = {}
+        self.trailing_rows = []
+
+    @classmethod
+    def from_rows(cls, rows, column_count):
+        """ Read rows a chunk at a time into columns
+        column_count is only used when there are no rows
+        """
+        chunks = None
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, cls.chunk_size))
+            if not batch:
+                break
+            if chunks is None:
+                chunks = [[] for value in batch[0]]
+            for index, values in enumerate(zip(*batch)):
+                chunks[index].append(column_array(list(values)))
+        if chunks is None:
+            return cls([numpy.empty(0, dtype=object) for i in range(column_count)])
+        return cls([concatenate_columns(arrays) for arrays in chunks])
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __iter__(self):
+        for start in range(0, len(self), self.chunk_size):
+            columns = []
+            for index, column in enumerate(self.columns):
+                column = column[start:start + self.chunk_size]
+                formatter = self.formatters.get(index)
+                if formatter is not None:
+                    column = numpy.frompyfunc(formatter, 1, 1)(column)
+                columns.append(column.tolist())
+            for row in zip(*columns):
+                yield list(row)
+        for row in self.trailing_rows:
+            yield row
+
+    def can_sort(self, sort_fields):
+        return all(self.columns[index].dtype.kind in SORTABLE_KINDS for index, reverse in sort_fields)
+
+    def sort(self, sort_fields):
+        """ Sort like DataExportMixin.sort_report_rows, by one stable lexsort
+        sort_fields: (column index, reverse) pairs, most significant last
+        """
+        keys = []
+        for index, reverse in sort_fields:
+            key = self.columns[index]
+            if reverse:
+                if key.dtype.kind == 'b':
+                    key = ~key
+                elif key.dtype.kind == 'M':
+                    key = -key.view(numpy.int64)
+                else:
+                    key = -key
+            keys.append(key)
+        order = numpy.lexsort(keys)
+        self.columns = [column[order] for column in self.columns]
+
+    def add_to_totals(self, totals):
+        """ Add every row to the python accumulators of a ReportTotals """
+        from .mixins import IntTotalAccumulator
+        totals.row_count += len(self)
+        for position, accumulator in totals.accumulators.items():
+            column = self.columns[position]
+            kind = column.dtype.kind
+            if kind == 'i' and type(accumulator) is IntTotalAccumulator:
+                largest = max(abs(int(column.max())), abs(int(column.min()))) if len(column) else 0
+                if len(column) * largest <= INT64_MAX:
+                    accumulator.sum += int(column.sum())
+                else:
+                    accumulator.sum += sum(column.tolist())
+            else:
+                for value in column.tolist():
+                    accumulator.add(value)
@@ -0,0 +1,234 @@
+"""
+Per-model data versions, bumped whenever rows of a model change
+
+Enable with REPORT_BUILDER_TRACK_DATA_VERSIONS = True. Versions live in the
+Django cache named by REPORT_BUILDER_DATA_VERSION_CACHE, which must be shared
+by every process that writes data. QuerySet.update() and bulk_create() send
+no signals, so changes made with them are not noticed.
+
+Only saves of the models saved reports read are tracked. Their labels are
+kept in the same cache and worked out again once a report or its fields
+change. Each process connects its receivers to them when it starts a request
+or reads a data fingerprint, so a process that does neither, such as a task
+worker that only writes data, should call refresh_data_tracking() itself.
+"""
+from django.conf import settings
+from django.core.signals import request_started
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import post_save, post_delete, m2m_changed
+import hashlib
+import json
+import threading
+import time
+
+VERSION_PREFIX = 'report_builder_data_version_'
+TRACKED_MODELS_KEY = 'report_builder_tracked_models'
+REPORT_FILE_PREFIX = 'report_builder_report_file_'
+REPORT_FILE_DEFINITION_PREFIX = 'report_builder_report_file_definition_'
+REPORT_FILE_PERMISSIONS_PREFIX = 'report_builder_report_file_permissions_'
+
+
+def tracking_enabled():
+    return getattr(settings, 'REPORT_BUILDER_TRACK_DATA_VERSIONS', False)
+
+
+def get_version_cache():
+    alias = getattr(settings, 'REPORT_BUILDER_DATA_VERSION_CACHE', 'default')
+    try:
+        from django.core.cache import caches
+        return caches[alias]
+    except ImportError:
+        from django.core.cache import get_cache
+        return get_cache(alias)
+
+
+def new_version():
+    """ Start counters from the clock so versions lost from the cache are never reused """
+    return int(time.time() * 1000)
+
+
+def get_model_label(model_class):
+    opts = model_class._meta.concrete_model._meta
+    return opts.app_label + '.' + opts.model_name
+
+
+def get_version_key(model_class):
+    return VERSION_PREFIX + get_model_label(model_class)
+
+
+def bump_version(key):
+    cache = get_version_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, new_version(), None)
+
+
+def get_versions(keys):
+    """ Dict of key to current version, starting counters that are missing """
+    cache = get_version_cache()
+    versions = cache.get_many(keys)
+    for key in set(keys) - set(versions):
+        cache.add(key, new_version(), None)
+        versions[key] = cache.get(key)
+    return versions
+
+
+def bump_data_version(model_class):
+    """ Mark data of model_class, and of the models it inherits from, as changed """
+    concrete_model = model_class._meta.concrete_model
+    for model in [concrete_model] + list(concrete_model._meta.get_parent_list()):
+        bump_version(get_version_key(model))
+
+
+def get_data_versions(models):
+    """ Dict of version key to current version for each of models """
+    return get_versions(set(get_version_key(model) for model in models))
+
+
+def get_data_fingerprint(models):
+    """ A hash that changes whenever data of any of models changes """
+    refresh_data_tracking()
+    versions = get_data_versions(models)
+    fingerprint = ','.join('%s:%s' % (key, versions[key]) for key in sorted(versions))
+    return hashlib.md5(fingerprint.encode('utf-8')).hexdigest()
+
+
+def get_report_file_key(report_id):
+    """ Key report_file of report_id was made with, see Report.get_report_file_key """
+    return get_version_cache().get(REPORT_FILE_PREFIX + str(report_id))
+
+
+def set_report_file_key(report_id, key):
+    get_version_cache().set(REPORT_FILE_PREFIX + str(report_id), key, None)
+
+
+def get_report_file_definition(report_id):
+    """ Definition key report_file of report_id was made with, see Report.get_definition_key """
+    return get_version_cache().get(REPORT_FILE_DEFINITION_PREFIX + str(report_id))
+
+
+def set_report_file_definition(report_id, key):
+    get_version_cache().set(REPORT_FILE_DEFINITION_PREFIX + str(report_id), key, None)
+
+
+def get_permissions_key(user):
+    """ Hash of what user may see of a report, which iter_report_rows checks """
+    permissions = [user.is_active, user.is_superuser, sorted(user.get_all_permissions())]
+    return hashlib.md5(json.dumps(permissions).encode('utf-8')).hexdigest()
+
+
+def get_report_file_permissions(report_id):
+    """ Permissions key of the user report_file of report_id was made by """
+    return get_version_cache().get(REPORT_FILE_PERMISSIONS_PREFIX + str(report_id))
+
+
+def set_report_file_permissions(report_id, key):
+    get_version_cache().set(REPORT_FILE_PERMISSIONS_PREFIX + str(report_id), key, None)
+
+
+def data_changed(sender, **kwargs):
+    bump_data_version(sender)
+
+
+def m2m_data_changed(sender, instance, action, model, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        # Paths can cross the relation from either side
+        bump_data_version(sender)
+        bump_data_version(type(instance))
+        bump_data_version(model)
+
+
+def get_installed_models():
+    try:
+        from django.apps import apps
+        return apps.get_models(include_auto_created=True)
+    except ImportError:
+        from django.db.models import get_models
+        return get_models(include_auto_created=True)
+
+
+def find_tracked_models():
+    """ Labels of the models saved reports read and of the m2m tables between them """
+    from .models import Report
+    labels = set()
+    for report in Report.objects.select_related('root_model'):
+        try:
+            models = report.compile().models
+        except (FieldDoesNotExist, AttributeError):
+            continue  # A report that no longer compiles reads nothing
+        for model in models:
+            labels.add(get_model_label(model))
+            for field in model._meta.many_to_many:
+                labels.add(get_model_label(field.rel.through))
+    return labels
+
+
+def get_tracked_models():
+    """ Labels of the models whose saves bump data versions """
+    cache = get_version_cache()
+    labels = cache.get(TRACKED_MODELS_KEY)
+    if labels is None:
+        labels = sorted(find_tracked_models())
+        cache.set(TRACKED_MODELS_KEY, labels, None)
+    return frozenset(labels)
+
+
+def forget_tracked_models(sender, instance, created=True, **kwargs):
+    """ Signal receiver for reports and their fields
+    Saving a report again only changes what it reads when it is moved to
+    another root model, and reports are saved with every file they make. """
+    from .models import Report
+    cache = get_version_cache()
+    if sender is Report and not created:
+        model_class = instance.root_model.model_class()
+        labels = cache.get(TRACKED_MODELS_KEY)
+        if model_class is None or labels is not None and get_model_label(model_class) in labels:
+            return
+    cache.delete(TRACKED_MODELS_KEY)
+
+
+_tracked_labels = None
+_tracked_senders = {}
+_tracked_lock = threading.Lock()
+
+
+def refresh_data_tracking(**kwargs):
+    """ Connect the data version receivers to the models of get_tracked_models(),
+    their proxies and their subclasses, and disconnect them from the rest """
+    global _tracked_labels
+    if not tracking_enabled():
+        return
+    labels = get_tracked_models()
+    if labels == _tracked_labels:
+        return
+    senders = {}
+    for model in get_installed_models():
+        concrete_model = model._meta.concrete_model
+        reads = [concrete_model] + list(concrete_model._meta.get_parent_list())
+        if labels.intersection(get_model_label(parent) for parent in reads):
+            senders[model._meta.app_label + '.' + model.__name__] = model
+    with _tracked_lock:
+        for uid, model in _tracked_senders.items():
+            if uid not in senders:
+                post_save.disconnect(sender=model, dispatch_uid='report_builder_data_saved_' + uid)
+                post_delete.disconnect(sender=model, dispatch_uid='report_builder_data_deleted_' + uid)
+                m2m_changed.disconnect(sender=model, dispatch_uid='report_builder_m2m_changed_' + uid)
+        for uid, model in senders.items():
+            post_save.connect(data_changed, sender=model, dispatch_uid='report_builder_data_saved_' + uid)
+            post_delete.connect(data_changed, sender=model, dispatch_uid='report_builder_data_deleted_' + uid)
+            m2m_changed.connect(m2m_data_changed, sender=model, dispatch_uid='report_builder_m2m_changed_' + uid)
+        _tracked_senders.clear()
+        _tracked_senders.update(senders)
+        _tracked_labels = labels
+
+
+def connect_data_versions():
+    from .models import Report, DisplayField, FilterField
+    for model in (Report, DisplayField, FilterField):
+        post_save.connect(forget_tracked_models, sender=model,
+                          dispatch_uid='report_builder_tracked_models_saved_%s' % model.__name__)
+        post_delete.connect(forget_tracked_models, sender=model,
+                            dispatch_uid='report_builder_tracked_models_deleted_%s' % model.__name__)
+    # Models are looked up on the first request, the database may not be ready before
+    request_started.connect(refresh_data_tracking, dispatch_uid='report_builder_refresh_data_tracking')
@@ -0,0 +1,116 @@
+"""
+Incremental refresh of report files
+
+A report with a change_tracking_field, a DateTimeField of its root model
+such as one with auto_now, keeps the raw rows of its last file run in a
+snapshot. The next run only fetches the rows of root objects changed since
+that run started, replaces their rows in the snapshot and totals and formats
+the merged rows. Objects the report's tombstone_field marks deleted drop out
+once they change. Objects deleted outright, and changes to related rows that
+leave the root object's field alone, are only picked up when the snapshot is
+rebuilt, which happens when the report's definition changes.
+
+Rows written by a transaction that began before a run but committed after it
+read carry an earlier time than the run's start, so each run also fetches the
+rows changed in the REPORT_BUILDER_INCREMENTAL_OVERLAP seconds (300 by
+default) before the last one started.
+
+Snapshots are JSON files in REPORT_BUILDER_SNAPSHOT_DIR, a temporary directory
+by default, which must belong to the user running the report builder. They
+hold report data, so keep the directory out of MEDIA_ROOT, and share it
+between the processes that refresh reports.
+"""
+from django.conf import settings
+from django.utils import timezone
+from collections import namedtuple
+import datetime
+import json
+import os
+import tempfile
+
+from .partitions import fetch_partitioned_rows, get_sort_keys, merge_partition_rows, sort_raw_rows
+from .utils import TypedJSONEncoder, decode_typed_value, make_private_dir
+
+ReportSnapshot = namedtuple("ReportSnapshot", "definition_key user_id taken rows")
+
+def get_snapshot_dir():
+    return getattr(settings, 'REPORT_BUILDER_SNAPSHOT_DIR', None) or \
+        os.path.join(tempfile.gettempdir(), 'report_builder_snapshots')
+
+
+def get_snapshot_path(report_id):
+    return os.path.join(get_snapshot_dir(), 'report_%s.json' % report_id)
+
+
+def load_snapshot(report_id):
+    make_private_dir(get_snapshot_dir())
+    try:
+        with open(get_snapshot_path(report_id), 'rb') as snapshot_file:
+            snapshot = json.loads(snapshot_file.read().decode('utf-8'), object_hook=decode_typed_value)
+        return ReportSnapshot(**snapshot)
+    except (IOError, OSError, ValueError, TypeError):
+        return None
+
+
+def save_snapshot(report_id, snapshot):
+    snapshot_dir = get_snapshot_dir()
+    make_private_dir(snapshot_dir)
+    content = json.dumps(dict(snapshot._asdict()), cls=TypedJSONEncoder)
+    # Write then rename so readers never see half a file and the name stays the same
+    fd, path = tempfile.mkstemp(dir=snapshot_dir)
+    with os.fdopen(fd, 'wb') as snapshot_file:
+        snapshot_file.write(content.encode('utf-8'))
+    os.rename(path, get_snapshot_path(report_id))
+
+
+def delete_snapshot(report_id):
+    try:
+        os.remove(get_snapshot_path(report_id))
+    except OSError:
+        pass
+
+
+def delete_report_snapshot(sender, instance, **kwargs):
+    """ Signal receiver for deleted reports """
+    delete_snapshot(instance.pk)
+
+
+def get_incremental_rows(mixin, report, user, queryset):
+    """ Raw rows of report, each ending with its pk, from its snapshot and
+    the rows changed since. The snapshot is rebuilt from a full run when it
+    was made from another definition or for another user.
+    Rows are sorted by get_row_key, see partitions.py.
+    queryset: the report's queryset, see ReportPlan.get_query
+    Returns rows, message
+    """
+    plan = report.compile()
+    message = ''
+    definition_key = report.get_definition_key()
+    sort_keys = get_sort_keys(plan)
+    # Taken before any rows are read, so changes made meanwhile are fetched next time
+    started = timezone.now()
+    snapshot = load_snapshot(report.pk)
+
+    if snapshot is None or snapshot.definition_key != definition_key or snapshot.user_id != user.pk:
+        rows = fetch_partitioned_rows(report, user, queryset, plan, mixin.partitions)
+        if rows is None:
+            rows, message = mixin.iter_report_rows(
+                queryset, plan.display_fields, user, property_filters=plan.property_filters, raw=True)
+        rows = sort_raw_rows(rows, sort_keys)
+    else:
+        overlap = datetime.timedelta(seconds=getattr(settings, 'REPORT_BUILDER_INCREMENTAL_OVERLAP', 300))
+        # The base manager, as a default manager may hide tombstoned rows
+        changed = plan.model_class._base_manager.filter(
+            **{report.change_tracking_field + '__gte': snapshot.taken - overlap})
+        changed_pks = set(changed.values_list('pk', flat=True))
+        changed_rows, message = mixin.iter_report_rows(
+            queryset.filter(pk__in=changed.values('pk')), plan.display_fields, user,
+            property_filters=plan.property_filters, raw=True)
+        changed_rows = sort_raw_rows(changed_rows, sort_keys)
+        # Objects changed since changed_pks was read replace their old rows too
+        replaced = changed_pks | set(row[-1] for row in changed_rows)
+        kept = [row for row in snapshot.rows if row[-1] not in replaced]
+        rows = list(merge_partition_rows([kept, changed_rows], sort_keys + [(-1, False)]))
+
+    save_snapshot(report.pk, ReportSnapshot(definition_key, user.pk, started, rows))
+    return rows, message
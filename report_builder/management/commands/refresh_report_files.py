@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from report_builder.models import Report
+from report_builder.schedule import get_due_reports, get_refresh_user, refresh_report
+
+
+class Command(BaseCommand):
+    args = '<report_id report_id ...>'
+    help = 'Make the stored files of reports due a scheduled refresh, or of the given reports'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='List the reports that would be refreshed'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            try:
+                reports = [Report.objects.get(pk=report_id) for report_id in args]
+            except (Report.DoesNotExist, ValueError):
+                raise CommandError('No report with id in %s' % ', '.join(args))
+        else:
+            reports = get_due_reports()
+        for report in reports:
+            user = get_refresh_user(report)
+            if user is None:
+                self.stderr.write('Skipped %s, it has no user to run as' % report.name)
+                continue
+            self.stdout.write('Refreshing %s' % report.name)
+            if not options['dry_run']:
+                refresh_report(report, user)
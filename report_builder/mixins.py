@@ -1,27 +1,340 @@
-from six import BytesIO, text_type
+import six
+from six import BytesIO, PY2, text_type
 
-from django.http import HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.conf import settings
+from django.db.models.fields import FieldDoesNotExist
+from django.http import HttpResponse, StreamingHttpResponse
 from django.contrib.contenttypes.models import ContentType
 from django.db.models.fields.related import ReverseManyRelatedObjectsDescriptor
-from django.db.models import Avg, Count, Sum, Max, Min
+from django.db import connections
+from django.db.models import Avg, Count, Sum, Max, Min, F, Q, CharField, TextField
 from openpyxl.workbook import Workbook
 from openpyxl.writer.excel import save_virtual_workbook
 from openpyxl.cell import get_column_letter
+import base64
+import binascii
+import csv
+import datetime
+import itertools
+import json
 import re
+import tempfile
 from collections import namedtuple
+from contextlib import contextmanager
+from functools import reduce
+from wsgiref.util import FileWrapper
 from decimal import Decimal
 from numbers import Number
 
+from .columnar import ColumnarRows, numpy
+from .incremental import get_incremental_rows
+from .partitions import fetch_partitioned_rows, strip_pks
+from .result_cache import get_result_cache
+from .timing import ReportTimer, timing_enabled, server_timing_enabled, untimed
 from .utils import (
     get_relation_fields_from_model,
     get_properties_from_model,
     get_direct_fields_from_model,
     get_model_from_path_string,
-    get_custom_fields_from_model,)
+    resolve_path,
+    get_custom_fields_from_model,
+    compile_property_filter,)
+
+try:
+    from django.db.models.functions import Lower
+except ImportError:
+    # Django < 1.8 has no query expressions to order by
+    Lower = None
 
 DisplayField = namedtuple("DisplayField", "path path_verbose field field_verbose aggregate total group choices")
 
+AGGREGATES = {'Avg': Avg, 'Count': Count, 'Sum': Sum, 'Max': Max, 'Min': Min}
+
+# Field types the database can total exactly
+INTEGER_FIELD_TYPES = (
+    'AutoField', 'BigIntegerField', 'IntegerField', 'PositiveIntegerField',
+    'PositiveSmallIntegerField', 'SmallIntegerField')
+# Field types whose values never are numbers, so each one counts as one
+COUNTED_FIELD_TYPES = (
+    'BooleanField', 'CharField', 'CommaSeparatedIntegerField', 'DateField',
+    'DateTimeField', 'EmailField', 'FileField', 'FilePathField',
+    'GenericIPAddressField', 'IPAddressField', 'ImageField', 'NullBooleanField',
+    'SlugField', 'TextField', 'TimeField', 'URLField')
+
+
+# Values whose Decimal conversion always succeeds, or always fails
+DECIMAL_TYPES = six.integer_types + (float,)
+NON_DECIMAL_TYPES = (type(None), datetime.date, datetime.time, datetime.timedelta)
+
+
+def compile_value_formatter(format_string):
+    """ Make a callable formatting a value like DataExportMixin.format_value
+    The Decimal conversion is picked by the type of the value, so only values
+    of unknown types pay for a failed conversion.
+    """
+    format_method = format_string.format
+
+    def format_cell(value):
+        if isinstance(value, DECIMAL_TYPES):
+            value = Decimal(value)
+        elif not isinstance(value, (Decimal,) + NON_DECIMAL_TYPES):
+            try:
+                value = Decimal(value)
+            except Exception:
+                pass
+        try:
+            return format_method(value)
+        except ValueError:
+            return value
+    return format_cell
+
+
+def compile_choice_formatter(choices_dict, value_formatter=None):
+    """ Make a callable showing a choice label, then formatting it """
+    if value_formatter is None:
+        return lambda value: text_type(choices_dict[value])
+    return lambda value: value_formatter(text_type(choices_dict[value]))
+
+
+class TotalAccumulator(object):
+    """ Total of one column: numbers are added as Decimal(str(value)) and every
+    other value counts as one. The typed subclasses below take a fast path for
+    the values a column is expected to hold and fall back to this for others.
+    """
+    __slots__ = ('other', 'count')
+
+    def __init__(self):
+        self.other = Decimal('0.00')
+        self.count = 0
+
+    def add(self, value):
+        # Booleans are Numbers - blah
+        if isinstance(value, Number) and not isinstance(value, bool):
+            # do decimal math for all numbers
+            self.other += Decimal(str(value))
+        else:
+            self.count += 1
+
+    def get_total(self):
+        return self.other + self.count * Decimal('1.00')
+
+
+class IntTotalAccumulator(TotalAccumulator):
+    __slots__ = ('sum',)
+    types = six.integer_types
+
+    def __init__(self):
+        super(IntTotalAccumulator, self).__init__()
+        self.sum = 0
+
+    def add(self, value):
+        if type(value) in self.types:
+            self.sum += value
+        else:
+            super(IntTotalAccumulator, self).add(value)
+
+    def get_total(self):
+        return super(IntTotalAccumulator, self).get_total() + Decimal(self.sum)
+
+
+class FloatTotalAccumulator(TotalAccumulator):
+    """ Floats are still added as Decimal(str(value)), only the type checks
+    are skipped, so totals keep the digits a float is shown with """
+    __slots__ = ()
+
+    def add(self, value):
+        if type(value) is float:
+            self.other += Decimal(str(value))
+        else:
+            super(FloatTotalAccumulator, self).add(value)
+
+
+class DecimalTotalAccumulator(TotalAccumulator):
+    __slots__ = ()
+
+    def add(self, value):
+        if type(value) is Decimal:
+            self.other += value
+        else:
+            super(DecimalTotalAccumulator, self).add(value)
+
+
+class CountTotalAccumulator(TotalAccumulator):
+    """ For columns whose values never are numbers """
+    __slots__ = ()
+    types = six.string_types + (type(None), bool, datetime.date, datetime.datetime, datetime.time)
+
+    def add(self, value):
+        if type(value) in self.types:
+            self.count += 1
+        else:
+            super(CountTotalAccumulator, self).add(value)
+
+
+TOTAL_ACCUMULATORS = {
+    'int': IntTotalAccumulator,
+    'float': FloatTotalAccumulator,
+    'decimal': DecimalTotalAccumulator,
+    'count': CountTotalAccumulator,
+}
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """ Keeps the microseconds DjangoJSONEncoder cuts to milliseconds, so a
+    cursor compares equal to the row it was taken from """
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(CursorEncoder, self).default(o)
+
+
+def encode_page_cursor(position):
+    """ Opaque cursor for DataExportMixin.get_report_page """
+    return base64.urlsafe_b64encode(json.dumps(position, cls=CursorEncoder).encode('utf-8')).decode('ascii')
+
+
+def decode_page_cursor(cursor):
+    """ Position from a cursor, raises ValueError for a malformed one """
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+
+
+class ReportTotals(object):
+    """ Totals of the totalled columns of a report run
+    db_columns maps column positions to (kind, lookup, decimal_places) from
+    DataExportMixin.get_db_total_columns. Those are totalled by one aggregate()
+    query on queryset once every row has been counted, every other column is
+    added up in python row by row, by the accumulator for its kind from
+    DataExportMixin.get_total_kinds.
+    """
+    def __init__(self, positions, db_columns=None, queryset=None, kinds=None):
+        self.row_count = 0
+        self.db_columns = db_columns or {}
+        self.queryset = queryset
+        kinds = kinds or {}
+        self.accumulators = {}
+        for position in positions:
+            if position not in self.db_columns:
+                self.accumulators[position] = TOTAL_ACCUMULATORS.get(
+                    kinds.get(position), TotalAccumulator)()
+        self.adders = [(position, accumulator.add) for position, accumulator in self.accumulators.items()]
+
+    def add_row(self, row):
+        self.row_count += 1
+        for position, add in self.adders:
+            add(row[position])
+
+    def get_totals(self):
+        """ Returns a dict of column position to total """
+        totals = dict((position, accumulator.get_total())
+                      for position, accumulator in self.accumulators.items())
+        aggregates = {}
+        for position, (kind, lookup, decimal_places) in self.db_columns.items():
+            if kind == 'sum':
+                aggregates['rb_sum_%s' % position] = Sum(lookup)
+                aggregates['rb_count_%s' % position] = Count(lookup)
+        results = self.queryset.aggregate(**aggregates) if aggregates else {}
+
+        for position, (kind, lookup, decimal_places) in self.db_columns.items():
+            total = Decimal('0.00')
+            # Like in add_row, every value which isn't a number counts as one
+            uncounted = self.row_count
+            if kind == 'sum':
+                value_sum = results['rb_sum_%s' % position]
+                if value_sum is not None:
+                    # Some backends sum decimals as floats
+                    total += Decimal(str(value_sum)).quantize(Decimal(1).scaleb(-decimal_places))
+                uncounted -= results['rb_count_%s' % position]
+            totals[position] = total + uncounted * Decimal('1.00')
+        return totals
+
+
+class Echo(object):
+    """ File-like object that hands back whatever is written to it
+    Lets csv.writer build one line at a time for a streaming response.
+    """
+    def write(self, value):
+        return value
+
+
 class DataExportMixin(object):
+    # Number of rows a preview shows
+    preview_rows = 50
+    # Rows format_report_rows formats at a time
+    format_batch_size = 1000
+    # ReportProgress counting rows of a run, if any
+    progress = None
+    # Partitions get_report_rows splits the root queryset into, see partitions.py
+    partitions = 1
+    # ReportTimer timing the stages of a run, if any, see timing.py
+    timer = None
+
+    def start_timer(self, report_id):
+        """ Time this run when timing or profiling is on for the report """
+        if timing_enabled(report_id):
+            self.timer = ReportTimer(report_id).start()
+        return self.timer
+
+    def stop_timer(self):
+        """ Drop the run's timer without reporting it, for runs that failed """
+        timer = self.timer
+        if timer is not None:
+            self.timer = None
+            timer.stop()
+
+    @contextmanager
+    def timed(self, report_id):
+        """ Start timing the run (see start_timer) for the work within the
+        with statement. Should it raise, the timer is stopped, else it is
+        left for finish_timer.
+        """
+        self.start_timer(report_id)
+        try:
+            yield self.timer
+        except BaseException:
+            self.stop_timer()
+            raise
+
+    def finish_timer(self, response=None):
+        """ Finish timing the run, adding a Server-Timing header to response when on """
+        timer = self.timer
+        if timer is None:
+            return response
+        self.timer = None
+        timer.finish(sender=self.__class__)
+        if response is not None and server_timing_enabled():
+            response['Server-Timing'] = timer.get_server_timing()
+        return response
+
+    def time_rows(self, rows, stage):
+        """ Row stage: time rows through stage when the run is timed """
+        if self.timer is None:
+            return rows
+        return self.timer.time_rows(rows, stage)
+
+    def time_block(self, stage):
+        """ Context manager timing its work as stage when the run is timed """
+        if self.timer is None:
+            return untimed()
+        return self.timer.block(stage)
+
+    def time_lines(self, lines):
+        """ Time the lines of a file as the write stage when the run is timed """
+        if self.timer is None:
+            return lines
+        return self.timer.time_lines(lines)
+
+    def count_file_bytes(self, report_file):
+        """ Count the size of a written file when the run is timed """
+        if self.timer is not None:
+            position = report_file.tell()
+            report_file.seek(0, 2)
+            self.timer.count_bytes(report_file.tell())
+            report_file.seek(position)
+
     def build_sheet(self, data, ws, sheet_name='report', header=None, widths=None):
         # Try to detect the openpyxl version, since the API changes
         # significantly from v1 to v2
@@ -67,12 +380,58 @@ class DataExportMixin(object):
             except:
                 ws.append(['Unknown Error'])
 
+    def build_write_only_sheet(self, data, ws, sheet_name='report', header=None, widths=None):
+        """ Like build_sheet but for a write only (streaming) worksheet
+        Rows are appended once and flushed out by openpyxl as they arrive,
+        so data may be any iterable of rows, including a generator.
+        """
+        ws.title = re.sub(r'\W+', '', sheet_name)[:30]
+        # Column widths must be set before any row is written
+        if widths and hasattr(ws, 'column_dimensions'):
+            try:
+                for i, width in enumerate(widths):
+                    ws.column_dimensions[get_column_letter(i+1)].width = width
+            except KeyError:
+                # Older write only sheets don't support column dimensions
+                pass
+        if header:
+            try:
+                from openpyxl.cell import WriteOnlyCell
+                from openpyxl.styles import Font
+            except ImportError:
+                # Older openpyxl can't style cells of write only sheets
+                ws.append(list(header))
+            else:
+                header_row = []
+                for header_cell in header:
+                    cell = WriteOnlyCell(ws, value=header_cell)
+                    cell.font = Font(bold=True)
+                    header_row.append(cell)
+                ws.append(header_row)
+
+        for row in data:
+            row = list(row)
+            for i in range(len(row)):
+                item = row[i]
+                # If item is a regular string
+                if isinstance(item, str):
+                    # Change it to a unicode string
+                    row[i] = text_type(item, "UTF-8")
+            try:
+                ws.append(row)
+            except ValueError as e:
+                ws.append([e.message])
+            except:
+                ws.append(['Unknown Error'])
+
     def build_xlsx_response(self, wb, title="report"):
         """ Take a workbook and return a xlsx file response """
         if not title.endswith('.xlsx'):
             title += '.xlsx'
         myfile = BytesIO()
-        myfile.write(save_virtual_workbook(wb))
+        with self.time_block('write'):
+            myfile.write(save_virtual_workbook(wb))
+        self.count_file_bytes(myfile)
         response = HttpResponse(
             myfile.getvalue(),
             content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
@@ -106,11 +465,13 @@ class DataExportMixin(object):
         like {'sheet_1': [['A1', 'B1']]}
         returns a StringIO file
         """
-        wb = self.list_to_workbook(data, title, header, widths)
         if not title.endswith('.xlsx'):
             title += '.xlsx'
         myfile = BytesIO()
-        myfile.write(save_virtual_workbook(wb))
+        with self.time_block('write'):
+            wb = self.list_to_workbook(data, title, header, widths)
+            myfile.write(save_virtual_workbook(wb))
+        self.count_file_bytes(myfile)
         return myfile
 
 
@@ -119,9 +480,101 @@ class DataExportMixin(object):
         data can be a 2d array or a dict of 2d arrays
         like {'sheet_1': [['A1', 'B1']]}
         """
-        wb = self.list_to_workbook(data, title, header, widths)
+        with self.time_block('write'):
+            wb = self.list_to_workbook(data, title, header, widths)
         return self.build_xlsx_response(wb, title=title)
 
+    def list_to_write_only_workbook(self, data, title='report', header=None, widths=None):
+        """ Create a write only openpyxl workbook from an iterable of rows
+        data can be an iterable of rows or a dict of iterables
+        like {'sheet_1': [['A1', 'B1']]}
+        """
+        try:
+            wb = Workbook(write_only=True)
+        except TypeError:
+            # openpyxl < 2.4 calls write only mode "optimized_write"
+            wb = Workbook(optimized_write=True)
+
+        if isinstance(data, dict):
+            for sheet_name, sheet_data in data.items():
+                ws = wb.create_sheet()
+                self.build_write_only_sheet(sheet_data, ws, sheet_name=sheet_name, header=header)
+        else:
+            ws = wb.create_sheet()
+            self.build_write_only_sheet(data, ws, header=header, widths=widths)
+        return wb
+
+    def list_to_xlsx_stream(self, data, title='report', header=None, widths=None):
+        """ Write rows straight into a xlsx file on disk
+        data can be any iterable of rows (see list_to_write_only_workbook).
+        Memory use doesn't grow with the number of rows.
+        returns a temporary file positioned at its start
+        """
+        xlsx_file = tempfile.TemporaryFile()
+        with self.time_block('write'):
+            wb = self.list_to_write_only_workbook(data, title, header, widths)
+            wb.save(xlsx_file)
+        self.count_file_bytes(xlsx_file)
+        xlsx_file.seek(0)
+        return xlsx_file
+
+    def list_to_xlsx_stream_response(self, data, title='report', header=None, widths=None):
+        """ Make an iterable of rows into a streamed xlsx response for download
+        Unlike list_to_xlsx_response the workbook is never held in memory.
+        """
+        if not title.endswith('.xlsx'):
+            title += '.xlsx'
+        xlsx_file = self.list_to_xlsx_stream(data, title, header, widths)
+        xlsx_file.seek(0, 2)
+        size = xlsx_file.tell()
+        xlsx_file.seek(0)
+        response = StreamingHttpResponse(
+            FileWrapper(xlsx_file),
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        response['Content-Disposition'] = 'attachment; filename=%s' % title
+        response['Content-Length'] = size
+        return response
+
+    def iter_csv_lines(self, data, header=None):
+        """ Yield each row of data as a line of csv """
+        writer = csv.writer(Echo())
+        if header:
+            data = itertools.chain([header], data)
+        for row in data:
+            if PY2:
+                # The python 2 csv module can't write unicode
+                row = [item.encode('utf-8') if isinstance(item, text_type) else item for item in row]
+            yield writer.writerow(row)
+
+    def iter_jsonl_lines(self, data, header=None):
+        """ Yield each row of data as a line of JSON (a JSON Lines file) """
+        if header:
+            data = itertools.chain([header], data)
+        for row in data:
+            yield json.dumps(list(row), cls=DjangoJSONEncoder) + '\n'
+
+    def list_to_csv_response(self, data, title='report', header=None):
+        """ Make an iterable of rows into a streamed csv response for download """
+        if not title.endswith('.csv'):
+            title += '.csv'
+        response = StreamingHttpResponse(
+            self.time_lines(self.iter_csv_lines(data, header)),
+            content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=%s' % title
+        return response
+
+    def list_to_jsonl_response(self, data, title='report', header=None):
+        """ Make an iterable of rows into a streamed JSON Lines response for download
+        The first line holds the header, every following line is one row.
+        """
+        if not title.endswith('.jsonl'):
+            title += '.jsonl'
+        response = StreamingHttpResponse(
+            self.time_lines(self.iter_jsonl_lines(data, header)),
+            content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename=%s' % title
+        return response
+
     def add_aggregates(self, queryset, display_fields):
         for display_field in display_fields:
             if hasattr(display_field, 'aggregate'):
@@ -137,278 +590,796 @@ class DataExportMixin(object):
                     queryset = queryset.annotate(Sum(display_field.path + display_field.field))
         return queryset
 
-    def report_to_list(self, queryset, display_fields, user, property_filters=[], preview=False):
+    def get_report_rows(self, report, user, queryset=None, preview=False):
+        """ Row generator and message for a saved report
+        Served from the result cache when one is configured, unless queryset
+        replaces the report's own filters. With REPORT_BUILDER_COLUMNAR_ROWS
+        on, downloads hold their rows in a ColumnarRows. With more than one
+        partition, downloads fetch their rows in parallel.
+        """
+        result_cache = get_result_cache() if queryset is None else None
+        if result_cache:
+            key = result_cache.get_key(report, user, preview)
+            cached = result_cache.get(key)
+            if cached is not None:
+                rows, message = cached
+                return iter(rows), message
+        plan = report.compile()
+        fetched_rows = None
+        if queryset is None:
+            queryset, message = plan.get_query()
+            if not preview and self.partitions > 1:
+                with self.time_block('fetch_partitions'):
+                    fetched_rows = fetch_partitioned_rows(report, user, queryset, plan, self.partitions)
+            if fetched_rows is not None:
+                fetched_rows = strip_pks(fetched_rows)
+        rows, message = self.iter_report_rows(
+            queryset,
+            plan.display_fields,
+            user,
+            property_filters=plan.property_filters,
+            preview=preview,
+            columnar=not preview and getattr(settings, 'REPORT_BUILDER_COLUMNAR_ROWS', False),
+            fetched_rows=fetched_rows)
+        if result_cache:
+            rows = result_cache.cache_rows(key, rows, message)
+        return rows, message
+
+    def get_incremental_report_rows(self, report, user):
+        """ Like get_report_rows for a report with a change_tracking_field:
+        only rows changed since the last run are fetched, see incremental.py
+        """
+        plan = report.compile()
+        queryset, message = plan.get_query()
+        if any(df.group for df in plan.display_fields):
+            return self.get_report_rows(report, user)
+        rows, message = get_incremental_rows(self, report, user, queryset)
+        return self.iter_report_rows(
+            queryset,
+            plan.display_fields,
+            user,
+            property_filters=plan.property_filters,
+            fetched_rows=strip_pks(rows))
+
+    def report_to_list(self, queryset, display_fields, user, property_filters=[], preview=False,
+                       columnar=False):
         """ Create list from a report with all data filtering
         preview: Return only first 50
         objects: Provide objects for list, instead of running filters
         display_fields: a list of fields or a report_builder display field model
+        columnar: return a ColumnarRows instead of a list when NumPy is installed
         Returns list, message in case of issues
         """
+        rows, message = self.iter_report_rows(
+            queryset,
+            display_fields,
+            user,
+            property_filters=property_filters,
+            preview=preview,
+            columnar=columnar)
+        if isinstance(rows, ColumnarRows):
+            return rows, message
+        return list(rows), message
+
+    def get_report_page(self, report, user, page_size, cursor=None):
+        """ One page of a saved report's rows, without totals
+        Reports sorted on non-null, non-text database fields (or not sorted,
+        which are paged in pk order) are paged by keyset on the sort fields
+        and pk, so every page is one LIMIT query. Other reports run in full
+        and are sliced.
+        cursor: None for the first page, else next_cursor of the page before
+        Returns rows, next_cursor (None after the last page), message
+        """
+        plan = report.compile()
+        queryset, message = plan.get_query()
+        position = decode_page_cursor(cursor) if cursor else None
+        keyset_fields = self.get_keyset_fields(plan)
+
+        if keyset_fields is None:
+            offset = position or 0
+            if not isinstance(offset, int):
+                raise ValueError('Invalid cursor')
+            rows, message = self.iter_report_rows(
+                queryset, plan.display_fields, user,
+                property_filters=plan.property_filters, with_totals=False)
+            rows = list(itertools.islice(rows, offset, offset + page_size + 1))
+            next_cursor = None
+            if len(rows) > page_size:
+                rows = rows[:page_size]
+                next_cursor = encode_page_cursor(offset + page_size)
+            return rows, next_cursor, message
+
+        keys = [key for key, reverse in keyset_fields]
+        # Rows are fetched in this order too, unsorted reports in pk order
+        ordering = ['-' + key if reverse else key for key, reverse in keyset_fields] + ['pk']
+        page_keys = queryset.order_by(*ordering)
+        if position is not None:
+            if not isinstance(position, list) or len(position) != len(keys) + 1:
+                raise ValueError('Invalid cursor')
+            page_keys = page_keys.filter(self.get_keyset_filter(keyset_fields, position))
+        # One more than the page tells whether there is a next page
+        page_keys = list(page_keys.values_list(*(keys + ['pk']))[:page_size + 1])
+        next_cursor = None
+        if len(page_keys) > page_size:
+            page_keys = page_keys[:page_size]
+            next_cursor = encode_page_cursor(list(page_keys[-1]))
+
+        rows, message = self.iter_report_rows(
+            queryset.filter(pk__in=[page_key[-1] for page_key in page_keys]).order_by(*ordering),
+            plan.display_fields, user, with_totals=False)
+        return list(rows), next_cursor, message
+
+    def get_keyset_fields(self, plan):
+        """ (lookup, reverse) of each sort field when the report can be paged
+        by keyset, else None. Values compared by keyset must sort in the
+        database like sort_helper does and give one row per object.
+        """
+        if plan.property_filters or plan.distinct:
+            return None
+        keyset_fields = []
+        for df in plan.display_fields:
+            if df.group:
+                return None
+            if '[property]' in df.field_verbose or '[custom' in df.field_verbose:
+                continue
+            if df.resolved.multi_valued and not df.aggregate:
+                return None
+        sort_fields = sorted((df for df in plan.display_fields if df.sort and df.sort > 0),
+                             key=lambda df: df.sort)
+        for df in sort_fields:
+            if '[property]' in df.field_verbose or '[custom' in df.field_verbose:
+                return None
+            model_field = df.resolved.field
+            if model_field is None or df.aggregate or df.path or model_field.null \
+            or isinstance(model_field, (CharField, TextField)):
+                return None
+            keyset_fields.append((df.field, df.sort_reverse))
+        return keyset_fields
+
+    def get_keyset_filter(self, keyset_fields, position):
+        """ Q for the rows after position, the sort values and pk of a row """
+        keyset_filter = None
+        equal = Q()
+        for (key, reverse), value in zip(keyset_fields + [('pk', False)], position):
+            after = equal & Q(**{'%s__%s' % (key, 'lt' if reverse else 'gt'): value})
+            keyset_filter = after if keyset_filter is None else keyset_filter | after
+            equal &= Q(**{key: value})
+        return keyset_filter
+
+    def get_display_fields(self, model_class, display_fields):
+        """ Make a list of field paths into report_builder.models.DisplayField like objects """
+        new_display_fields = []
+        for display_field in display_fields:
+            field_list = display_field.split('__')
+            field = field_list[-1]
+            path = '__'.join([str(x) for x in field_list[:-1]])
+            if path:
+                path += '__' # Legacy format to append a __ here.
+            resolved = resolve_path(model_class, path, field)
+            if resolved.field is None:
+                raise FieldDoesNotExist(field)
+            choices = resolved.field.choices
+            new_display_fields.append(DisplayField(path, '', field, '', '', None, None, choices))
+        return new_display_fields
+
+    def iter_report_rows(self, queryset, display_fields, user, property_filters=[], preview=False,
+                         columnar=False, with_totals=True, raw=False, fetched_rows=None):
+        """ Create a row generator from a report with all data filtering
+        Each row goes through the fetch, property filter, property resolve,
+        totals, sort, choices and format stages one at a time. When a field
+        is totalled the TOTALS rows follow the last report row. Stages are
+        timed when the run has a timer (see start_timer).
+        preview: Return only first 50
+        display_fields: a list of fields or a report_builder display field model
+        columnar: hold all rows in a ColumnarRows, which totals, sorts and
+            formats them a column at a time. Ignored without NumPy.
+        with_totals: False to leave out the TOTALS rows
+        raw: stop after the sort stage, leaving rows unformatted and untotalled
+            with the pk of their root object appended. Not for grouped reports.
+        fetched_rows: rows already through the stages up to sort, from raw
+            runs with the pks taken off. They are totalled in python.
+        Returns generator (or ColumnarRows), message in case of issues
+        """
+        columnar = columnar and numpy is not None and not raw
         model_class = queryset.model
         if isinstance(display_fields, list):
-            # Make it a report_builder.models.DisplayField like object
-            new_display_fields = []
-            for display_field in display_fields:
-                field_list = display_field.split('__')
-                field = field_list[-1]
-                path = '__'.join([str(x) for x in field_list[:-1]])
-                if path:
-                    path += '__' # Legacy format to append a __ here.
-                new_model = get_model_from_path_string(model_class, path)
-                model_field = new_model._meta.get_field_by_name(field)[0]
-                choices = model_field.choices
-                new_display_fields.append(DisplayField(path, '', field, '', '', None, None, choices))
-            display_fields = new_display_fields
-
-        message= ""
+            display_fields = self.get_display_fields(model_class, display_fields)
+
+        message = ""
         objects = self.add_aggregates(queryset, display_fields)
 
         # Display Values
+        columns = []
         display_field_paths = []
         property_list = {}
         custom_list = {}
-        display_totals = {}
-        def append_display_total(display_totals, display_field, display_field_key):
-            if display_field.total:
-                display_totals[display_field_key] = {'val': Decimal('0.00')}
-
+        total_fields = {}
+        multi_valued = False
 
-        for i, display_field in enumerate(display_fields):
-            model = get_model_from_path_string(model_class, display_field.path)
+        for display_field in display_fields:
+            resolved = resolve_path(model_class, display_field.path)
+            model = resolved.model
             if user.has_perm(model._meta.app_label + '.change_' + model._meta.module_name) \
             or user.has_perm(model._meta.app_label + '.view_' + model._meta.module_name) \
             or not model:
-                # TODO: clean this up a bit
                 display_field_key = display_field.path + display_field.field
+                position = len(columns)
                 if '[property]' in display_field.field_verbose:
-                    property_list[i] = display_field_key
-                    append_display_total(display_totals, display_field, display_field_key)
+                    property_list[position] = display_field_key
                 elif '[custom' in display_field.field_verbose:
-                    custom_list[i] = display_field_key
-                    append_display_total(display_totals, display_field, display_field_key)
-                elif display_field.aggregate == "Avg":
-                    display_field_key += '__avg'
-                    display_field_paths += [display_field_key]
-                    append_display_total(display_totals, display_field, display_field_key)
-                elif display_field.aggregate == "Max":
-                    display_field_key += '__max'
-                    display_field_paths += [display_field_key]
-                    append_display_total(display_totals, display_field, display_field_key)
-                elif display_field.aggregate == "Min":
-                    display_field_key += '__min'
-                    display_field_paths += [display_field_key]
-                    append_display_total(display_totals, display_field, display_field_key)
-                elif display_field.aggregate == "Count":
-                    display_field_key += '__count'
-                    display_field_paths += [display_field_key]
-                    append_display_total(display_totals, display_field, display_field_key)
-                elif display_field.aggregate == "Sum":
-                    display_field_key += '__sum'
-                    display_field_paths += [display_field_key]
-                    append_display_total(display_totals, display_field, display_field_key)
+                    custom_list[position] = display_field_key
                 else:
+                    if display_field.aggregate:
+                        display_field_key += '__' + display_field.aggregate.lower()
+                    elif resolved.multi_valued:
+                        multi_valued = True
                     display_field_paths += [display_field_key]
-                    append_display_total(display_totals, display_field, display_field_key)
+                columns.append(display_field_key)
+                if display_field.total and with_totals:
+                    total_fields[position] = display_field
             else:
                 message += "You don't have permission to " + display_field.name
-        if user.has_perm(model_class._meta.app_label + '.change_' + model_class._meta.model_name) \
-        or user.has_perm(model_class._meta.app_label + '.view_' + model_class._meta.model_name):
-
-            def increment_total(display_field_key, display_totals, val):
-                if display_field_key in display_totals:
-                    # Booleans are Numbers - blah
-                    if isinstance(val, Number) and not isinstance(val, bool):
-                        # do decimal math for all numbers
-                        display_totals[display_field_key]['val'] += Decimal(str(val))
-                    else:
-                        display_totals[display_field_key]['val'] += Decimal('1.00')
-
-            # get pk for primary and m2m relations in order to retrieve objects
-            # for adding properties to report rows
-            display_field_paths.insert(0, 'pk')
-            m2m_relations = []
-            for position, property_path in property_list.items():
-                property_root = property_path.split('__')[0]
-                root_class = model_class
-                property_root_class = getattr(root_class, property_root)
-                if type(property_root_class) == ReverseManyRelatedObjectsDescriptor:
-                    display_field_paths.insert(1, '%s__pk' % property_root)
-                    m2m_relations.append(property_root)
-            values_and_properties_list = []
-            filtered_report_rows = []
-            group = None
-            for df in display_fields:
-                if df.group:
-                    group = df.path + df.field
-                    break
-            if group:
-                filtered_report_rows = self.add_aggregates(objects.values_list(group), display_fields)
+
+        if not user.has_perm(model_class._meta.app_label + '.change_' + model_class._meta.model_name) \
+        and not user.has_perm(model_class._meta.app_label + '.view_' + model_class._meta.model_name):
+            return iter([]), "Permission Denied"
+
+        # get pk for primary and m2m relations in order to retrieve objects
+        # for adding properties to report rows
+        m2m_relations = []
+        for property_path in property_list.values():
+            property_root = property_path.split('__')[0]
+            property_root_class = getattr(model_class, property_root)
+            if type(property_root_class) == ReverseManyRelatedObjectsDescriptor \
+            and property_root not in m2m_relations:
+                m2m_relations.append(property_root)
+        key_paths = ['pk'] + ['%s__pk' % property_root for property_root in m2m_relations]
+
+        group = None
+        for df in display_fields:
+            if df.group:
+                group = df.path + df.field
+                break
+
+        # Let the database sort when it can, so rows can stream in order
+        sort_fields = sorted(
+            (df for df in display_fields if getattr(df, 'sort', None) and df.sort > 0),
+            key=lambda df: df.sort)
+        db_ordering = None
+        if sort_fields and not group:
+            db_ordering = self.get_db_ordering(objects, sort_fields)
+        if db_ordering:
+            objects = objects.order_by(*db_ordering)
+
+        if fetched_rows is not None:
+            rows = self.time_rows(fetched_rows, 'fetch')
+        elif group:
+            # Order by the group alone, any other ordering ends up in the GROUP BY
+            objects = self.add_aggregates(objects.values_list(group).order_by(group), display_fields)
+            if preview:
+                rows = self.fetch_grouped_rows(objects[:self.preview_rows])
             else:
-                values_list = objects.values_list(*display_field_paths)
-
-            if not group:
-                for row in values_list:
-                    row = list(row)
-                    values_and_properties_list.append(row[1:])
-                    obj = None # we will get this only if needed for more complex processing
-                    #related_objects
-                    remove_row = False
-                    # filter properties (remove rows with excluded properties)
-                    for property_filter in property_filters:
-                        if not obj:
-                            obj = model_class.objects.get(pk=row.pop(0))
-                        root_relation = property_filter.path.split('__')[0]
-                        if root_relation in m2m_relations:
-                            pk = row[0]
-                            if pk is not None:
-                                # a related object exists
-                                m2m_obj = getattr(obj, root_relation).get(pk=pk)
-                                val = reduce(getattr, [property_filter.field], m2m_obj)
-                            else:
-                                val = None
-                        else:
-                            if '[custom' in property_filter.field_verbose:
-                                for relation in property_filter.path.split('__'):
-                                    if hasattr(obj, root_relation):
-                                        obj = getattr(obj, root_relation)
-                                val = obj.get_custom_value(property_filter.field)
-                            else:
-                                val = reduce(getattr, (property_filter.path + property_filter.field).split('__'), obj)
-                        if filter_property(property_filter, val):
-                            remove_row = True
-                            values_and_properties_list.pop()
-                            break
-                    if not remove_row:
-                        # increment totals for fields
-                        for i, field in enumerate(display_field_paths[1:]):
-                            if field in display_totals.keys():
-                                increment_total(field, display_totals, row[i])
-                        for position, display_property in property_list.items():
-                            if not obj:
-                                obj = model_class.objects.get(pk=row.pop(0))
-                            relations = display_property.split('__')
-                            root_relation = relations[0]
-                            if root_relation in m2m_relations:
-                                pk = row.pop(0)
-                                if pk is not None:
-                                    # a related object exists
-                                    m2m_obj = getattr(obj, root_relation).get(pk=pk)
-                                    val = reduce(getattr, relations[1:], m2m_obj)
-                                else:
-                                    val = None
-                            else:
-                                try: # Could error if a related field doesn't exist
-                                    val = reduce(getattr, relations, obj)
-                                except AttributeError:
-                                    val = None
-                            values_and_properties_list[-1].insert(position, val)
-                            increment_total(display_property, display_totals, val)
-                        for position, display_custom in custom_list.items():
-                            if not obj:
-                                obj = model_class.objects.get(pk=row.pop(0))
-                            val = obj.get_custom_value(display_custom)
-                            values_and_properties_list[-1].insert(position, val)
-                            increment_total(display_custom, display_totals, val)
-                        filtered_report_rows += [values_and_properties_list[-1]]
-                    if preview and len(filtered_report_rows) == 50:
-                        break
-            if hasattr(display_fields, 'filter'):
-                sort_fields = display_fields.filter(sort__gt=0).order_by('-sort').\
-                    values_list('position', 'sort_reverse')
-                for sort_field in sort_fields:
-                    try:
-                        filtered_report_rows = sorted(
-                            filtered_report_rows,
-                            key=lambda x: self.sort_helper(x, sort_field[0]-1),
-                            reverse=sort_field[1]
-                            )
-                    except TypeError: # Sorry crappy way to determine if date is being sorted
-                        filtered_report_rows = sorted(
-                            filtered_report_rows,
-                            key=lambda x: self.sort_helper(x, sort_field[0]-1, date_field=True),
-                            reverse=sort_field[1]
-                            )
-            values_and_properties_list = filtered_report_rows
+                rows = self.fetch_grouped_rows(objects)
+            rows = self.time_rows(rows, 'fetch')
         else:
-            values_and_properties_list = []
-            message = "Permission Denied"
+            if preview and property_filters:
+                # Property filters drop rows, so keep fetching pages until
+                # there are enough rows to show
+                rows = self.fetch_report_pages(
+                    objects, key_paths, display_field_paths, self.preview_rows, keyset=not db_ordering)
+            elif preview:
+                rows = self.fetch_report_rows(
+                    objects, key_paths, display_field_paths, limit=self.preview_rows)
+            else:
+                rows = self.fetch_report_rows(objects, key_paths, display_field_paths)
+            rows = self.time_rows(rows, 'fetch')
+            if property_filters or property_list or custom_list:
+                property_paths = list(property_list.values())
+                property_paths += [property_filter.path for property_filter in property_filters]
+                chunk_size = getattr(settings, 'REPORT_BUILDER_OBJECT_CHUNK_SIZE', 500)
+                if preview:
+                    chunk_size = min(chunk_size, self.preview_rows)
+                rows = self.time_rows(self.load_report_objects(
+                    rows, model_class, property_paths, m2m_relations, chunk_size), 'load_objects')
+            if property_filters:
+                rows = self.time_rows(
+                    self.filter_property_rows(rows, property_filters, chunk_size), 'property_filter')
+            if property_list or custom_list:
+                rows = self.time_rows(
+                    self.resolve_property_rows(rows, property_list, custom_list), 'properties')
+            if raw:
+                rows = self.append_pk_rows(rows)
+            else:
+                rows = (row[1] for row in rows)
+            if preview:
+                rows = itertools.islice(rows, self.preview_rows)
+
+        if self.progress is not None:
+            rows = self.progress.count_rows(rows, 'rows_fetched', 'fetching')
+
+        if total_fields and not raw:
+            # The database can only total the rows it returns as they are
+            if preview or property_filters or objects.query.distinct or multi_valued \
+            or fetched_rows is not None:
+                totals = ReportTotals(
+                    total_fields.keys(), kinds=self.get_total_kinds(model_class, total_fields))
+            else:
+                db_columns, totals_queryset = self.get_db_total_columns(
+                    objects, total_fields, group)
+                totals = ReportTotals(
+                    total_fields.keys(), db_columns, totals_queryset,
+                    self.get_total_kinds(model_class, total_fields))
+            if not columnar:
+                rows = self.time_rows(self.total_report_rows(rows, totals), 'totals')
+
+        python_sort = [(df.position, df.sort_reverse) for df in reversed(sort_fields)] \
+            if sort_fields and not db_ordering and fetched_rows is None else []
+        if columnar:
+            with self.time_block('columnar'):
+                rows = ColumnarRows.from_rows(rows, len(columns))
+                if total_fields:
+                    rows.add_to_totals(totals)
+                if python_sort:
+                    sort_columns = [(position - 1, reverse) for position, reverse in python_sort]
+                    if rows.can_sort(sort_columns):
+                        rows.sort(sort_columns)
+                    else:
+                        rows = ColumnarRows.from_rows(
+                            self.sort_report_rows(rows, python_sort), len(columns))
+        elif python_sort:
+            rows = self.time_rows(self.sort_report_rows(rows, python_sort), 'sort')
+
+        if raw:
+            return rows, message
 
         # add choice list display and display field formatting
-        choice_lists = {}
-        display_formats = {}
-        final_list = []
+        formatters = {}
+        value_formatters = {}
         for df in display_fields:
+            value_formatter = None
+            if hasattr(df, 'display_format') and df.display_format:
+                value_formatter = compile_value_formatter(df.display_format.string)
+                value_formatters[df.position] = value_formatter
             if df.choices and hasattr(df, 'choices_dict'):
-                df_choices = df.choices_dict
+                df_choices = dict(df.choices_dict)
                 # Insert blank and None as valid choices
                 df_choices[''] = ''
                 df_choices[None] = ''
-                choice_lists.update({df.position: df_choices})
-            if hasattr(df, 'display_format') and df.display_format:
-                display_formats.update({df.position: df.display_format})
-
-        for row in values_and_properties_list:
-            # add display totals for grouped result sets
-            # TODO: dry this up, duplicated logic in non-grouped total routine
-            if group:
-                # increment totals for fields
-                for i, field in enumerate(display_field_paths[1:]):
-                    if field in display_totals.keys():
-                        increment_total(field, display_totals, row[i])
-            row = list(row)
-            for position, choice_list in choice_lists.items():
-                row[position-1] = unicode(choice_list[row[position-1]])
-            for position, display_format in display_formats.items():
-                # convert value to be formatted into Decimal in order to apply
-                # numeric formats
+                formatters[df.position] = compile_choice_formatter(df_choices, value_formatter)
+            elif value_formatter:
+                formatters[df.position] = value_formatter
+        if columnar:
+            rows.formatters = dict((position - 1, formatter) for position, formatter in formatters.items())
+            if total_fields:
+                rows.trailing_rows = list(
+                    self.append_totals_rows([], len(columns), totals, value_formatters))
+            return rows, message
+
+        if formatters:
+            rows = self.time_rows(self.format_report_rows(rows, formatters), 'format')
+
+        if total_fields:
+            rows = self.time_rows(
+                self.append_totals_rows(rows, len(columns), totals, value_formatters), 'totals_rows')
+
+        return rows, message
+
+    def get_db_ordering(self, queryset, sort_fields):
+        """ Compile sorted display fields into order_by() arguments
+        The ordering matches sort_helper: strings sort case insensitively and
+        NULLs come first, or last when reversed.
+        sort_fields: display fields in order of sort priority
+        Returns a list for order_by() or None when rows must be sorted in python
+        """
+        model_class = queryset.model
+        nulls_order_largest = connections[queryset.db].features.nulls_order_largest
+        ordering = []
+        for display_field in sort_fields:
+            # The database knows nothing about properties and custom fields
+            if '[property]' in display_field.field_verbose or '[custom' in display_field.field_verbose:
+                return None
+            model_field = resolve_path(model_class, display_field.path, display_field.field).field
+            if model_field is None:
+                return None
+            display_field_key = display_field.path + display_field.field
+            aggregate = display_field.aggregate
+            if aggregate:
+                display_field_key += '__' + aggregate.lower()
+            is_text = aggregate != 'Count' and isinstance(model_field, (CharField, TextField))
+            # Aggregates of nothing and values across relations can be NULL
+            nullable = aggregate != 'Count' and \
+                bool(aggregate or display_field.path or model_field.null)
+            reorder_nulls = nullable and nulls_order_largest
+
+            if Lower is None:
+                # Without query expressions only plain orderings are possible
+                if is_text or reorder_nulls:
+                    return None
+                ordering.append('-' + display_field_key if display_field.sort_reverse else display_field_key)
+                continue
+
+            expression = Lower(display_field_key) if is_text else F(display_field_key)
+            if reorder_nulls:
                 try:
-                    value = Decimal(row[position-1])
-                except:
-                    value = row[position-1]
-                # Try to format the value, let it go without formatting for ValueErrors
+                    if display_field.sort_reverse:
+                        ordering.append(expression.desc(nulls_last=True))
+                    else:
+                        ordering.append(expression.asc(nulls_first=True))
+                except TypeError:
+                    # Django < 1.11 can't say where NULLs go
+                    return None
+            elif display_field.sort_reverse:
+                ordering.append(expression.desc())
+            else:
+                ordering.append(expression.asc())
+        # Ties keep a stable order, which pages of rows rely on
+        return ordering + ['pk']
+
+    def fetch_report_rows(self, objects, key_paths, display_field_paths, limit=None):
+        """ Row stage: stream (keys, values, object) rows out of the database
+        keys are the pk and m2m pks needed to resolve properties, the object
+        is attached by load_report_objects when a later stage needs it.
+        limit: LIMIT the query to this many rows
+        """
+        key_count = len(key_paths)
+        values_list = objects.values_list(*(key_paths + display_field_paths))
+        if limit is not None:
+            values_list = values_list[:limit]
+        for row in values_list.iterator():
+            yield row[:key_count], list(row[key_count:]), None
+
+    def fetch_report_pages(self, objects, key_paths, display_field_paths, page_size, keyset=True):
+        """ Row stage: like fetch_report_rows, but page_size rows per query
+        For stages that drop rows, so only the pages they need are queried.
+        keyset: page by pk (keyset pagination), which ignores the queryset's
+        ordering. Otherwise pages are ordered slices of the queryset.
+        """
+        key_count = len(key_paths)
+        values_list = objects.values_list(*(key_paths + display_field_paths))
+        if not keyset:
+            values_list = values_list.order_by(*(list(values_list.query.order_by) + ['pk']))
+            offset = 0
+            while True:
+                page = list(values_list[offset:offset + page_size])
+                for row in page:
+                    yield row[:key_count], list(row[key_count:]), None
+                if len(page) < page_size:
+                    return
+                offset += page_size
+
+        values_list = values_list.order_by('pk')
+        last_pk = None
+        while True:
+            page = values_list
+            if last_pk is not None:
+                page = page.filter(pk__gt=last_pk)
+            page = list(page[:page_size])
+            full_page = len(page) == page_size
+            if full_page:
+                # Joins can give an object several rows, which may go on
+                # past the page. Take all the last object's rows at once.
+                last_pk = page[-1][0]
+                page = [row for row in page if row[0] != last_pk]
+                page += list(values_list.filter(pk=last_pk))
+            for row in page:
+                yield row[:key_count], list(row[key_count:]), None
+            if not full_page:
+                break
+
+    def fetch_grouped_rows(self, objects):
+        """ Row stage: stream aggregated rows grouped by the group field """
+        for row in objects.iterator():
+            yield list(row)
+
+    def get_object_lookups(self, model_class, property_paths):
+        """ Work out the select_related and prefetch_related lookups for the
+        relations walked by property_paths (like foo__bar__property)
+        Returns select_related, prefetch_related
+        """
+        select_related = set()
+        prefetch_related = set()
+        for property_path in property_paths:
+            model = model_class
+            relations = []
+            many = False
+            for path_section in property_path.split('__'):
+                if not path_section:
+                    continue
                 try:
-                    row[position-1] = display_format.string.format(value)
-                except ValueError:
-                    row[position-1] = value
-            final_list.append(row)
-        values_and_properties_list = final_list
-
-
-        if display_totals:
-            display_totals_row = []
-
-            fields_and_properties = list(display_field_paths[1:])
-            for position, value in property_list.items():
-                fields_and_properties.insert(position, value)
-            for i, field in enumerate(fields_and_properties):
-                if field in display_totals.keys():
-                    display_totals_row += [display_totals[field]['val']]
+                    field = model._meta.get_field_by_name(path_section)
+                except FieldDoesNotExist:
+                    # A property, not a relation
+                    break
+                field_object = field[0]
+                is_direct = field[2]
+                is_m2m = field[3]
+                if is_direct and not is_m2m and not getattr(field_object, 'rel', None):
+                    break
+                if is_m2m or not is_direct:
+                    many = True
+                relations.append(path_section)
+                model = get_model_from_path_string(model, path_section)
+            if relations:
+                if many:
+                    prefetch_related.add('__'.join(relations))
                 else:
-                    display_totals_row += ['']
-
-            # add formatting to display totals
-            for df in display_fields:
-                if df.display_format:
-                    try:
-                        value = Decimal(display_totals_row[df.position-1])
-                    except:
-                        value = display_totals_row[df.position-1]
-                    # Fall back to original value if format string and value
-                    # aren't compatible, e.g. a numerically-oriented format
-                    # string with value which is not numeric.
-                    try:
-                        value = df.display_format.string.format(value)
-                    except ValueError:
-                        pass
-                    display_totals_row[df.position-1] = value
-
-            values_and_properties_list = (
-                values_and_properties_list + [
-                    ['TOTALS'] + (len(fields_and_properties) - 1) * ['']
-                    ] + [display_totals_row]
-                )
-
-        return values_and_properties_list, message
+                    select_related.add('__'.join(relations))
+        return sorted(select_related), sorted(prefetch_related)
+
+    def get_lookup_queryset(self, model_class, property_paths):
+        """ Queryset for model_class loading the relations property_paths use """
+        select_related, prefetch_related = self.get_object_lookups(model_class, property_paths)
+        queryset = model_class.objects.all()
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
+    def load_report_objects(self, rows, model_class, property_paths, m2m_relations, chunk_size):
+        """ Row stage: swap the keys of each row for (related_objects, values, object)
+        The root objects and the m2m objects of each row are loaded chunk_size
+        rows at a time with in_bulk, along with the relations property_paths
+        go through. related_objects maps m2m relation names to the row's
+        related object (or None).
+        """
+        queryset = self.get_lookup_queryset(
+            model_class,
+            [path for path in property_paths if path.split('__')[0] not in m2m_relations])
+        related_querysets = {}
+        for relation in m2m_relations:
+            related_model = getattr(model_class, relation).field.rel.to
+            related_paths = [
+                path.split('__', 1)[1] for path in property_paths
+                if path.split('__')[0] == relation and '__' in path]
+            related_querysets[relation] = self.get_lookup_queryset(related_model, related_paths)
+
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            objects = queryset.in_bulk(set(keys[0] for keys, values, obj in chunk))
+            related_maps = {}
+            for i, relation in enumerate(m2m_relations):
+                related_pks = set(keys[i+1] for keys, values, obj in chunk)
+                related_pks.discard(None)
+                related_maps[relation] = related_querysets[relation].in_bulk(related_pks)
+            for keys, values, obj in chunk:
+                obj = objects.get(keys[0])
+                # Skip objects deleted since the rows were fetched
+                if obj is None:
+                    continue
+                related_objects = {}
+                for i, relation in enumerate(m2m_relations):
+                    related_objects[relation] = related_maps[relation].get(keys[i+1])
+                yield related_objects, values, obj
+
+    def get_property_filter_value(self, property_filter, related_objects, obj):
+        root_relation = property_filter.path.split('__')[0]
+        if root_relation in related_objects:
+            m2m_obj = related_objects[root_relation]
+            if m2m_obj is None:
+                return None
+            # a related object exists
+            return reduce(getattr, [property_filter.field], m2m_obj)
+        if '[custom' in property_filter.field_verbose:
+            related_obj = obj
+            for relation in property_filter.path.split('__'):
+                if relation and hasattr(related_obj, relation):
+                    related_obj = getattr(related_obj, relation)
+            return related_obj.get_custom_value(property_filter.field)
+        return reduce(getattr, (property_filter.path + property_filter.field).split('__'), obj)
+
+    def filter_property_rows(self, rows, property_filters, chunk_size):
+        """ Row stage: drop rows excluded by property and custom field filters
+        Filters are compiled once and evaluated chunk_size rows at a time.
+        Each filter only sees the rows earlier filters kept.
+        """
+        compiled_filters = [
+            (property_filter, compile_property_filter(property_filter))
+            for property_filter in property_filters]
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            for property_filter, compiled_filter in compiled_filters:
+                filtered = compiled_filter.batch([
+                    self.get_property_filter_value(property_filter, related_objects, obj)
+                    for related_objects, values, obj in chunk])
+                chunk = [row for row, remove in zip(chunk, filtered) if not remove]
+            for row in chunk:
+                yield row
+
+    def resolve_property_rows(self, rows, property_list, custom_list):
+        """ Row stage: insert property and custom field values into each row """
+        inserts = sorted(list(property_list.items()) + list(custom_list.items()))
+        for related_objects, values, obj in rows:
+            for position, display_property in inserts:
+                if position in custom_list:
+                    val = obj.get_custom_value(display_property)
+                else:
+                    relations = display_property.split('__')
+                    root_relation = relations[0]
+                    if root_relation in related_objects:
+                        m2m_obj = related_objects[root_relation]
+                        if m2m_obj is not None:
+                            # a related object exists
+                            val = reduce(getattr, relations[1:], m2m_obj)
+                        else:
+                            val = None
+                    else:
+                        try: # Could error if a related field doesn't exist
+                            val = reduce(getattr, relations, obj)
+                        except AttributeError:
+                            val = None
+                values.insert(position, val)
+            yield related_objects, values, obj
+
+    def append_pk_rows(self, rows):
+        """ Row stage: like row[1] for row in rows, with the root object's pk
+        appended to the values """
+        for keys, values, obj in rows:
+            values.append(obj.pk if obj is not None else keys[0])
+            yield values
+
+    def get_db_total_columns(self, queryset, total_fields, group=None):
+        """ Find the totalled columns the database can sum for ReportTotals
+        Integer and decimal columns are summed, columns whose values never
+        are numbers only need the row count. Floats, averages, properties and
+        custom fields are left to python.
+        total_fields: dict of column position to display field
+        Returns db_columns, the queryset to aggregate
+        """
+        model_class = queryset.model
+        db_columns = {}
+        annotations = {}
+        for position, display_field in total_fields.items():
+            if '[property]' in display_field.field_verbose or '[custom' in display_field.field_verbose:
+                continue
+            aggregate = display_field.aggregate
+            if group and not aggregate:
+                continue
+            model_field = resolve_path(model_class, display_field.path, display_field.field).field
+            if model_field is None:
+                continue
+            internal_type = model_field.get_internal_type()
+            decimal_places = 0
+            if aggregate == 'Count':
+                kind = 'sum'
+            elif internal_type in COUNTED_FIELD_TYPES:
+                kind = 'count'
+            elif aggregate == 'Avg':
+                continue
+            elif internal_type in INTEGER_FIELD_TYPES:
+                kind = 'sum'
+            elif internal_type == 'DecimalField':
+                kind = 'sum'
+                decimal_places = model_field.decimal_places
+            else:
+                continue
+            lookup = display_field.path + display_field.field
+            if kind == 'sum' and aggregate:
+                # Aggregates are summed over a subquery of the report rows
+                lookup = 'rb_total_%s' % position
+                annotations[lookup] = AGGREGATES[aggregate](display_field.path + display_field.field)
+            db_columns[position] = (kind, lookup, decimal_places)
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+        return db_columns, queryset
+
+    def get_total_kinds(self, model_class, total_fields):
+        """ Pick the ReportTotals accumulator of each totalled column from its
+        model field and aggregate. Columns of unknown type get none.
+        total_fields: dict of column position to display field
+        Returns dict of column position to kind
+        """
+        kinds = {}
+        for position, display_field in total_fields.items():
+            if '[property]' in display_field.field_verbose or '[custom' in display_field.field_verbose:
+                continue
+            model_field = resolve_path(model_class, display_field.path, display_field.field).field
+            if model_field is None:
+                continue
+            internal_type = model_field.get_internal_type()
+            aggregate = display_field.aggregate
+            if aggregate == 'Count':
+                kinds[position] = 'int'
+            elif internal_type in COUNTED_FIELD_TYPES:
+                kinds[position] = 'count'
+            elif aggregate == 'Avg':
+                continue
+            elif internal_type in INTEGER_FIELD_TYPES:
+                kinds[position] = 'int'
+            elif internal_type == 'FloatField':
+                kinds[position] = 'float'
+            elif internal_type == 'DecimalField':
+                kinds[position] = 'decimal'
+        return kinds
+
+    def total_report_rows(self, rows, totals):
+        """ Row stage: add each row to the ReportTotals """
+        for row in rows:
+            totals.add_row(row)
+            yield row
+
+    def sort_report_rows(self, rows, sort_fields):
+        """ Row stage: sort by the display fields with a sort value
+        Sorting needs every row, so this stage holds all of them.
+        """
+        rows = list(rows)
+        for sort_field in sort_fields:
+            try:
+                rows = sorted(
+                    rows,
+                    key=lambda x: self.sort_helper(x, sort_field[0]-1),
+                    reverse=sort_field[1]
+                    )
+            except TypeError: # Sorry crappy way to determine if date is being sorted
+                rows = sorted(
+                    rows,
+                    key=lambda x: self.sort_helper(x, sort_field[0]-1, date_field=True),
+                    reverse=sort_field[1]
+                    )
+        for row in rows:
+            yield row
+
+    def format_value(self, display_format, value):
+        # convert value to be formatted into Decimal in order to apply
+        # numeric formats
+        try:
+            value = Decimal(value)
+        except Exception:
+            pass
+        # Fall back to original value if format string and value
+        # aren't compatible, e.g. a numerically-oriented format
+        # string with value which is not numeric.
+        try:
+            return display_format.string.format(value)
+        except ValueError:
+            return value
+
+    def format_report_rows(self, rows, formatters):
+        """ Row stage: show choice labels and apply display formats
+        formatters maps positions to callables from compile_value_formatter
+        or compile_choice_formatter. Rows are formatted a batch at a time, one
+        column after the other.
+        """
+        formatters = [(position - 1, formatter) for position, formatter in formatters.items()]
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.format_batch_size))
+            if not batch:
+                return
+            for index, formatter in formatters:
+                for row in batch:
+                    row[index] = formatter(row[index])
+            for row in batch:
+                yield row
+
+    def append_totals_rows(self, rows, column_count, totals, formatters):
+        """ Row stage: follow the last row with the TOTALS rows
+        totals are only complete once every row has been through.
+        formatters maps positions to callables from compile_value_formatter
+        """
+        for row in rows:
+            yield row
+
+        display_totals = totals.get_totals()
+        display_totals_row = []
+        for position in range(column_count):
+            if position in display_totals:
+                display_totals_row += [display_totals[position]]
+            else:
+                display_totals_row += ['']
+
+        # add formatting to display totals
+        for position, formatter in formatters.items():
+            display_totals_row[position-1] = formatter(display_totals_row[position-1])
+
+        yield ['TOTALS'] + (column_count - 1) * ['']
+        yield display_totals_row
 
     def sort_helper(self, x, sort_key, date_field=False):
         # If comparing datefields, assume null is the min year
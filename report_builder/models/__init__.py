@@ -1,4 +1,15 @@
 from report_builder.models.display_field import DisplayField
 from report_builder.models.filter_field import FilterField
 from report_builder.models.report import Report
-from report_builder.models.format import Format
\ No newline at end of file
+from report_builder.models.format import Format
+
+try:
+    from django.apps import AppConfig
+except ImportError:
+    # Django < 1.7 has no AppConfig.ready to connect signals in
+    from report_builder.data_versions import tracking_enabled, connect_data_versions
+    from report_builder.plan import plans_shared, connect_report_plans
+    if plans_shared():
+        connect_report_plans()
+    if tracking_enabled():
+        connect_data_versions()
@@ -1,6 +1,6 @@
 from django.conf import settings
 from django.db import models
-from report_builder.utils import get_model_from_path_string
+from report_builder.utils import resolve_path
 
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
@@ -64,8 +64,10 @@ class DisplayField(models.Model):
     @property
     def choices(self):
         if self.pk:
-            model = get_model_from_path_string(self.report.root_model.model_class(), self.path)
-            return self.get_choices(model, self.field)
+            resolved = resolve_path(self.report.root_model.model_class(), self.path, self.field)
+            if resolved.choices:
+                # See https://github.com/burke-software/django-report-builder/pull/93
+                return ((resolved.field.get_prep_value(key), val) for key, val in resolved.choices)
 
     def __unicode__(self):
         return self.name
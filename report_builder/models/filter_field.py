@@ -2,7 +2,7 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
 from dateutil import parser
-from report_builder.utils import get_model_from_path_string, get_aware_time
+from report_builder.utils import resolve_path, get_aware_time
 
 from django.db.models import Q
 
@@ -70,10 +70,11 @@ class FilterField(models.Model):
         ordering = ['position']
 
     @staticmethod
-    def get_report_filters(report):
+    def get_report_filters(report, report_filter_fields=None):
         """
         Returns the queryset filters and excludes as well as any error messages that might accompany them
         :param report: Report object for which to retrieve the filters and excludes
+        :param report_filter_fields: the report's filter fields, when already loaded
         :return: filters, excludes and messages
         """
         and_filters = []
@@ -81,7 +82,8 @@ class FilterField(models.Model):
         excludes = {}
         message = ''
 
-        report_filter_fields = report.filterfield_set.all()
+        if report_filter_fields is None:
+            report_filter_fields = report.filterfield_set.all()
 
         for filter_field in report_filter_fields:
             # remove the namespace redundancy
@@ -176,8 +178,7 @@ class FilterField(models.Model):
     @property
     def choices(self):
         if self.pk:
-            model = get_model_from_path_string(self.report.root_model.model_class(), self.path)
-            return self.get_choices(model, self.field)
+            return resolve_path(self.report.root_model.model_class(), self.path, self.field).choices
 
     def __unicode__(self):
         return self.field
@@ -1,14 +1,20 @@
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.db import models
-from django.db.models import Avg, Min, Max, Count, Sum, Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models import Avg, Min, Max, Count, Sum
 from report_builder.unique_slugify import unique_slugify
 from django.template import loader, Context
 from report_builder.models import FilterField
-from report_builder.utils import get_allowed_models, get_model_manager
-import operator
-from functools import reduce
+from report_builder.utils import get_allowed_models
+from report_builder import data_versions
+from report_builder.plan import compile_report
+from report_builder.schedule import ON_CHANGE, validate_refresh_schedule, is_refresh_due
+from django.core.serializers.json import DjangoJSONEncoder
+import hashlib
+import json
 
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
@@ -24,6 +30,17 @@ class Report(models.Model):
     distinct = models.BooleanField(default=False)
     report_file = models.FileField(upload_to="report_files", blank=True)
     report_file_creation = models.DateTimeField(blank=True, null=True)
+    refresh_schedule = models.CharField(
+        max_length=100, blank=True, validators=[validate_refresh_schedule],
+        help_text='Regenerate the report file in the background: a cron expression '
+                  '("0 5 * * 1-5") or "on_change" for after its data changed.')
+    change_tracking_field = models.CharField(
+        max_length=255, blank=True,
+        help_text='A date time field of the root model set whenever a row changes. Report files are '
+                  'then refreshed by merging the rows changed since the last file into it.')
+    tombstone_field = models.CharField(
+        max_length=255, blank=True,
+        help_text='A field of the root model marking rows deleted, which are left out of the report.')
 
     root_model = models.ForeignKey(ContentType, limit_choices_to={'pk__in': get_allowed_models()})
     user_created = models.ForeignKey(AUTH_USER_MODEL, editable=False, blank=True, null=True)
@@ -33,10 +50,37 @@ class Report(models.Model):
                                      help_text="These users have starred this report for easy reference.",
                                      related_name="report_starred_set")
 
+    # ReportPlan compiled from this instance, see compile()
+    _plan = None
+
     def save(self, *args, **kwargs):
         if not self.id:
             unique_slugify(self, self.name)
         super(Report, self).save(*args, **kwargs)
+        self._plan = None
+
+    def clean(self):
+        """
+        Check change_tracking_field and tombstone_field name fields of the root model,
+        which every compile and incremental refresh of the report look up
+        """
+        errors = {}
+        model_class = self.root_model.model_class() if self.root_model_id else None
+        if model_class is not None:
+            for name in ('change_tracking_field', 'tombstone_field'):
+                field_name = getattr(self, name)
+                if not field_name:
+                    continue
+                try:
+                    field = model_class._meta.get_field(field_name)
+                except FieldDoesNotExist:
+                    errors[name] = '%s has no field %s' % (model_class._meta.verbose_name, field_name)
+                    continue
+                if name == 'change_tracking_field' and not isinstance(field, models.DateField):
+                    # DateTimeField is a DateField too
+                    errors[name] = 'Enter a date or date time field of the root model'
+        if errors:
+            raise ValidationError(errors)
 
     def add_aggregates(self, queryset):
         """
@@ -75,42 +119,108 @@ class Report(models.Model):
 
         return queryset
 
+    def compile(self):
+        """
+        Immutable plan of the report, kept on this instance until it is
+        saved. Load the report again to see changes made to its fields.
+        :return: ReportPlan
+        """
+        return compile_report(self)
+
     def get_query(self):
         """
         Builds the report's queryset
         :return: QuerySet Object, Error messages
         """
-        report = self
-        model_class = report.root_model.model_class()
+        return self.compile().get_query()
 
-        # Check for report_builder_model_manger property on the model
-        if getattr(model_class, 'report_builder_model_manager', False):
-            objects = getattr(model_class, 'report_builder_model_manager').all()
-        else:
-            # Get global model manager
-            manager = get_model_manager()
-            objects = getattr(model_class, manager).all()
+    def get_definition(self):
+        """
+        Everything about the report that changes its rows
+        :return: dict of json serializable values
+        """
+        return self.compile().definition
 
-        # Filters & exclude
-        and_filters, or_filters, excludes, message = FilterField.get_report_filters(report)
+    def get_report_models(self):
+        """
+        The root model and every model on the paths of the report's fields
+        :return: set of model classes
+        """
+        return set(self.compile().models)
 
-        if and_filters:
-            and_filters = [Q(x) for x in and_filters]
-            objects = objects.filter(reduce(operator.and_, and_filters))
-        if or_filters:
-            or_filters = [Q(x) for x in or_filters]
-            objects = objects.filter(reduce(operator.or_, or_filters))
-        if excludes:
-            objects = objects.exclude(**excludes)
+    def get_data_fingerprint(self):
+        """
+        Hash of the data versions of get_report_models(), which changes
+        whenever any of their rows are saved or deleted
+        :return: str, or None when data versions are not tracked
+        """
+        if not data_versions.tracking_enabled():
+            return None
+        return data_versions.get_data_fingerprint(self.get_report_models())
+
+    def get_report_file_key(self):
+        """
+        Identifies a report_file made from the current definition and data
+        :return: str, or None when data versions are not tracked
+        """
+        fingerprint = self.get_data_fingerprint()
+        if fingerprint is None:
+            return None
+        definition = json.dumps(self.get_definition(), sort_keys=True, cls=DjangoJSONEncoder)
+        return hashlib.md5((definition + fingerprint).encode('utf-8')).hexdigest()
 
-        # Aggregates
-        objects = self.add_aggregates(objects)
+    def get_definition_key(self):
+        """
+        Hash of the report definition, see get_definition()
+        :return: str
+        """
+        definition = json.dumps(self.get_definition(), sort_keys=True, cls=DjangoJSONEncoder)
+        return hashlib.md5(definition.encode('utf-8')).hexdigest()
 
-        # Distinct
-        if report.distinct:
-            objects = objects.distinct()
+    def report_file_made_for(self, user):
+        """
+        True when report_file was made by a user with the same permissions
+        as user, so it holds no columns user may not see
+        :return: bool
+        """
+        return data_versions.get_report_file_permissions(self.pk) == \
+            data_versions.get_permissions_key(user)
 
-        return objects, message
+    def report_file_is_current(self, user=None):
+        """
+        True when report_file can be served instead of running the report again
+        :param user: also require the file to be made for this user, see report_file_made_for
+        :return: bool
+        """
+        if not self.report_file:
+            return False
+        if user is not None and not self.report_file_made_for(user):
+            return False
+        key = self.get_report_file_key()
+        return key is not None and data_versions.get_report_file_key(self.pk) == key
+
+    def report_file_is_fresh(self, user=None):
+        """
+        True when report_file can be served right away: it is current, or a
+        scheduled refresh made it from the current definition and the next
+        refresh is not due yet
+        :param user: the user to serve it to, see report_file_is_current
+        :return: bool
+        """
+        if self.report_file_is_current(user):
+            return True
+        schedule = self.refresh_schedule.strip()
+        if not self.report_file or not schedule or schedule == ON_CHANGE:
+            return False
+        # Refreshes run as REPORT_BUILDER_REFRESH_USER, who may see more
+        if user is not None and not self.report_file_made_for(user):
+            return False
+        if data_versions.get_report_file_definition(self.pk) != self.get_definition_key():
+            return False
+        try:
+            return not is_refresh_due(self)
+        except ValueError:
+            return False
 
     def get_absolute_url(self):
         """
@@ -186,6 +296,7 @@ class Report(models.Model):
             if display_field.position != i+1:
                 display_field.position = i+1
                 display_field.save()
+                self._plan = None
 
     # ==============================================================================
     # Arbitrary model properties
@@ -0,0 +1,297 @@
+"""
+Partitioned report runs, for splitting large exports over workers
+
+The root queryset is split into pk ranges of about equal size. Each range
+goes through the fetch, property and sort stages in a worker, and the sorted
+partitions are merged back into the report's order, so totals and formatting
+run once over all rows. Set DataExportMixin.partitions (the async report task
+takes REPORT_BUILDER_PARTITIONS) to enable it. REPORT_BUILDER_PARTITION_BACKEND
+picks the workers: 'serial' (the default, one partition after the other),
+'thread' (a thread pool, each thread with its own database connection) or
+'process' (a multiprocessing pool). Daemonic processes, like the workers of
+a celery prefork pool, may not start processes, so there 'process' uses
+threads. Reports of fewer than REPORT_BUILDER_PARTITION_MIN_ROWS root
+objects, and grouped reports, are not split.
+
+Each partition is sorted in python by get_row_key, not only by the database,
+whose collation may order text differently, and written in chunks to a
+temporary file, so the partitions merge in the order of
+DataExportMixin.sort_report_rows while only one chunk of each is in memory.
+Partitions tie and, without sorted columns, merge in pk order. Reports whose
+rows a whole run would order by the model's Meta.ordering instead are not
+split.
+"""
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from six import string_types
+from six.moves import cPickle as pickle
+import functools
+import heapq
+import itertools
+import os
+import shutil
+import tempfile
+
+# Rows pickled at a time into partition files
+CHUNK_SIZE = 1000
+
+
+def get_partition_count():
+    return getattr(settings, 'REPORT_BUILDER_PARTITIONS', 1)
+
+
+def get_pk_ranges(queryset, partitions, min_rows=0):
+    """ Split the pks of queryset into up to partitions ranges of about equal size
+    Returns (low, high) pairs for get_partition_filter, None for an open end
+    """
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    count = pks.count()
+    if count < max(min_rows, 2):
+        return [(None, None)]
+    # Duplicate bounds would make empty ranges
+    bounds = sorted(set(pks[count * i // partitions] for i in range(1, partitions)))
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def get_partition_filter(low, high):
+    partition_filter = Q()
+    if low is not None:
+        partition_filter &= Q(pk__gte=low)
+    if high is not None:
+        partition_filter &= Q(pk__lt=high)
+    return partition_filter
+
+
+def write_partition(rows, directory):
+    """ Pickle rows in chunks to a new file in directory, returns its path
+    The file is made by mkstemp, so no other user can read it or swap it
+    before read_partition loads it back. """
+    fd, path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as partition_file:
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK_SIZE))
+            if not chunk:
+                break
+            pickle.dump(chunk, partition_file, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def read_partition(path):
+    """ Rows of a file written by write_partition, one chunk at a time """
+    with open(path, 'rb') as partition_file:
+        while True:
+            try:
+                chunk = pickle.load(partition_file)
+            except EOFError:
+                return
+            for row in chunk:
+                yield row
+
+
+def run_partition(arguments):
+    """ Write the raw rows of one pk range of a report to a file in directory,
+    see iter_report_rows. Rows are sorted by get_row_key, for merge_partition_rows.
+    arguments: (report_id, user_id, low, high, directory), one tuple so pools can map it
+    Returns the path of the file
+    """
+    from django.contrib.auth import get_user_model
+    from .mixins import DataExportMixin
+    from .models import Report
+    report_id, user_id, low, high, directory = arguments
+    report = Report.objects.get(pk=report_id)
+    user = get_user_model().objects.get(pk=user_id)
+    plan = report.compile()
+    queryset, message = plan.get_query()
+    rows, message = DataExportMixin().iter_report_rows(
+        queryset.filter(get_partition_filter(low, high)),
+        plan.display_fields,
+        user,
+        property_filters=plan.property_filters,
+        raw=True)
+    return write_partition(sort_raw_rows(rows, get_sort_keys(plan)), directory)
+
+
+def run_partition_in_thread(arguments):
+    try:
+        return run_partition(arguments)
+    finally:
+        # Each thread opened connections of its own
+        for connection in connections.all():
+            connection.close()
+
+
+def get_pool_size():
+    # None starts one worker per core
+    return getattr(settings, 'REPORT_BUILDER_PARTITION_PROCESSES', None)
+
+
+def map_in_threads(arguments):
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(get_pool_size())
+    try:
+        return pool.map(run_partition_in_thread, arguments)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def map_in_processes(arguments):
+    from multiprocessing import Pool, current_process
+    if current_process().daemon:
+        return map_in_threads(arguments)
+    # Forked workers must open connections of their own
+    for connection in connections.all():
+        connection.close()
+    pool = Pool(get_pool_size())
+    try:
+        return pool.map(run_partition, arguments)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def map_serially(arguments):
+    return [run_partition(args) for args in arguments]
+
+
+PARTITION_BACKENDS = {
+    'serial': map_serially,
+    'thread': map_in_threads,
+    'process': map_in_processes,
+}
+
+
+@functools.total_ordering
+class ReversedKey(object):
+    """ Sort key ordering its value the other way round """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def get_row_key(row, sort_keys):
+    """ Sort key of a raw row, ordering like DataExportMixin.sort_report_rows
+    and the database ordering from get_db_ordering: text case insensitively
+    and NULLs first, or last when reversed.
+    sort_keys: (column index, reverse) pairs, most significant first
+    """
+    key = []
+    for index, reverse in sort_keys:
+        value = row[index]
+        value = (value is not None, value.lower() if isinstance(value, string_types) else value)
+        key.append(ReversedKey(value) if reverse else value)
+    return tuple(key)
+
+
+def get_sort_fields(plan):
+    """ Sorted display fields of plan, most significant first """
+    return sorted((df for df in plan.display_fields if df.sort and df.sort > 0),
+                  key=lambda df: df.sort)
+
+
+def get_sort_keys(plan):
+    """ (column index, reverse) of each sorted column of plan, most significant first """
+    return [(df.position - 1, df.sort_reverse) for df in get_sort_fields(plan)]
+
+
+def get_queryset_ordering(queryset):
+    """ The order_by() terms of queryset, or the model's Meta.ordering it falls back to """
+    query = queryset.query
+    if query.order_by:
+        return list(query.order_by)
+    if query.default_ordering:
+        return list(queryset.model._meta.ordering)
+    return []
+
+
+def can_merge_in_pk_order(queryset, plan):
+    """ True when merging partitions in pk order gives the order of a run over
+    the whole queryset. That run keeps the queryset's ordering for reports
+    without sorted columns and for ties of columns sorted in python, but
+    orders ties by pk where the database sorts, see get_db_ordering. """
+    from .mixins import DataExportMixin
+    pk = queryset.model._meta.pk
+    if get_queryset_ordering(queryset) in ([], ['pk'], [pk.name], [pk.attname]):
+        return True
+    # Columns the database sorts are ordered by pk last, see get_db_ordering
+    sort_fields = get_sort_fields(plan)
+    return bool(sort_fields) and DataExportMixin().get_db_ordering(queryset, sort_fields) is not None
+
+
+def sort_raw_rows(rows, sort_keys):
+    """ Raw rows as a list sorted by get_row_key, ties in pk order """
+    sort_keys = list(sort_keys) + [(-1, False)]
+    return sorted(rows, key=lambda row: get_row_key(row, sort_keys))
+
+
+def merge_partition_rows(partitions, sort_keys):
+    """ Rows of sorted partitions as one sorted sequence
+    Partitions must be sorted by get_row_key, see sort_raw_rows. They are
+    in pk order and ties keep it, so rows come out in the order of a run
+    over the whole queryset sorted in python.
+    """
+    if not sort_keys:
+        return itertools.chain.from_iterable(partitions)
+
+    def decorate(partition_index, rows):
+        for row_index, row in enumerate(rows):
+            yield get_row_key(row, sort_keys), partition_index, row_index, row
+
+    merged = heapq.merge(*[decorate(index, rows) for index, rows in enumerate(partitions)])
+    return (item[-1] for item in merged)
+
+
+def merge_partition_files(directory, paths, sort_keys):
+    """ Rows of the partition files at paths, merged by merge_partition_rows
+    directory is removed once the rows are read or the generator is closed """
+    partitions = [read_partition(path) for path in paths]
+    try:
+        for row in merge_partition_rows(partitions, sort_keys):
+            yield row
+    finally:
+        for partition in partitions:
+            partition.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def fetch_partitioned_rows(report, user, queryset, plan, partitions):
+    """ Raw rows of report, fetched in parallel over pk ranges of queryset
+    Returns the merged rows, each ending with its pk, or None when the
+    report is not split
+    """
+    if partitions < 2 or any(df.group for df in plan.display_fields):
+        return None
+    if not can_merge_in_pk_order(queryset, plan):
+        return None
+    ranges = get_pk_ranges(
+        queryset, partitions, getattr(settings, 'REPORT_BUILDER_PARTITION_MIN_ROWS', 10000))
+    if len(ranges) < 2:
+        return None
+    map_partitions = PARTITION_BACKENDS[getattr(settings, 'REPORT_BUILDER_PARTITION_BACKEND', 'serial')]
+    # mkdtemp makes a directory only this user can open
+    directory = tempfile.mkdtemp(prefix='report_builder_partitions_')
+    try:
+        paths = map_partitions([(report.pk, user.pk, low, high, directory) for low, high in ranges])
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    return merge_partition_files(directory, paths, get_sort_keys(plan))
+
+
+def strip_pks(rows):
+    """ Take the pk off the end of raw rows """
+    for row in rows:
+        row.pop()
+        yield row
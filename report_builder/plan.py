@@ -0,0 +1,254 @@
+"""
+Compiled report plans
+
+Report.compile() reads a report's display and filter fields once and keeps
+the result, with everything derived from them, in an immutable ReportPlan.
+By default a plan is kept on the Report instance it was compiled from, so it
+lives as long as the request or run that loaded the report. When
+REPORT_BUILDER_DATA_VERSION_CACHE names a cache shared by every process,
+plans are also cached per process and checked against a version in it,
+which saving or deleting a report, its fields or a format bumps. Changes
+made with QuerySet.update() send no signals and are not noticed then.
+"""
+from django.conf import settings
+from django.db.models import Q, Avg, Count, Sum, Max, Min
+from django.db.models.fields import FieldDoesNotExist
+from django.forms.models import model_to_dict
+from collections import namedtuple
+from functools import reduce
+import operator
+import threading
+
+from .data_versions import bump_version, get_versions
+from .utils import get_model_manager, resolve_path
+
+PLAN_VERSION_PREFIX = 'report_builder_report_plan_'
+ALL_PLANS_VERSION_KEY = PLAN_VERSION_PREFIX + 'all'
+
+AGGREGATES = {
+    'Avg': Avg,
+    'Max': Max,
+    'Min': Min,
+    'Count': Count,
+    'Sum': Sum,
+}
+
+
+class PlanField(namedtuple("PlanField", "path path_verbose field field_verbose name aggregate total "
+                                        "group sort sort_reverse position width display_format "
+                                        "choices choices_dict resolved")):
+    """ A display field as compiled into a plan """
+    __slots__ = ()
+
+
+class ReportPlan(namedtuple("ReportPlan", "report_id model_class display_fields columns header widths "
+                                          "and_filter or_filter excludes filter_message aggregates "
+                                          "distinct property_filters models definition tombstone_filter")):
+    """
+    Everything needed to run a report, built once by Report.compile()
+    display_fields are PlanFields in position order, and_filter/or_filter
+    the report's filters as single Q objects and aggregates the annotations
+    of aggregated display fields.
+    """
+    __slots__ = ()
+
+    def get_query(self):
+        """ The report's queryset and any filter error messages """
+        model_class = self.model_class
+
+        # Check for report_builder_model_manger property on the model
+        if getattr(model_class, 'report_builder_model_manager', False):
+            objects = getattr(model_class, 'report_builder_model_manager').all()
+        else:
+            # Get global model manager
+            manager = get_model_manager()
+            objects = getattr(model_class, manager).all()
+
+        if self.and_filter is not None:
+            objects = objects.filter(self.and_filter)
+        if self.or_filter is not None:
+            objects = objects.filter(self.or_filter)
+        if self.excludes:
+            objects = objects.exclude(**self.excludes)
+        if self.tombstone_filter:
+            objects = objects.exclude(**self.tombstone_filter)
+
+        for aggregate in self.aggregates:
+            objects = objects.annotate(aggregate)
+
+        if self.distinct:
+            objects = objects.distinct()
+
+        return objects, self.filter_message
+
+
+def compile_plan_field(model_class, display_field):
+    resolved = resolve_path(model_class, display_field.path, display_field.field)
+    choices = resolved.choices
+    choices_dict = None
+    if choices:
+        # See https://github.com/burke-software/django-report-builder/pull/93
+        choices = tuple((resolved.field.get_prep_value(key), val) for key, val in choices)
+        choices_dict = dict(choices)
+    return PlanField(
+        display_field.path,
+        display_field.path_verbose,
+        display_field.field,
+        display_field.field_verbose,
+        display_field.name,
+        display_field.aggregate,
+        display_field.total,
+        display_field.group,
+        display_field.sort,
+        display_field.sort_reverse,
+        display_field.position,
+        display_field.width,
+        display_field.display_format,
+        choices,
+        choices_dict,
+        resolved,
+    )
+
+
+def get_report_definition(report, display_fields, filter_fields):
+    """ Everything about report that changes its rows """
+    definition_fields = []
+    for display_field in display_fields:
+        fields = model_to_dict(display_field)
+        if display_field.display_format:
+            fields['display_format'] = display_field.display_format.string
+        definition_fields.append(fields)
+    return {
+        'report': report.pk,
+        'root_model': report.root_model_id,
+        'distinct': report.distinct,
+        'change_tracking_field': report.change_tracking_field,
+        'tombstone_field': report.tombstone_field,
+        'display_fields': definition_fields,
+        'filter_fields': [model_to_dict(filter_field) for filter_field in filter_fields],
+    }
+
+
+def get_tombstone_filter(model_class, tombstone_field):
+    """ filter() arguments for the root objects tombstone_field marks deleted """
+    field = resolve_path(model_class, '', tombstone_field).field
+    if field is None:
+        raise FieldDoesNotExist(tombstone_field)
+    if field.get_internal_type() in ('BooleanField', 'NullBooleanField'):
+        return {tombstone_field: True}
+    return {tombstone_field + '__isnull': False}
+
+
+def build_report_plan(report):
+    from .models import FilterField
+
+    model_class = report.root_model.model_class()
+    display_fields = list(report.displayfield_set.select_related('display_format'))
+    filter_fields = list(report.filterfield_set.all())
+
+    plan_fields = tuple(compile_plan_field(model_class, display_field)
+                        for display_field in display_fields)
+
+    aggregates = []
+    for display_field in display_fields:
+        if display_field.aggregate in AGGREGATES:
+            aggregates.append(AGGREGATES[display_field.aggregate](display_field.path + display_field.field))
+
+    and_filters, or_filters, excludes, message = FilterField.get_report_filters(report, filter_fields)
+    and_filter = or_filter = None
+    if and_filters:
+        and_filter = reduce(operator.and_, [Q(x) for x in and_filters])
+    if or_filters:
+        or_filter = reduce(operator.or_, [Q(x) for x in or_filters])
+
+    property_filters = tuple(
+        filter_field for filter_field in filter_fields
+        if '[property]' in filter_field.field_verbose or '[custom' in filter_field.field_verbose)
+
+    models = set([model_class])
+    for field in display_fields + filter_fields:
+        models.update(hop.model for hop in resolve_path(model_class, field.path).hops)
+
+    return ReportPlan(
+        report.pk,
+        model_class,
+        plan_fields,
+        tuple(field.path + field.field for field in plan_fields),
+        tuple(field.name for field in plan_fields),
+        tuple(field.width for field in plan_fields),
+        and_filter,
+        or_filter,
+        excludes,
+        message,
+        tuple(aggregates),
+        report.distinct,
+        property_filters,
+        frozenset(models),
+        get_report_definition(report, display_fields, filter_fields),
+        get_tombstone_filter(model_class, report.tombstone_field) if report.tombstone_field else None,
+    )
+
+
+_report_plans = {}
+_report_plans_lock = threading.Lock()
+
+
+def get_plan_version(report_id):
+    report_key = PLAN_VERSION_PREFIX + str(report_id)
+    versions = get_versions([report_key, ALL_PLANS_VERSION_KEY])
+    return versions[report_key], versions[ALL_PLANS_VERSION_KEY]
+
+
+def plans_shared():
+    """ True when plans may be cached across requests, see the module docstring """
+    return bool(getattr(settings, 'REPORT_BUILDER_DATA_VERSION_CACHE', None))
+
+
+def compile_report(report):
+    """ The ReportPlan of report, cached on report and, when plans_shared(),
+    per process until its version changes """
+    if report._plan is not None:
+        return report._plan
+    if report.pk is None or not plans_shared():
+        report._plan = build_report_plan(report)
+        return report._plan
+    # Settings can turn sharing on after startup
+    connect_report_plans()
+    version = get_plan_version(report.pk)
+    cached = _report_plans.get(report.pk)
+    if cached is not None and cached[0] == version:
+        report._plan = cached[1]
+        return report._plan
+    report._plan = build_report_plan(report)
+    with _report_plans_lock:
+        _report_plans[report.pk] = (version, report._plan)
+    return report._plan
+
+
+def invalidate_report_plan(sender, instance, **kwargs):
+    """ Signal receiver for reports, their fields and formats """
+    from .models import Report, Format
+    if sender is Report:
+        bump_version(PLAN_VERSION_PREFIX + str(instance.pk))
+    elif sender is Format:
+        # A format can be used by any report
+        bump_version(ALL_PLANS_VERSION_KEY)
+    else:
+        bump_version(PLAN_VERSION_PREFIX + str(instance.report_id))
+
+
+_plans_connected = False
+
+
+def connect_report_plans():
+    global _plans_connected
+    if _plans_connected:
+        return
+    _plans_connected = True
+    from django.db.models.signals import post_save, post_delete
+    from .models import Report, DisplayField, FilterField, Format
+    for model in (Report, DisplayField, FilterField, Format):
+        post_save.connect(invalidate_report_plan, sender=model,
+                          dispatch_uid='report_builder_plan_saved_%s' % model.__name__)
+        post_delete.connect(invalidate_report_plan, sender=model,
+                            dispatch_uid='report_builder_plan_deleted_%s' % model.__name__)
@@ -0,0 +1,73 @@
+"""
+Progress of report runs, for async reports to publish while they work
+"""
+import time
+
+
+class ReportProgress(object):
+    """
+    Counts the rows of one report run through its stages
+    publish is called with progress_info() when the stage changes and at
+    most every interval seconds while rows go through.
+    total_rows, when known, gives an ETA.
+    """
+    def __init__(self, publish, total_rows=None, interval=1.0):
+        self.publish_info = publish
+        self.total_rows = total_rows
+        self.interval = interval
+        self.current_stage = 'pending'
+        self.rows_fetched = 0
+        self.rows_written = 0
+        self.started = time.time()
+        self.published = 0
+
+    def stage(self, name):
+        self.current_stage = name
+        self.publish(force=True)
+
+    def count_rows(self, rows, counter, stage):
+        """ Pass rows through, counting them in the counter attribute
+        The stage starts with the first row, so when counters are nested the
+        stage follows the rows: the fetch counter of a writer's rows starts
+        fetching, and the writer's own counter takes over once rows reach it.
+        """
+        count = getattr(self, counter)
+        started = False
+        for row in rows:
+            if not started:
+                started = True
+                self.stage(stage)
+            count += 1
+            setattr(self, counter, count)
+            if not count % 100:
+                self.publish()
+            yield row
+        if not started:
+            self.stage(stage)
+        self.publish(force=True)
+
+    def get_eta(self):
+        """ Seconds left, from the pace rows have been written at """
+        if not self.total_rows or not self.rows_written:
+            return None
+        elapsed = time.time() - self.started
+        remaining = max(self.total_rows - self.rows_written, 0)
+        return round(elapsed / self.rows_written * remaining, 1)
+
+    def progress_info(self):
+        return {
+            'stage': self.current_stage,
+            'rows_fetched': self.rows_fetched,
+            'rows_written': self.rows_written,
+            'total_rows': self.total_rows,
+            'eta': self.get_eta(),
+            'elapsed': round(time.time() - self.started, 1),
+            # Lets clients spot a task that stopped making progress
+            'updated': time.time(),
+        }
+
+    def publish(self, force=False):
+        now = time.time()
+        if force or now - self.published >= self.interval:
+            self.published = now
+            self.publish_info(self.progress_info())
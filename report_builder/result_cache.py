@@ -0,0 +1,185 @@
+"""
+Cache of report rows, shared by downloads and previews
+
+Enable with REPORT_BUILDER_RESULT_CACHE = 'cache' (a Django cache, picked by
+REPORT_BUILDER_RESULT_CACHE_ALIAS) or 'disk' (JSON files in
+REPORT_BUILDER_RESULT_CACHE_DIR, a temporary directory only this user can
+open by default). Entries expire after
+REPORT_BUILDER_RESULT_CACHE_MAX_AGE seconds and the least recently used are
+evicted beyond REPORT_BUILDER_RESULT_CACHE_MAX_ENTRIES.
+"""
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from .data_versions import get_permissions_key
+from .utils import TypedJSONEncoder, decode_typed_value, make_private_dir
+
+
+class CacheResultStore(object):
+    """ Keep entries in a Django cache backend """
+    prefix = 'report_builder_result_'
+
+    def __init__(self, alias='default'):
+        try:
+            from django.core.cache import caches
+            self.cache = caches[alias]
+        except ImportError:
+            from django.core.cache import get_cache
+            self.cache = get_cache(alias)
+
+    def get(self, key):
+        return self.cache.get(self.prefix + key)
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(self.prefix + key, value, timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.prefix + key)
+
+    def incr(self, key):
+        try:
+            self.cache.incr(self.prefix + key)
+        except ValueError:
+            self.cache.set(self.prefix + key, 1, None)
+
+
+class DiskResultStore(object):
+    """ Keep entries as JSON files in a directory only this user can open
+    Row values JSON has no type for come back as text, see TypedJSONEncoder """
+    lock = threading.Lock()
+
+    def __init__(self, directory):
+        self.directory = directory
+        make_private_dir(directory)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, key), 'rb') as cache_file:
+                return json.loads(cache_file.read().decode('utf-8'), object_hook=decode_typed_value)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, key, value, timeout=None):
+        content = json.dumps(value, cls=TypedJSONEncoder)
+        # Write then rename so readers never see half a file
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as cache_file:
+            cache_file.write(content.encode('utf-8'))
+        os.rename(path, os.path.join(self.directory, key))
+
+    def delete(self, key):
+        try:
+            os.remove(os.path.join(self.directory, key))
+        except OSError:
+            pass
+
+    def incr(self, key):
+        with self.lock:
+            self.set(key, (self.get(key) or 0) + 1)
+
+
+class ReportResultCache(object):
+    """
+    Rows and message of report runs, keyed by the report definition, the
+    user's permissions and the data version of the report's models
+    """
+    index_key = 'index'
+
+    def __init__(self, store, max_entries=100, max_age=300, max_rows=100000):
+        self.store = store
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_rows = max_rows
+
+    def get_data_version(self, report):
+        """ Version of the data report reads. Unless data versions are
+        tracked, data changes are only picked up once entries reach max_age. """
+        return report.get_data_fingerprint() or ''
+
+    def get_key(self, report, user, preview=False):
+        key = json.dumps([
+            report.get_definition(),
+            get_permissions_key(user),
+            self.get_data_version(report),
+            preview,
+        ], sort_keys=True, cls=DjangoJSONEncoder)
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """ (rows, message) for key, or None """
+        entry = self.store.get(key)
+        if entry is not None and time.time() - entry[0] > self.max_age:
+            self.store.delete(key)
+            entry = None
+        if entry is None:
+            self.store.incr('misses')
+            return None
+        self.store.incr('hits')
+        self.touch(key)
+        return entry[1], entry[2]
+
+    def set(self, key, rows, message):
+        self.store.set(key, (time.time(), rows, message), self.max_age)
+        self.touch(key)
+
+    def touch(self, key):
+        """ Mark key most recently used and evict past max_entries
+        Concurrent writers may drop each other's index updates. Entries lost
+        that way still expire after max_age. """
+        index = [k for k in self.store.get(self.index_key) or [] if k != key]
+        index.append(key)
+        while len(index) > self.max_entries:
+            self.store.delete(index.pop(0))
+        self.store.set(self.index_key, index)
+
+    def cache_rows(self, key, rows, message):
+        """ Pass rows through, storing them once all have been produced """
+        collected = []
+        for row in rows:
+            if collected is not None:
+                if len(collected) < self.max_rows:
+                    collected.append(row)
+                else:
+                    collected = None
+            yield row
+        if collected is not None:
+            self.set(key, collected, message)
+
+    def clear(self):
+        for key in self.store.get(self.index_key) or []:
+            self.store.delete(key)
+        for key in (self.index_key, 'hits', 'misses'):
+            self.store.delete(key)
+
+    def stats(self):
+        return {
+            'hits': self.store.get('hits') or 0,
+            'misses': self.store.get('misses') or 0,
+            'entries': len(self.store.get(self.index_key) or []),
+        }
+
+
+def get_result_cache():
+    """ The configured ReportResultCache, or None when caching is off """
+    backend = getattr(settings, 'REPORT_BUILDER_RESULT_CACHE', False)
+    if not backend:
+        return None
+    if backend == 'disk':
+        store = DiskResultStore(getattr(
+            settings,
+            'REPORT_BUILDER_RESULT_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'report_builder_cache')))
+    else:
+        store = CacheResultStore(getattr(settings, 'REPORT_BUILDER_RESULT_CACHE_ALIAS', 'default'))
+    return ReportResultCache(
+        store,
+        max_entries=getattr(settings, 'REPORT_BUILDER_RESULT_CACHE_MAX_ENTRIES', 100),
+        max_age=getattr(settings, 'REPORT_BUILDER_RESULT_CACHE_MAX_AGE', 300),
+        max_rows=getattr(settings, 'REPORT_BUILDER_RESULT_CACHE_MAX_ROWS', 100000),
+    )
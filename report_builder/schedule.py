@@ -0,0 +1,150 @@
+"""
+Background refresh of stored report files
+
+A report's refresh_schedule is a cron expression (minute hour day month
+weekday, e.g. "0 5 * * 1-5") or "on_change", which regenerates report_file
+once the report's data changed and needs REPORT_BUILDER_TRACK_DATA_VERSIONS.
+Run the refresh_report_files management command from cron, or put the
+report_builder_refresh_report_files task in the celery beat schedule, every
+few minutes. Refreshes run with the permissions of the user named by
+REPORT_BUILDER_REFRESH_USER, else of whoever last changed the report, and
+their files are only served to users with the same permissions.
+"""
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from collections import namedtuple
+import datetime
+
+from . import data_versions
+
+ON_CHANGE = 'on_change'
+# Ranges of minute, hour, day of month, month and day of week (0 and 7 are Sunday)
+CRON_FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def parse_cron_field(field, low, high):
+    """ Set of the values a cron field like "*/15", "1-5" or "0,30" matches """
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(value) for value in part.split('-', 1)]
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if step < 1 or start < low or end > high or start > end:
+            raise ValueError('%s is out of range' % field)
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule(namedtuple("CronSchedule", "minutes hours days months weekdays any_day any_weekday")):
+    """ A parsed cron expression """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('A cron expression has five fields')
+        minutes, hours, days, months, weekdays = [
+            parse_cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELD_RANGES)]
+        if 7 in weekdays:
+            weekdays = (weekdays - set([7])) | set([0])
+        return cls(frozenset(minutes), frozenset(hours), frozenset(days), frozenset(months),
+                   frozenset(weekdays), fields[2] == '*', fields[4] == '*')
+
+    def matches_day(self, day):
+        if day.month not in self.months:
+            return False
+        in_days = day.day in self.days
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays
+        # Like cron, a restricted day of month and day of week match either
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def previous_run(self, now):
+        """ The latest minute at or before now the schedule fires at
+        None when it does not fire within five years, e.g. on February 30
+        """
+        today = now.date()
+        day = today
+        for i in range(366 * 5):
+            if self.matches_day(day):
+                for hour in sorted(self.hours, reverse=True):
+                    if day == today and hour > now.hour:
+                        continue
+                    minutes = [minute for minute in self.minutes
+                               if day != today or hour < now.hour or minute <= now.minute]
+                    if minutes:
+                        return datetime.datetime.combine(day, datetime.time(hour, max(minutes)))
+            day -= datetime.timedelta(days=1)
+        return None
+
+
+def validate_refresh_schedule(value):
+    if value and value.strip() != ON_CHANGE:
+        try:
+            CronSchedule.parse(value)
+        except ValueError as e:
+            raise ValidationError('Enter "%s" or a cron expression: %s' % (ON_CHANGE, e))
+
+
+def is_refresh_due(report, now=None):
+    """ True when the report's schedule wants report_file made again """
+    schedule = report.refresh_schedule.strip()
+    if not schedule:
+        return False
+    if schedule == ON_CHANGE:
+        return data_versions.tracking_enabled() and not report.report_file_is_current()
+    if not report.report_file or report.report_file_creation is None:
+        return True
+    # Schedules are in local time
+    now = get_local_time(now or timezone.now())
+    previous_run = CronSchedule.parse(schedule).previous_run(now)
+    return previous_run is not None and get_local_time(report.report_file_creation) < previous_run
+
+
+def get_local_time(value):
+    """ value as a naive local time, like it is when USE_TZ is off """
+    if timezone.is_aware(value):
+        return timezone.make_naive(value, timezone.get_current_timezone())
+    return value
+
+
+def get_due_reports(now=None):
+    from .models import Report
+    due_reports = []
+    for report in Report.objects.exclude(refresh_schedule=''):
+        try:
+            if is_refresh_due(report, now):
+                due_reports.append(report)
+        except ValueError:
+            continue  # Saved before validation, left alone until fixed
+    return due_reports
+
+
+def get_refresh_user(report):
+    """ The user a scheduled refresh of report runs as, or None """
+    username = getattr(settings, 'REPORT_BUILDER_REFRESH_USER', None)
+    if username:
+        from django.contrib.auth import get_user_model
+        User = get_user_model()
+        return User.objects.get(**{User.USERNAME_FIELD: username})
+    return report.user_modified or report.user_created
+
+
+def refresh_report(report, user):
+    """ Make the report's report_file again, in this process """
+    from .partitions import get_partition_count
+    from .views import DownloadXlsxView
+    view = DownloadXlsxView()
+    view.partitions = get_partition_count()
+    view.process_report(report.pk, user.pk, to_response=False)
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Sent by a timed report run once it finishes, see timing.py.
+# timings: dict of stage name to seconds spent in that stage alone
+# counters: dict of rows_in, rows_out, queries, bytes_written and total_seconds
+# profile_path: file of the cProfile stats, or None when not profiled
+report_timed = Signal(providing_args=['report_id', 'timings', 'counters', 'profile_path'])
@@ -27,7 +27,15 @@ function check_if_report_done(report_id, task_id) {
 	if (check_report != false ){
 		$.get( "/report_builder/report/"+ report_id + "/check_status/" + task_id + "/", function( data ) {
 			console.log(data);
+			if (data.progress) {
+				var progress = data.progress.stage + ": " + data.progress.rows_written + " rows written";
+				if (data.progress.eta !== null) {
+					progress += ", about " + Math.ceil(data.progress.eta) + "s left";
+				}
+				$('#report_progress').text(progress);
+			}
 			if (data.state == "SUCCESS") {
+				$('#report_progress').text('');
 				window.location.href = data.link;
 				clearInterval(check_report);
 				check_report = false;
@@ -37,6 +45,11 @@ function check_if_report_done(report_id, task_id) {
 }
 function get_async_report(report_id) {
 	$.get( "/report_builder/report/"+ report_id + "/download_xlsx/", function( data ) {
+	if (data.link) {
+		// The stored report file is still current
+		window.location.href = data.link;
+		return;
+	}
 	var task_id = data.task_id;
 	status = "loading"
 	check_report = setInterval( function(){ check_if_report_done(report_id, task_id); }, 2000 );
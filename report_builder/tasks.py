@@ -1,10 +1,39 @@
 from __future__ import absolute_import
 
 from celery import shared_task
+from celery.result import AsyncResult
+from django.conf import settings
+from django.core.cache import cache
+from .partitions import get_partition_count
+from .progress import ReportProgress
+from .schedule import get_due_reports, get_refresh_user
 from .views import DownloadXlsxView
 
 
-@shared_task
-def report_builder_async_report_save(report_id, user_id):
+@shared_task(bind=True)
+def report_builder_async_report_save(self, report_id, user_id):
     view = DownloadXlsxView()
+    # check_status reads the progress from the task meta
+    view.progress = ReportProgress(lambda info: self.update_state(state='PROGRESS', meta=info))
+    view.partitions = get_partition_count()
     view.process_report(report_id, user_id, to_response=False)
+
+
+@shared_task
+def report_builder_refresh_report_files():
+    """ Start making report_file again for every report due a scheduled refresh """
+    for report in get_due_reports():
+        user = get_refresh_user(report)
+        if user is not None:
+            start_report_task(report.pk, user.pk)
+
+
+def start_report_task(report_id, user_id):
+    """ Start report_builder_async_report_save unless it already runs for
+    this report and user, returns the task id """
+    task_key = 'report_builder_report_task_%s_%s' % (report_id, user_id)
+    task_id = cache.get(task_key)
+    if task_id is None or AsyncResult(task_id).ready():
+        task_id = report_builder_async_report_save.delay(report_id, user_id).task_id
+        cache.set(task_key, task_id, getattr(settings, 'REPORT_BUILDER_ASYNC_TASK_TIMEOUT', 3600))
+    return task_id
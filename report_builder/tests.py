@@ -1,10 +1,33 @@
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.client import Client
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.utils import timezone
 from .models import Report, DisplayField
 from .views import *
 from django.conf import settings
-from .utils import get_properties_from_model, get_direct_fields_from_model
+from six import BytesIO, StringIO
+from unittest import skipUnless
+from decimal import Decimal
+import datetime
+import os
+import tempfile
+from .mixins import compile_value_formatter, ReportTotals, encode_page_cursor, decode_page_cursor
+from .columnar import ColumnarRows, numpy
+from .partitions import get_pk_ranges, merge_partition_rows, merge_partition_files, read_partition, \
+    write_partition
+from .benchmarks.results import compare_results, load_results
+from .incremental import delete_snapshot, load_snapshot
+from .progress import ReportProgress
+from .signals import report_timed
+from .schedule import CronSchedule, is_refresh_due, get_due_reports
+from .result_cache import DiskResultStore, get_result_cache
+from . import data_versions
+from .utils import get_properties_from_model, get_direct_fields_from_model, clear_introspection_cache, \
+    resolve_path, _introspection_cache
 
 try:
     from django.contrib.auth import get_user_model
@@ -46,7 +69,7 @@ class UtilityFunctionTests(TestCase):
         self.assertTrue('description' in names)
         self.assertTrue('distinct' in names)
         self.assertTrue('id' in names)
-        self.assertEquals(len(names), 9)
+        self.assertEquals(len(names), 12)
 
     def test_get_custom_fields_from_model(self):
         if 'custom_field' in settings.INSTALLED_APPS:
@@ -64,11 +87,74 @@ class UtilityFunctionTests(TestCase):
         self.assertEquals(properties[0]['label'], 'choices')
         self.assertEquals(properties[1]['label'], 'choices_dict')
 
+    def test_introspection_cache(self):
+        clear_introspection_cache()
+        fields = get_relation_fields_from_model(Report)
+        fields.pop()
+        with self.assertNumQueries(0):
+            cached = get_relation_fields_from_model(Report)
+        self.assertEquals(len(cached), len(fields) + 1)
+        clear_introspection_cache(Report)
+        ContentType.objects.clear_cache()
+        with CaptureQueriesContext(connection) as queries:
+            get_relation_fields_from_model(Report)
+        self.assertTrue(len(queries))
+
+    def test_get_relation_fields_from_model_queries(self):
+        clear_introspection_cache()
+        ContentType.objects.clear_cache()
+        exclude = [self.report_ct.id, ContentType.objects.get_for_model(DisplayField).id]
+        with CaptureQueriesContext(connection) as queries:
+            fields = get_relation_fields_from_model(Report, exclude)
+        self.assertTrue(len(queries) <= 3)
+        for field in fields:
+            if field.field_ct is not None:
+                self.assertEquals(field.field_ct.model_class()._meta.model_name,
+                                  (field.rel.to if hasattr(field, 'rel') else field.model)._meta.model_name)
+
+    def test_get_relation_fields_from_model_exclude(self):
+        clear_introspection_cache()
+        all_names = [field.field_name for field in get_relation_fields_from_model(Report)]
+        self.assertTrue('displayfield' in all_names)
+        exclude = [ContentType.objects.get_for_model(DisplayField).id]
+        names = [field.field_name for field in get_relation_fields_from_model(Report, exclude)]
+        self.assertEquals(names, [name for name in all_names if name != 'displayfield'])
+        # Excludes come from requests, so they must not add cache entries
+        self.assertEquals(len([key for key in _introspection_cache if key[1] is Report]), 1)
+
+    def test_resolve_path(self):
+        resolved = resolve_path(Report, 'displayfield__report__', 'name')
+        self.assertTrue(resolved is resolve_path(Report, 'displayfield__report__', 'name'))
+        self.assertEquals(resolved.model, Report)
+        self.assertEquals(resolved.field.name, 'name')
+        self.assertEquals([hop.name for hop in resolved.hops], ['displayfield', 'report'])
+        self.assertEquals([hop.is_reverse for hop in resolved.hops], [True, False])
+        self.assertTrue(resolved.multi_valued)
+        self.assertFalse(resolve_path(DisplayField, 'report__').multi_valued)
+        self.assertEquals(resolve_path(FilterField, '', 'filter_type').choices,
+                          tuple(FilterField._meta.get_field_by_name('filter_type')[0].choices))
+
     def test_filter_property(self):
         # Not a very complete test - only tests one type of filter
         result = filter_property(self.filter_field, 'spam')
         self.assertTrue(result)
 
+    def test_compile_property_filter(self):
+        values = [None, 0, 3, 2.5, Decimal('7.25'), True, 'spam', 'Lots of SPAM', '12',
+                  datetime.date(2014, 6, 1), datetime.datetime(2014, 6, 1, 12, 30)]
+        filter_values = ['spam', '3', '2.5', '1234', '2014-05-01', 'sp[a', 'S', '1']
+        for filter_type, label in FilterField.FILTER_TYPE_CHOICES:
+            for filter_value in filter_values:
+                for exclude in (False, True):
+                    filter_field = FilterField(
+                        filter_type=filter_type,
+                        filter_value=filter_value,
+                        exclude=exclude)
+                    compiled = compile_property_filter(filter_field)
+                    expected = [filter_property(filter_field, value) for value in values]
+                    self.assertEquals([compiled(value) for value in values], expected, (filter_type, filter_value, exclude))
+                    self.assertEquals(compiled.batch(values), expected)
+
     def test_custom_global_model_manager(self):
         #test for custom global model manager
         if getattr(settings, 'REPORT_BUILDER_MODEL_MANAGER', False):
@@ -87,6 +173,30 @@ class UtilityFunctionTests(TestCase):
             self.assertEquals(objects[0], self.report)
 
 
+    def test_cron_schedule(self):
+        schedule = CronSchedule.parse('*/15 5-6 * * 1-5')
+        now = datetime.datetime(2014, 3, 10, 6, 20)  # A Monday
+        self.assertEquals(schedule.previous_run(now), datetime.datetime(2014, 3, 10, 6, 15))
+        self.assertEquals(schedule.previous_run(now.replace(hour=4)), datetime.datetime(2014, 3, 7, 6, 45))
+        # Day of month or day of week
+        schedule = CronSchedule.parse('0 0 1 * 7')
+        self.assertEquals(schedule.previous_run(now), datetime.datetime(2014, 3, 9, 0, 0))
+        self.assertEquals(schedule.previous_run(now.replace(day=2)), datetime.datetime(2014, 3, 2, 0, 0))
+        for expression in ['* * *', '60 * * * *', '5-1 * * * *', '*/0 * * * *']:
+            self.assertRaises(ValueError, CronSchedule.parse, expression)
+        self.assertEquals(CronSchedule.parse('0 0 30 2 *').previous_run(now), None)
+
+
+    def test_compare_benchmark_results(self):
+        baseline = {'scale': 10, 'benchmarks': {
+            'fast': {'median': 0.001}, 'slow': {'median': 1.0}, 'same': {'median': 1.0}}}
+        results = {'scale': 10, 'benchmarks': {
+            'fast': {'median': 0.004}, 'slow': {'median': 1.5}, 'same': {'median': 1.1}, 'new': {'median': 2}}}
+        self.assertEquals(compare_results(results, baseline), [('slow', 1.0, 1.5)])
+        baseline['scale'] = 100
+        self.assertRaises(ValueError, compare_results, results, baseline)
+
+
 class ViewTests(TestCase):
     def setUp(self):
         self.user = User.objects.create_user('user', 'temporary@example.com', 'user')
@@ -132,3 +242,665 @@ class ViewTests(TestCase):
         self.assertContains(response, "name [CharField]")
         self.assertContains(response, "path [CharField]")
 
+
+    def add_name_display_field(self):
+        self.user.is_superuser = True
+        self.user.save()
+        DisplayField.objects.create(
+            report=self.report,
+            field='name',
+            field_verbose='name [CharField]',
+            name='Name',
+            position=1)
+        self.filter_field.delete()
+
+    def test_download_xlsx(self):
+        self.add_name_display_field()
+        response = self.c.get('/report_builder/report/%s/download_xlsx/' % self.report.pk)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        from openpyxl import load_workbook
+        wb = load_workbook(BytesIO(b''.join(response.streaming_content)))
+        ws = wb.worksheets[0]
+        self.assertEquals(ws.cell(row=1, column=1).value, 'Name')
+        self.assertEquals(ws.cell(row=2, column=1).value, 'foo report')
+
+    def test_download_csv(self):
+        self.add_name_display_field()
+        response = self.c.get('/report_builder/report/%s/download_csv/' % self.report.pk)
+        self.assertEquals(response['Content-Type'], 'text/csv')
+        content = b''.join(response.streaming_content)
+        self.assertEquals(content.splitlines(), [b'Name', b'foo report'])
+
+    def test_download_jsonl(self):
+        self.add_name_display_field()
+        response = self.c.get('/report_builder/report/%s/download_jsonl/' % self.report.pk)
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEquals([json.loads(line) for line in lines], [['Name'], ['foo report']])
+
+
+    def test_download_timed(self):
+        self.add_name_display_field()
+        timed = []
+
+        def receiver(sender, **kwargs):
+            timed.append(kwargs)
+        report_timed.connect(receiver)
+        try:
+            with self.settings(REPORT_BUILDER_SERVER_TIMING=True,
+                               REPORT_BUILDER_PROFILE_REPORTS=[self.report.pk],
+                               REPORT_BUILDER_PROFILE_DIR=tempfile.mkdtemp()):
+                response = self.c.get('/report_builder/report/%s/download_xlsx/' % self.report.pk)
+                self.assertIn('fetch;dur=', response['Server-Timing'])
+                self.assertIn('write;dur=', response['Server-Timing'])
+                self.assertEquals(timed[0]['report_id'], self.report.pk)
+                self.assertEquals(list(timed[0]['timings']), ['fetch', 'write'])
+                counters = timed[0]['counters']
+                self.assertEquals((counters['rows_in'], counters['rows_out']), (1, 1))
+                self.assertTrue(counters['queries'] > 0)
+                self.assertEquals(counters['bytes_written'], int(response['Content-Length']))
+                self.assertTrue(os.path.exists(timed[0]['profile_path']))
+
+                response = self.c.get('/report_builder/report/%s/download_csv/' % self.report.pk)
+                self.assertFalse(response.has_header('Server-Timing'))
+                self.assertEquals(len(timed), 1)
+                content = b''.join(response.streaming_content)
+                self.assertEquals(timed[1]['counters']['bytes_written'], len(content))
+        finally:
+            report_timed.disconnect(receiver)
+
+    def test_download_fresh_report_file(self):
+        self.report.refresh_schedule = '0 5 * * *'
+        self.report.report_file = 'report_files/foo.xlsx'
+        self.report.report_file_creation = timezone.now()
+        self.report.save()
+        # Not made by a refresh of this definition
+        self.assertFalse(self.report.report_file_is_fresh())
+        data_versions.set_report_file_definition(self.report.pk, self.report.get_definition_key())
+        self.assertFalse(is_refresh_due(self.report))
+        # Made by a refresh user with other permissions
+        data_versions.set_report_file_permissions(self.report.pk, None)
+        self.assertTrue(self.report.report_file_is_fresh())
+        self.assertFalse(self.report.report_file_is_fresh(self.user))
+        data_versions.set_report_file_permissions(self.report.pk, data_versions.get_permissions_key(self.user))
+        response = self.c.get('/report_builder/report/%s/download_xlsx/' % self.report.pk)
+        self.assertEquals(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('report_files/foo.xlsx'))
+        self.report.report_file_creation -= datetime.timedelta(days=1)
+        self.report.save()
+        self.assertTrue(is_refresh_due(self.report))
+        self.assertEquals(get_due_reports(), [self.report])
+
+    def test_refresh_due_use_tz(self):
+        self.report.refresh_schedule = '0 5 * * *'
+        self.report.report_file = 'report_files/foo.xlsx'
+        with self.settings(USE_TZ=True):
+            self.report.report_file_creation = timezone.now()
+            self.report.save()
+            report = Report.objects.get(pk=self.report.pk)
+            self.assertTrue(timezone.is_aware(report.report_file_creation))
+            self.assertFalse(is_refresh_due(report))
+            self.assertEquals(get_due_reports(), [])
+
+    def test_report_file_made_for(self):
+        other = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.report.report_file = 'report_files/foo.xlsx'
+        self.report.save()
+        with self.settings(REPORT_BUILDER_TRACK_DATA_VERSIONS=True):
+            data_versions.set_report_file_key(self.report.pk, self.report.get_report_file_key())
+            data_versions.set_report_file_permissions(self.report.pk, data_versions.get_permissions_key(other))
+            self.assertTrue(self.report.report_file_is_current())
+            self.assertTrue(self.report.report_file_is_current(other))
+            # Made by a superuser, it may hold columns user can't see
+            self.assertFalse(self.report.report_file_is_current(self.user))
+
+    def test_report_rows(self):
+        self.add_name_display_field()
+        response = self.c.get('/report_builder/report/%s/rows/' % self.report.pk, {'page_size': 1})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEquals(data['header'], ['Name'])
+        self.assertEquals(data['rows'], [['foo report']])
+        self.assertEquals(data['next_cursor'], None)
+        response = self.c.get('/report_builder/report/%s/rows/' % self.report.pk, {'cursor': '!'})
+        self.assertEquals(response.status_code, 400)
+
+
+class DataExportMixinTests(TestCase):
+    def test_list_to_xlsx_stream(self):
+        rows = (['row %s' % i, i] for i in range(100))
+        xlsx_file = DataExportMixin().list_to_xlsx_stream(rows, header=['name', 'number'])
+        from openpyxl import load_workbook
+        ws = load_workbook(xlsx_file).worksheets[0]
+        self.assertEquals(ws.cell(row=1, column=2).value, 'number')
+        self.assertEquals(ws.cell(row=101, column=1).value, 'row 99')
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        report_ct = ContentType.objects.get_for_model(Report)
+        data_report = Report.objects.create(name="data report", root_model=report_ct)
+        for position, (field, filter_type) in enumerate(
+                [('b', 'exact'), ('c', 'gt'), ('a', 'iregex')]):
+            FilterField.objects.create(
+                report=data_report,
+                field=field,
+                field_verbose=field,
+                filter_type=filter_type,
+                filter_value='x',
+                position=position+1)
+        self.report = Report.objects.create(
+            name="filter field report",
+            root_model=ContentType.objects.get_for_model(FilterField))
+        for position, (field, field_verbose) in enumerate([
+                ('field', 'field [CharField]'),
+                ('filter_type', 'filter type [CharField]'),
+                ('position', 'position [PositiveSmallIntegerField]'),
+                ('choices', 'choices [property]')]):
+            DisplayField.objects.create(
+                report=self.report,
+                field=field,
+                field_verbose=field_verbose,
+                name=field,
+                position=position+1)
+        self.report.displayfield_set.filter(field='field').update(sort=1)
+        self.report.displayfield_set.filter(field='position').update(
+            total=True,
+            display_format=Format.objects.create(name='two places', string='{:.2f}'))
+
+    def test_report_to_list(self):
+        queryset, message = self.report.get_query()
+        objects_list, message = DataExportMixin().report_to_list(
+            queryset, self.report.displayfield_set.all(), self.user)
+        self.assertEquals(message, '')
+        self.assertEquals(objects_list, [
+            ['a', 'Reg. Exp. (Case Insensitive)', '3.00', None],
+            ['b', 'Equals', '1.00', None],
+            ['c', 'Greater Than', '2.00', None],
+            ['TOTALS', '', '', ''],
+            ['', '', '6.00', ''],
+        ])
+
+    def test_iter_report_rows_property_filter(self):
+        queryset, message = self.report.get_query()
+        property_filter = FilterField(
+            field='choices',
+            field_verbose='choices [property]',
+            filter_type='isnull',
+            filter_value='1',
+            exclude=True)
+        rows, message = DataExportMixin().iter_report_rows(
+            queryset,
+            self.report.displayfield_set.all(),
+            self.user,
+            property_filters=[property_filter])
+        self.assertEquals(list(rows)[-1], ['', '', '0.00', ''])
+
+    def test_iter_report_rows_batches_objects(self):
+        queryset, message = self.report.get_query()
+        rows, message = DataExportMixin().iter_report_rows(
+            queryset, self.report.displayfield_set.all(), self.user)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(len(list(rows)), 5)
+        # The values, the in_bulk objects and the totals
+        filter_field_queries = [
+            query for query in queries.captured_queries
+            if 'FROM "report_builder_filterfield"' in query['sql']]
+        self.assertEquals(len(filter_field_queries), 3)
+
+    def test_get_object_lookups(self):
+        select_related, prefetch_related = DataExportMixin().get_object_lookups(
+            DisplayField, ['report__root_model__name', 'report__starred__username', 'choices'])
+        self.assertEquals(select_related, ['report__root_model'])
+        self.assertEquals(prefetch_related, ['report__starred'])
+
+    def test_iter_report_rows_m2m_property(self):
+        report = Report.objects.create(
+            name="starred report",
+            root_model=ContentType.objects.get_for_model(Report))
+        report.starred.add(self.user)
+        DisplayField.objects.create(
+            report=report,
+            path='starred__',
+            field='username',
+            field_verbose='username [property]',
+            name='Starred by',
+            position=1)
+        queryset = Report.objects.filter(pk=report.pk)
+        rows, message = DataExportMixin().iter_report_rows(
+            queryset, report.displayfield_set.all(), self.user)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(list(rows), [['admin']])
+        # The values, the reports and the starring users
+        self.assertEquals(len(queries.captured_queries), 3)
+
+    def test_iter_report_rows_db_ordering(self):
+        self.report.displayfield_set.update(sort=None)
+        self.report.displayfield_set.filter(field='position').update(sort=1, sort_reverse=True)
+        queryset, message = self.report.get_query()
+        rows, message = DataExportMixin().iter_report_rows(
+            queryset, self.report.displayfield_set.all(), self.user)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals([row[0] for row in rows], ['a', 'c', 'b', 'TOTALS', ''])
+        self.assertTrue('ORDER BY "report_builder_filterfield"."position" DESC'
+                        in queries.captured_queries[0]['sql'])
+
+    def test_iter_report_rows_db_totals(self):
+        FilterField.objects.filter(field='c').update(position=None)
+        self.report.displayfield_set.filter(field='field').update(total=True)
+        queryset, message = self.report.get_query()
+        rows, message = DataExportMixin().iter_report_rows(
+            queryset, self.report.displayfield_set.all(), self.user)
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(rows)
+        # Strings count one each, like NULLs in the summed column
+        self.assertEquals(rows[-1], [Decimal('3.00'), '', '5.00', ''])
+        self.assertTrue('SUM(' in queries.captured_queries[-1]['sql'])
+
+    def test_iter_report_rows_grouped(self):
+        self.report.displayfield_set.filter(field__in=['field', 'choices']).delete()
+        self.report.check_report_display_field_positions()
+        self.report.displayfield_set.filter(field='filter_type').update(group=True)
+        self.report.displayfield_set.filter(field='position').update(aggregate='Sum')
+        queryset, message = self.report.get_query()
+        rows, message = DataExportMixin().iter_report_rows(
+            queryset, self.report.displayfield_set.all(), self.user)
+        self.assertEquals(list(rows), [
+            ['Equals', '1.00'],
+            ['Greater Than', '2.00'],
+            ['Reg. Exp. (Case Insensitive)', '3.00'],
+            ['TOTALS', ''],
+            ['', '6.00'],
+        ])
+
+    def test_iter_report_rows_preview_limit(self):
+        queryset, message = self.report.get_query()
+        mixin = DataExportMixin()
+        mixin.preview_rows = 2
+        rows, message = mixin.iter_report_rows(
+            queryset, self.report.displayfield_set.all(), self.user, preview=True)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals([row[0] for row in rows], ['b', 'c', 'TOTALS', ''])
+        self.assertTrue('LIMIT 2' in queries.captured_queries[0]['sql'])
+
+    def test_iter_report_rows_preview_pages(self):
+        queryset, message = self.report.get_query()
+        property_filter = FilterField(
+            field='filter_type',
+            field_verbose='filter type [property]',
+            filter_type='exact',
+            filter_value='exact',
+            exclude=True)
+        mixin = DataExportMixin()
+        mixin.preview_rows = 1
+        rows, message = mixin.iter_report_rows(
+            queryset,
+            self.report.displayfield_set.all(),
+            self.user,
+            property_filters=[property_filter],
+            preview=True)
+        # The first row is filtered out, the second page has one to show
+        self.assertEquals([row[0] for row in rows], ['c', 'TOTALS', ''])
+
+    def test_get_report_rows_result_cache(self):
+        mixin = DataExportMixin()
+        with self.settings(REPORT_BUILDER_RESULT_CACHE='disk',
+                           REPORT_BUILDER_RESULT_CACHE_DIR=tempfile.mkdtemp()):
+            result_cache = get_result_cache()
+            result_cache.clear()
+            rows, message = mixin.get_report_rows(self.report, self.user)
+            expected = list(rows)
+            rows, message = mixin.get_report_rows(self.report, self.user)
+            self.assertEquals(list(rows), expected)
+            self.assertEquals(result_cache.stats()['entries'], 1)
+            # Changing the report changes its key
+            self.report.displayfield_set.filter(field='choices').delete()
+            report = Report.objects.get(pk=self.report.pk)
+            rows, message = mixin.get_report_rows(report, self.user)
+            self.assertEquals(len(list(rows)[0]), 3)
+            stats = result_cache.stats()
+            self.assertEquals((stats['hits'], stats['entries']), (1, 2))
+
+    def test_disk_result_store(self):
+        directory = os.path.join(tempfile.mkdtemp(), 'cache')
+        store = DiskResultStore(directory)
+        self.assertEquals(os.stat(directory).st_mode & 0o777, 0o700)
+        value = [1.5, [['a', Decimal('1.10'), datetime.date(2015, 1, 2)]], '']
+        store.set('key', value)
+        self.assertEquals(store.get('key'), value)
+        with open(os.path.join(directory, 'key'), 'wb') as cache_file:
+            cache_file.write(b'not json')
+        self.assertEquals(store.get('key'), None)
+
+    def test_data_fingerprint(self):
+        self.assertEquals(self.report.get_data_fingerprint(), None)
+        with self.settings(REPORT_BUILDER_TRACK_DATA_VERSIONS=True):
+            self.assertEquals(self.report.get_report_models(), set([FilterField]))
+            fingerprint = self.report.get_data_fingerprint()
+            self.assertEquals(fingerprint, self.report.get_data_fingerprint())
+            data_versions.data_changed(Format)
+            self.assertEquals(fingerprint, self.report.get_data_fingerprint())
+            data_versions.data_changed(FilterField)
+            self.assertNotEqual(fingerprint, self.report.get_data_fingerprint())
+
+    def test_data_tracking_senders(self):
+        cache = data_versions.get_version_cache()
+        with self.settings(REPORT_BUILDER_TRACK_DATA_VERSIONS=True):
+            cache.delete(data_versions.TRACKED_MODELS_KEY)
+            tracked = data_versions.get_tracked_models()
+            self.assertTrue('report_builder.filterfield' in tracked)
+            self.assertFalse('report_builder.format' in tracked)
+            try:
+                fingerprint = self.report.get_data_fingerprint()
+                Format.objects.create(name='unread')
+                self.assertEquals(fingerprint, self.report.get_data_fingerprint())
+                FilterField.objects.all()[0].save()
+                self.assertNotEqual(fingerprint, self.report.get_data_fingerprint())
+            finally:
+                cache.set(data_versions.TRACKED_MODELS_KEY, [], None)
+                data_versions.refresh_data_tracking()
+                cache.delete(data_versions.TRACKED_MODELS_KEY)
+
+    def test_compile(self):
+        plan = self.report.compile()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.report.compile() is plan)
+        self.assertEquals(plan.header, ('field', 'filter_type', 'position', 'choices'))
+        self.assertEquals([df.field for df in plan.display_fields if df.sort], ['field'])
+        self.assertEquals(plan.display_fields[1].choices_dict['exact'], 'Equals')
+        self.assertEquals(plan.display_fields[2].display_format.string, '{:.2f}')
+        with self.assertRaises(AttributeError):
+            plan.header = ()
+        self.report.displayfield_set.get(field='choices').delete()
+        # Kept on the instance, not shared with other requests
+        self.assertTrue(self.report.compile() is plan)
+        report = Report.objects.get(pk=self.report.pk)
+        self.assertEquals(report.compile().header, ('field', 'filter_type', 'position'))
+
+    def test_compile_shared(self):
+        with self.settings(REPORT_BUILDER_DATA_VERSION_CACHE='default'):
+            plan = Report.objects.get(pk=self.report.pk).compile()
+            self.assertTrue(Report.objects.get(pk=self.report.pk).compile() is plan)
+            self.report.displayfield_set.get(field='choices').delete()
+            report = Report.objects.get(pk=self.report.pk)
+            self.assertEquals(report.compile().header, ('field', 'filter_type', 'position'))
+
+    def test_compile_value_formatter(self):
+        mixin = DataExportMixin()
+        values = [3, 2.5, Decimal('1.005'), True, '4.25', 'abc', None,
+                  datetime.date(2014, 1, 2), datetime.timedelta(days=1)]
+        for format_string in ['{:.2f}', '{}', '{:,}', '{:>8}']:
+            display_format = Format(name='format', string=format_string)
+            formatter = compile_value_formatter(format_string)
+            for value in values:
+                try:
+                    expected = mixin.format_value(display_format, value)
+                except Exception as e:
+                    self.assertRaises(type(e), formatter, value)
+                else:
+                    self.assertEquals(formatter(value), expected)
+
+    def test_typed_totals(self):
+        values = [1, 2, 2 ** 70, None, True, 'x', Decimal('1.25'), 0.1, 0.2, datetime.date(2014, 1, 1)]
+        generic = ReportTotals([0])
+        kinds = ['int', 'float', 'decimal', 'count']
+        typed = ReportTotals(range(len(kinds)), kinds=dict(enumerate(kinds)))
+        for value in values:
+            generic.add_row([value])
+            typed.add_row([value] * len(kinds))
+        expected = generic.get_totals()[0]
+        for position, total in typed.get_totals().items():
+            self.assertEquals(total, expected)
+            self.assertEquals(str(total), str(expected))
+        # Each float is added as the Decimal of its str(), not summed as floats
+        totals = ReportTotals([0], kinds={0: 'float'})
+        for value in (0.1, 0.2):
+            totals.add_row([value])
+        self.assertEquals(str(totals.get_totals()[0]), '0.30')
+        if numpy is not None:
+            totals = ReportTotals([0], kinds={0: 'float'})
+            ColumnarRows.from_rows([[0.1], [0.2]], 1).add_to_totals(totals)
+            self.assertEquals(str(totals.get_totals()[0]), '0.30')
+
+    def test_report_to_list_columnar(self):
+        if numpy is not None:
+            queryset, message = self.report.get_query()
+            mixin = DataExportMixin()
+            expected, message = mixin.report_to_list(
+                queryset, self.report.displayfield_set.all(), self.user)
+            rows, message = mixin.report_to_list(
+                queryset, self.report.displayfield_set.all(), self.user, columnar=True)
+            self.assertTrue(isinstance(rows, ColumnarRows))
+            self.assertEquals(list(rows), expected)
+
+    def test_report_progress(self):
+        published = []
+        mixin = DataExportMixin()
+        mixin.progress = ReportProgress(published.append, interval=3600)
+        queryset, message = self.report.get_query()
+        rows, message = mixin.report_to_list(queryset, self.report.displayfield_set.all(), self.user)
+        self.assertEquals(mixin.progress.rows_fetched, 3)
+        list(mixin.progress.count_rows(rows, 'rows_written', 'writing'))
+        mixin.progress.total_rows = 3
+        self.assertEquals(published[-1]['stage'], 'writing')
+        self.assertEquals(published[-1]['rows_written'], len(rows))
+        self.assertEquals(mixin.progress.get_eta(), 0)
+
+    def test_report_progress_nested(self):
+        progress = ReportProgress(lambda info: None, interval=3600)
+        rows = progress.count_rows(
+            progress.count_rows(iter(range(3)), 'rows_fetched', 'fetching'), 'rows_written', 'writing')
+        next(rows)
+        self.assertEquals(progress.current_stage, 'writing')
+        list(rows)
+        self.assertEquals((progress.current_stage, progress.rows_fetched, progress.rows_written),
+                          ('writing', 3, 3))
+
+    def test_timed_stops_on_error(self):
+        mixin = DataExportMixin()
+        with self.settings(REPORT_BUILDER_PROFILE_REPORTS=[self.report.pk]):
+            with self.assertRaises(ZeroDivisionError):
+                with mixin.timed(self.report.pk) as timer:
+                    self.report.get_query()[0].count() / 0
+        self.assertEquals(mixin.timer, None)
+        self.assertEquals(len(timer.queries), 1)
+        self.assertEquals((timer.queries.wrapper, timer.queries.debug_attribute), (None, None))
+
+    def test_get_report_rows_partitioned(self):
+        mixin = DataExportMixin()
+        mixin.partitions = 3
+        with self.settings(REPORT_BUILDER_PARTITION_BACKEND='serial',
+                           REPORT_BUILDER_PARTITION_MIN_ROWS=0):
+            queryset, message = self.report.get_query()
+            self.assertEquals(len(get_pk_ranges(queryset, 3)), 3)
+            for sort_reverse in (False, True):
+                self.report.displayfield_set.filter(sort__gt=0).update(sort_reverse=sort_reverse)
+                report = Report.objects.get(pk=self.report.pk)
+                rows, message = DataExportMixin().get_report_rows(report, self.user)
+                expected = list(rows)
+                self.assertEquals(expected[0][0], 'c' if sort_reverse else 'a')
+                rows, message = mixin.get_report_rows(report, self.user)
+                self.assertEquals(list(rows), expected)
+            # Unsorted rows follow Meta ordering by position, c, a, b, not pks
+            self.report.displayfield_set.update(sort=None)
+            FilterField.objects.filter(field='b').update(position=5)
+            report = Report.objects.get(pk=self.report.pk)
+            rows, message = mixin.get_report_rows(report, self.user)
+            self.assertEquals([row[0] for row in rows][:3], ['c', 'a', 'b'])
+
+    def test_get_incremental_report_rows(self):
+        # Well before the first run and its overlap
+        Report.objects.update(report_file_creation=timezone.now() - datetime.timedelta(days=1))
+        report = Report.objects.create(
+            name="incremental report",
+            root_model=ContentType.objects.get_for_model(Report),
+            change_tracking_field='report_file_creation',
+            tombstone_field='distinct')
+        DisplayField.objects.create(report=report, field='name', field_verbose='name [CharField]',
+                                    name='name', position=1, sort=1)
+        mixin = DataExportMixin()
+        with self.settings(REPORT_BUILDER_SNAPSHOT_DIR=tempfile.mkdtemp(),
+                           REPORT_BUILDER_INCREMENTAL_OVERLAP=60):
+            rows, message = mixin.get_incremental_report_rows(report, self.user)
+            self.assertEquals(list(rows), [['data report'], ['filter field report'], ['incremental report']])
+            taken = load_snapshot(report.pk).taken
+            # Changes that leave the change tracking field alone are not fetched
+            Report.objects.filter(pk=self.report.pk).update(name='changed unseen')
+            Report.objects.create(name="a new report", root_model=report.root_model)
+            Report.objects.filter(name="data report").update(distinct=True)
+            # Committed after the run read, by a transaction that began before it
+            Report.objects.filter(name__in=["a new report", "data report"]).update(
+                report_file_creation=taken - datetime.timedelta(seconds=1))
+            rows, message = mixin.get_incremental_report_rows(report, self.user)
+            self.assertEquals(list(rows), [['a new report'], ['filter field report'], ['incremental report']])
+            snapshot = load_snapshot(report.pk)
+            self.assertEquals(len(snapshot.rows), 3)
+            self.assertTrue(snapshot.taken >= taken)
+            # A new change tracking field rebuilds the snapshot
+            definition_key = report.get_definition_key()
+            report.change_tracking_field = 'modified'
+            report.save()
+            self.assertNotEqual(report.get_definition_key(), definition_key)
+            delete_snapshot(report.pk)
+            self.assertEquals(load_snapshot(report.pk), None)
+
+    def test_partition_files(self):
+        directory = tempfile.mkdtemp()
+        rows = [['row %s' % i, Decimal(i)] for i in range(2500)]
+        path = write_partition(iter(rows), directory)
+        self.assertEquals(list(read_partition(path)), rows)
+        merged = merge_partition_files(directory, [path, write_partition([['row 0', 0]], directory)], [(0, False)])
+        self.assertEquals(next(merged), ['row 0', 0])
+        merged.close()
+        self.assertFalse(os.path.exists(directory))
+
+    def test_report_clean(self):
+        report = Report(name="incremental report", root_model=ContentType.objects.get_for_model(Report),
+                        change_tracking_field='report_file_creation', tombstone_field='distinct')
+        report.clean()
+        report.change_tracking_field = 'name'
+        report.tombstone_field = 'tombstoned'
+        try:
+            report.clean()
+            self.fail('clean() accepted bad fields')
+        except ValidationError as e:
+            self.assertEquals(sorted(e.message_dict), ['change_tracking_field', 'tombstone_field'])
+
+    def test_merge_partition_rows(self):
+        partitions = [[['b', None], ['B', 2]], [['a', 1], ['c', None]]]
+        self.assertEquals(list(merge_partition_rows(partitions, [])),
+                          [['b', None], ['B', 2], ['a', 1], ['c', None]])
+        self.assertEquals(list(merge_partition_rows(partitions, [(0, False)])),
+                          [['a', 1], ['b', None], ['B', 2], ['c', None]])
+        self.assertEquals(list(merge_partition_rows([[['B', 2], ['b', None]], [['a', 1], ['c', None]]],
+                                                    [(1, True), (0, False)])),
+                          [['B', 2], ['a', 1], ['b', None], ['c', None]])
+
+    def test_columnar_rows_sort(self):
+        if numpy is not None:
+            import random
+            rows = [[random.randint(-3, 3), random.random() < 0.5, datetime.date(2014, 1, random.randint(1, 3)), i]
+                    for i in range(200)]
+            for sort_fields in [[(1, False), (2, True)], [(3, True), (1, False), (2, False)]]:
+                expected = list(DataExportMixin().sort_report_rows([list(row) for row in rows], sort_fields))
+                columnar = ColumnarRows.from_rows(rows, 4)
+                sort_columns = [(position - 1, reverse) for position, reverse in sort_fields]
+                self.assertTrue(columnar.can_sort(sort_columns))
+                columnar.sort(sort_columns)
+                self.assertEquals(list(columnar), expected)
+
+    def test_get_report_page(self):
+        mixin = DataExportMixin()
+        # Sorted on a text field, so pages are sliced from the full run
+        rows, cursor, message = mixin.get_report_page(self.report, self.user, 2)
+        self.assertEquals([row[0] for row in rows], ['a', 'b'])
+        rows, cursor, message = mixin.get_report_page(self.report, self.user, 2, cursor)
+        self.assertEquals(rows, [['c', 'Greater Than', '2.00', None]])
+        self.assertEquals(cursor, None)
+
+    def test_get_report_page_keyset(self):
+        self.report.displayfield_set.update(sort=None)
+        DisplayField.objects.create(
+            report=self.report, field='id', field_verbose='id [AutoField]', name='id',
+            position=5, sort=1, sort_reverse=True)
+        mixin = DataExportMixin()
+        with CaptureQueriesContext(connection) as queries:
+            rows, cursor, message = mixin.get_report_page(self.report, self.user, 2)
+        self.assertEquals([row[0] for row in rows], ['a', 'c'])
+        self.assertTrue(any('LIMIT 3' in query['sql'] for query in queries.captured_queries))
+        rows, cursor, message = mixin.get_report_page(self.report, self.user, 2, cursor)
+        self.assertEquals([row[0] for row in rows], ['b'])
+        self.assertEquals(cursor, None)
+
+    def test_get_report_page_unsorted(self):
+        self.report.displayfield_set.update(sort=None)
+        # Meta ordering by position is c, a, b
+        FilterField.objects.filter(field='b').update(position=5)
+        mixin = DataExportMixin()
+        rows, cursor, message = mixin.get_report_page(self.report, self.user, 2)
+        self.assertEquals([row[0] for row in rows], ['b', 'c'])
+        rows, cursor, message = mixin.get_report_page(self.report, self.user, 2, cursor)
+        self.assertEquals([row[0] for row in rows], ['a'])
+
+    def test_encode_page_cursor(self):
+        position = [datetime.datetime(2014, 1, 2, 3, 4, 5, 123456), datetime.time(1, 2, 3, 456789), 7]
+        self.assertEquals(decode_page_cursor(encode_page_cursor(position)),
+                          ['2014-01-02T03:04:05.123456', '01:02:03.456789', 7])
+
+
+class PartitionTests(TransactionTestCase):
+    """ Partitions fetch on connections of their own, which only see committed rows """
+    def test_get_report_rows_thread_backend(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        data_report = Report.objects.create(
+            name="data report", root_model=ContentType.objects.get_for_model(Report))
+        for position, field in enumerate(['b', 'C', 'a', 'B', 'c']):
+            FilterField.objects.create(
+                report=data_report,
+                field=field,
+                field_verbose=field,
+                filter_type='exact',
+                filter_value='x',
+                position=position+1)
+        report = Report.objects.create(
+            name="filter field report",
+            root_model=ContentType.objects.get_for_model(FilterField))
+        DisplayField.objects.create(
+            report=report, field='field', field_verbose='field [CharField]',
+            name='field', position=1, sort=1)
+        DisplayField.objects.create(
+            report=report, field='position', field_verbose='position [PositiveSmallIntegerField]',
+            name='position', position=2)
+        mixin = DataExportMixin()
+        mixin.partitions = 3
+        with self.settings(REPORT_BUILDER_PARTITION_BACKEND='thread',
+                           REPORT_BUILDER_PARTITION_MIN_ROWS=0):
+            rows, message = mixin.get_report_rows(report, user)
+            # Case insensitive, ties in pk order
+            self.assertEquals([row[1] for row in rows], [3, 1, 4, 2, 5])
+
+
+@skipUnless('report_builder.benchmarks' in settings.INSTALLED_APPS,
+            'report_builder.benchmarks is not in INSTALLED_APPS')
+class BenchmarkTests(TestCase):
+    """ Smoke tests of the benchmark harness on a few seeded items """
+    def test_run_benchmarks(self):
+        from .benchmarks.models import BenchmarkItem
+        from .benchmarks.runner import run_benchmarks
+        from .benchmarks.seed import seed, create_reports
+        seed(10, batch_size=4)
+        self.assertEquals(BenchmarkItem.objects.count(), 10)
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        benchmarks = run_benchmarks(create_reports(), user, repeat=1)
+        self.assertEquals(benchmarks['report_to_list.wide']['rows'], 10)
+        self.assertTrue('ajax_preview.m2m' in benchmarks)
+        for name, timing in benchmarks.items():
+            self.assertTrue(timing['min'] <= timing['median'], name)
+
+    def test_benchmark_command(self):
+        path = os.path.join(tempfile.mkdtemp(), 'results.json')
+        call_command('report_builder_benchmark', scale=10, repeat=1, only='report_to_list,build_sheet',
+                     output=path, stdout=StringIO())
+        results = load_results(path)
+        self.assertEquals(results['scale'], 10)
+        self.assertEquals(sorted(results['benchmarks'])[0], 'build_sheet')
+        call_command('report_builder_benchmark', scale=10, repeat=1, only='report_to_list',
+                     baseline=path, tolerance=1000, seed=False, stdout=StringIO())
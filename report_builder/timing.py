@@ -0,0 +1,273 @@
+"""
+Per-stage timing and profiling of report runs
+
+Settings:
+REPORT_BUILDER_TIMING: time every report run and send the report_timed signal
+REPORT_BUILDER_SERVER_TIMING: also add a Server-Timing header to responses
+REPORT_BUILDER_PROFILE_REPORTS: ids of reports whose runs are profiled with cProfile
+REPORT_BUILDER_PROFILE_DIR: where profiles are saved, a temporary directory by default
+"""
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+import cProfile
+import os
+import tempfile
+import time
+
+from .signals import report_timed
+
+# Stage name of the lines writers produce, which aren't report rows
+WRITE_STAGE = 'write'
+
+
+def profiling_enabled(report_id):
+    if report_id is None:
+        return False
+    profile_reports = getattr(settings, 'REPORT_BUILDER_PROFILE_REPORTS', ())
+    return str(report_id) in [str(pk) for pk in profile_reports]
+
+
+def server_timing_enabled():
+    return getattr(settings, 'REPORT_BUILDER_SERVER_TIMING', False)
+
+
+def timing_enabled(report_id=None):
+    return getattr(settings, 'REPORT_BUILDER_TIMING', False) or server_timing_enabled() \
+        or profiling_enabled(report_id)
+
+
+def get_profile_dir():
+    profile_dir = getattr(settings, 'REPORT_BUILDER_PROFILE_DIR', None) or \
+        os.path.join(tempfile.gettempdir(), 'report_builder_profiles')
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    return profile_dir
+
+
+@contextmanager
+def untimed():
+    yield
+
+
+class QueryCounter(object):
+    """
+    Counts the queries run on a connection between start() and stop()
+    By an execute wrapper where Django has them (2.0 and later), else from
+    the debug cursor's query log, which is only kept while counting.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.wrapper = None
+        self.debug_attribute = None
+        self.debug_cursor = None
+        self.initial = 0
+        self.executed = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.executed += 1
+        return execute(sql, params, many, context)
+
+    def start(self):
+        connection = self.connection
+        if hasattr(connection, 'execute_wrapper'):
+            self.wrapper = connection.execute_wrapper(self)
+            self.wrapper.__enter__()
+            return
+        # Django < 1.8 calls it use_debug_cursor
+        self.debug_attribute = 'force_debug_cursor' if hasattr(connection, 'force_debug_cursor') \
+            else 'use_debug_cursor'
+        self.debug_cursor = getattr(connection, self.debug_attribute)
+        setattr(connection, self.debug_attribute, True)
+        self.initial = len(connection.queries)
+
+    def stop(self):
+        if self.wrapper is not None:
+            self.wrapper.__exit__(None, None, None)
+            self.wrapper = None
+        elif self.debug_attribute is not None:
+            self.executed = len(self.connection.queries) - self.initial
+            setattr(self.connection, self.debug_attribute, self.debug_cursor)
+            self.debug_attribute = None
+
+    def __len__(self):
+        if self.debug_attribute is not None:
+            return len(self.connection.queries) - self.initial
+        return self.executed
+
+
+class ReportTimer(object):
+    """
+    Times the stages of one report run
+    Row stages are timed as rows are pulled through them, other work in
+    blocks. Each stage is timed on its own: the time a stage waits on the
+    stages before it counts for those.
+    Queries are counted on the default database while the timer runs.
+    """
+    def __init__(self, report_id=None):
+        self.report_id = report_id
+        # Stage name to [seconds, rows], in the order stages were added
+        self.stages = OrderedDict()
+        self.row_stages = []
+        self.bytes_written = 0
+        # Seconds spent in timed stages within the one being timed
+        self.nested = 0.0
+        self.started = None
+        self.total_seconds = None
+        self.queries = None
+        self.profile = None
+        self.profile_path = None
+
+    def start(self):
+        self.started = default_timer()
+        self.queries = QueryCounter(connections[DEFAULT_DB_ALIAS])
+        self.queries.start()
+        if profiling_enabled(self.report_id):
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def stop(self):
+        """ Stop counting queries and profiling, without saving or sending anything
+        For runs that failed. Safe to call more than once.
+        """
+        if self.queries is not None:
+            self.queries.stop()
+        if self.profile is not None:
+            self.profile.disable()
+
+    def add_stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = [0.0, 0]
+        return self.stages[stage]
+
+    def time_rows(self, rows, stage):
+        """ Pass rows through, timing how long the stage takes to give each """
+        if stage not in self.row_stages:
+            self.row_stages.append(stage)
+        return self._time_rows(iter(rows), self.add_stage(stage))
+
+    def _time_rows(self, rows, totals):
+        while True:
+            outer = self.nested
+            self.nested = 0.0
+            start = default_timer()
+            try:
+                row = next(rows)
+            except StopIteration:
+                self.end_section(totals, start, outer)
+                return
+            except:
+                self.end_section(totals, start, outer)
+                raise
+            self.end_section(totals, start, outer)
+            totals[1] += 1
+            yield row
+
+    @contextmanager
+    def block(self, stage):
+        """ Time the work done within the with statement as stage """
+        totals = self.add_stage(stage)
+        outer = self.nested
+        self.nested = 0.0
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.end_section(totals, start, outer)
+
+    def end_section(self, totals, start, outer):
+        elapsed = default_timer() - start
+        totals[0] += elapsed - self.nested
+        self.nested = outer + elapsed
+
+    def time_lines(self, lines):
+        """ Time lines of a file as the write stage, counting their bytes """
+        for line in self.time_rows(lines, WRITE_STAGE):
+            self.bytes_written += len(line)
+            yield line
+
+    def count_bytes(self, count):
+        self.bytes_written += count
+
+    def get_timings(self):
+        """ Dict of stage name to seconds, in pipeline order """
+        return OrderedDict((stage, totals[0]) for stage, totals in self.stages.items())
+
+    def get_counters(self):
+        row_stages = [stage for stage in self.row_stages if stage != WRITE_STAGE]
+        return {
+            'rows_in': self.stages[row_stages[0]][1] if row_stages else 0,
+            'rows_out': self.stages[row_stages[-1]][1] if row_stages else 0,
+            'queries': len(self.queries) if self.queries is not None else 0,
+            'bytes_written': self.bytes_written,
+            'total_seconds': self.total_seconds,
+        }
+
+    def finish(self, sender=None):
+        """ Stop timing, save the profile if any and send report_timed
+        Returns the timings
+        """
+        if self.total_seconds is not None:
+            return self.get_timings()
+        self.total_seconds = default_timer() - self.started
+        self.stop()
+        if self.profile is not None:
+            self.profile_path = os.path.join(
+                get_profile_dir(),
+                'report_%s_%s.prof' % (self.report_id, time.strftime('%Y%m%d%H%M%S')))
+            self.profile.dump_stats(self.profile_path)
+        timings = self.get_timings()
+        report_timed.send(
+            sender=sender or self.__class__,
+            report_id=self.report_id,
+            timings=timings,
+            counters=self.get_counters(),
+            profile_path=self.profile_path)
+        return timings
+
+    def finish_after(self, items, sender=None):
+        """ Pass items through, finishing once the last has gone
+        or when closed early, like a response the client dropped
+        """
+        return FinishAfter(self, items, sender)
+
+    def get_server_timing(self):
+        """ Value of a Server-Timing header, durations in milliseconds """
+        metrics = ['%s;dur=%.1f' % (stage, seconds * 1000)
+                   for stage, seconds in self.get_timings().items()]
+        if self.total_seconds is not None:
+            metrics.append('total;dur=%.1f' % (self.total_seconds * 1000))
+        counters = self.get_counters()
+        for counter in ('rows_in', 'rows_out', 'queries'):
+            metrics.append('%s;desc="%s"' % (counter, counters[counter]))
+        return ', '.join(metrics)
+
+
+class FinishAfter(object):
+    """
+    Iterator of ReportTimer.finish_after. Unlike a generator it also
+    finishes when closed before the first item was taken.
+    """
+    def __init__(self, timer, items, sender=None):
+        self.timer = timer
+        self.items = iter(items)
+        self.sender = sender
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.items)
+        except BaseException:
+            self.close()
+            raise
+    next = __next__
+
+    def close(self):
+        if hasattr(self.items, 'close'):
+            self.items.close()
+        self.timer.finish(self.sender)
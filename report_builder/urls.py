@@ -7,6 +7,9 @@ urlpatterns = patterns('',
     url('^report/(?P<pk>\d+)/$', views.ReportUpdateView.as_view(), name="report_update_view"),
     url('^report/(?P<pk>\d+)/check_status/(?P<task_id>.+)/$', views.check_status, name="report_check_status"),
     url('^report/(?P<pk>\d+)/download_xlsx/$',  views.DownloadXlsxView.as_view(), name="report_download_xlsx"),
+    url('^report/(?P<pk>\d+)/download_csv/$',  views.DownloadCsvView.as_view(), name="report_download_csv"),
+    url('^report/(?P<pk>\d+)/download_jsonl/$',  views.DownloadJsonlView.as_view(), name="report_download_jsonl"),
+    url('^report/(?P<pk>\d+)/rows/$',  views.ReportRowsView.as_view(), name="report_rows"),
     url('^ajax_get_related/$', staff_member_required(views.AjaxGetRelated.as_view())),
     url('^ajax_get_fields/$', staff_member_required(views.AjaxGetFields.as_view())),
     url('^ajax_get_choices/$', views.ajax_get_choices, name="ajax_get_choices"),
@@ -15,4 +18,5 @@ urlpatterns = patterns('',
     url('^report/(?P<pk>\d+)/add_star/$', views.ajax_add_star),
     url('^report/(?P<pk>\d+)/create_copy/$', views.create_copy),
     url('^export_to_report/$', views.ExportToReport.as_view(), name="export_to_report"),
+    url('^result_cache_stats/$', views.result_cache_stats, name="report_result_cache_stats"),
 )
@@ -1,7 +1,22 @@
 import copy
+import threading
+from collections import namedtuple
+from functools import wraps
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.dateparse import parse_date, parse_datetime, parse_time
+from six import text_type
+import datetime
 import inspect
+import json
+import os
+import re
+import time
+import uuid
+from decimal import Decimal
+from dateutil import parser
 from django.utils import timezone
 
 def javascript_date_format(python_date_format):
@@ -65,6 +80,128 @@ def get_allowed_models():
 
         return models
 
+# ======================================================================================================================
+# FILES OF REPORT DATA
+# ======================================================================================================================
+
+# Tag of values JSON has no type for, see TypedJSONEncoder
+TYPE_KEY = '__report_builder_type__'
+
+
+class TypedJSONEncoder(json.JSONEncoder):
+    """ Writes the row values JSON has no type for as tagged objects """
+    def default(self, o):
+        if isinstance(o, Decimal):
+            return {TYPE_KEY: 'decimal', 'value': text_type(o)}
+        if isinstance(o, datetime.datetime):
+            return {TYPE_KEY: 'datetime', 'value': o.isoformat()}
+        if isinstance(o, datetime.date):
+            return {TYPE_KEY: 'date', 'value': o.isoformat()}
+        if isinstance(o, datetime.time):
+            return {TYPE_KEY: 'time', 'value': o.isoformat()}
+        if isinstance(o, datetime.timedelta):
+            return {TYPE_KEY: 'timedelta', 'value': [o.days, o.seconds, o.microseconds]}
+        if isinstance(o, uuid.UUID):
+            return {TYPE_KEY: 'uuid', 'value': o.hex}
+        # Anything else as the text it is shown as
+        return text_type(o)
+
+
+def decode_typed_value(value):
+    """ object_hook reading back the tagged objects of TypedJSONEncoder """
+    kind = value.get(TYPE_KEY)
+    if kind == 'decimal':
+        return Decimal(value['value'])
+    if kind == 'datetime':
+        return parse_datetime(value['value'])
+    if kind == 'date':
+        return parse_date(value['value'])
+    if kind == 'time':
+        return parse_time(value['value'])
+    if kind == 'timedelta':
+        return datetime.timedelta(*value['value'])
+    if kind == 'uuid':
+        return uuid.UUID(value['value'])
+    return value
+
+
+def make_private_dir(directory):
+    """
+    Create directory for report data only this user can open, or check an
+    existing one belongs to this user. Others could read the data in a shared
+    directory, or plant files for the web process to read back.
+    """
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    if hasattr(os, 'getuid'):
+        # lstat as well, so a link someone else planted is refused too
+        if os.getuid() != os.lstat(directory).st_uid or os.getuid() != os.stat(directory).st_uid:
+            raise ImproperlyConfigured(
+                '%s belongs to another user, give the report builder a directory of its own' % directory)
+    if os.stat(directory).st_mode & 0o077:
+        os.chmod(directory, 0o700)
+
+
+# ======================================================================================================================
+# MODEL INTROSPECTION CACHE
+# ======================================================================================================================
+
+_introspection_cache = {}
+_introspection_cache_lock = threading.Lock()
+
+
+def cache_introspection(func):
+    """
+    Remember what func(model_class, *args) returns for the life of the process.
+    Model metadata only changes on deploy, so only cache what is read from it;
+    args must come from a small fixed set. Callers get a copy of the cached list.
+    """
+    @wraps(func)
+    def cached_func(model_class, *args):
+        model_class = model_class._meta.model  # Model instances are passed in too
+        key = (func.__name__, model_class) + tuple(
+            tuple(arg) if isinstance(arg, list) else arg for arg in args)
+        try:
+            result = _introspection_cache[key]
+        except KeyError:
+            result = func(model_class, *args)
+            if result is not None:
+                result = list(result)
+            with _introspection_cache_lock:
+                _introspection_cache[key] = result
+        if result is None:
+            return None
+        return list(result)
+    return cached_func
+
+
+def clear_introspection_cache(model_class=None):
+    """ Forget cached introspection for one model, or for all of them """
+    with _introspection_cache_lock:
+        if model_class is None:
+            _introspection_cache.clear()
+            return
+        model_class = model_class._meta.model
+        for key in list(_introspection_cache):
+            if key[1] is model_class:
+                del _introspection_cache[key]
+
+
+def warm_introspection_cache(models=None):
+    """ Fill the cache for models (default all installed models)
+    Only introspection that needs no database queries is done here, so it is
+    safe to call while the app registry is loading. """
+    if models is None:
+        from django.apps import apps
+        models = apps.get_models()
+    for model_class in models:
+        get_direct_fields_from_model(model_class)
+        get_properties_from_model(model_class)
+
+
 # ======================================================================================================================
 # MODEL INTROSPECTION TYPE FUNCTIONS
 # ======================================================================================================================
@@ -73,6 +210,7 @@ def isprop(v):
     return isinstance(v, property)
 
 
+@cache_introspection
 def get_properties_from_model(model_class):
     """ Show properties from a model """
     properties = []
@@ -86,8 +224,27 @@ def get_properties_from_model(model_class):
 
 
 def get_relation_fields_from_model(model_class, exclude = []):
-    """ Get related fields (m2m, FK, and reverse FK) """
+    """ Get related fields (m2m, FK, and reverse FK)
+    exclude: ids of content types whose models' relations are left out """
+    relation_fields = get_all_relation_fields_from_model(model_class)
+    if not exclude:
+        return relation_fields
+
+    exclude_class_names = []
+
+    for excl in exclude:
+        model_name = ContentType.objects.get_for_id(excl).model_class()._meta.model_name
+        exclude_class_names.append(model_name)
+
+    return [field_object for field_object in relation_fields
+            if field_object.field_name not in exclude_class_names]
+
+
+@cache_introspection
+def get_all_relation_fields_from_model(model_class):
+    """ Every related field of model_class, see get_relation_fields_from_model """
     relation_fields = []
+    related_models = []
 
     all_fields_names = model_class._meta.get_all_field_names()
 
@@ -95,15 +252,6 @@ def get_relation_fields_from_model(model_class, exclude = []):
 
         field = model_class._meta.get_field_by_name(field_name)
 
-        exclude_class_names = []
-
-        for excl in exclude:
-            model_name = ContentType.objects.get_for_id(excl).model_class()._meta.model_name
-            exclude_class_names.append(model_name)
-
-        if field_name in exclude_class_names:
-            continue
-
         field_object = field[0]
         is_direct = field[2]
         is_m2m = field[3]
@@ -111,21 +259,26 @@ def get_relation_fields_from_model(model_class, exclude = []):
         if is_m2m or not is_direct or hasattr(field_object, 'related'):
             # a related field
             if(hasattr(field_object, 'rel')):
-                field_model_name = field_object.rel.to._meta.model_name
-                field_object.field_ct = ContentType.objects.get(model=field_model_name)
+                related_models.append((field_object, field_object.rel.to))
             # If the field is actually a child class that's inherited from our current model
             elif type(field_object).__name__ is 'RelatedObject':
-                field_model_name = field_object.model()._meta.model_name
-                field_object.field_ct = ContentType.objects.get(model=field_model_name)
+                related_models.append((field_object, field_object.model))
             else:
                 field_object.field_ct = None
 
             field_object.field_name = field_name
             relation_fields += [field_object]
 
+    # One lookup for all related models, later calls are served by the ContentType cache
+    content_types = ContentType.objects.get_for_models(
+        *set(model for field_object, model in related_models), for_concrete_models=False)
+    for field_object, model in related_models:
+        field_object.field_ct = content_types[model]
+
     return relation_fields
 
 
+@cache_introspection
 def get_direct_fields_from_model(model_class):
     """
     Direct, not m2m, not FK
@@ -160,7 +313,8 @@ def get_direct_fields_from_model(model_class):
 
 
 def get_custom_fields_from_model(model_class):
-    """ django-custom-fields support """
+    """ django-custom-fields support
+    Not cached, custom fields are rows any process can change """
     if 'custom_field' in settings.INSTALLED_APPS:
         from custom_field.models import CustomField
         try:
@@ -171,25 +325,322 @@ def get_custom_fields_from_model(model_class):
         return custom_fields
 
 
-def get_model_from_path_string(root_model, path):
+PathHop = namedtuple("PathHop", "name model is_m2m is_reverse")
+
+
+class ResolvedPath(namedtuple("ResolvedPath", "model field choices hops")):
     """
-    Return a model class for a related model
-    root_model is the class of the initial model
-    path is like foo__bar where bar is related to foo
+    A field path walked from a root model
+    model is the model the path ends on, field the model field named at the
+    end (None for properties and custom fields) with its choices, and hops
+    one PathHop per relation followed
+    """
+    __slots__ = ()
+
+    @property
+    def multi_valued(self):
+        """ True when any hop can give many values for each root object """
+        return any(hop.is_m2m or hop.is_reverse for hop in self.hops)
+
+
+def resolve_path(root_model, path, field_name=None):
     """
+    Walk path (like foo__bar__) from root_model, then look up field_name
+    Results are shared by every caller and live in the introspection cache
+    """
+    root_model = root_model._meta.model
+    key = ('resolve_path', root_model, path, field_name)
+    try:
+        return _introspection_cache[key]
+    except KeyError:
+        pass
+
+    model = root_model
+    hops = []
     for path_section in path.split('__'):
         if path_section:
-            field = root_model._meta.get_field_by_name(path_section)
+            field = model._meta.get_field_by_name(path_section)
 
             field_object = field[0]
             is_direct = field[2]
+            is_m2m = field[3]
 
             if is_direct:
-                root_model = field_object.related.parent_model()
+                model = field_object.related.parent_model
             else:
-                root_model = field_object.model
+                model = field_object.model
+            hops.append(PathHop(path_section, model, is_m2m, not is_direct))
+
+    model_field = None
+    if field_name:
+        try:
+            model_field = model._meta.get_field_by_name(field_name)[0]
+        except FieldDoesNotExist:
+            pass
+    choices = tuple(model_field.choices) if model_field is not None and model_field.choices else None
+
+    resolved = ResolvedPath(model, model_field, choices, tuple(hops))
+    with _introspection_cache_lock:
+        _introspection_cache[key] = resolved
+    return resolved
+
+
+def get_model_from_path_string(root_model, path):
+    """
+    Return a model class for a related model
+    root_model is the class of the initial model
+    path is like foo__bar where bar is related to foo
+    """
+    return resolve_path(root_model, path).model
 
-    return root_model
+def is_multi_valued_path(root_model, path):
+    """
+    True when path (like foo__bar__) goes through a m2m or reverse relation,
+    so there can be many values for each root_model object
+    """
+    return resolve_path(root_model, path).multi_valued
 
 def get_aware_time(value):
-    return timezone.make_aware(value, timezone.get_current_timezone())
\ No newline at end of file
+    return timezone.make_aware(value, timezone.get_current_timezone())
+
+#TODO: i10n
+WEEKDAY_INTS = {
+    'monday': 0,
+    'tuesday': 1,
+    'wednesday': 2,
+    'thursday': 3,
+    'friday': 4,
+    'saturday': 5,
+    'sunday': 6,
+}
+
+def filter_property(filter_field, value):
+    filter_type = filter_field.filter_type
+    filter_value = filter_field.filter_value
+    filtered = True 
+    #TODO instead of catch all, deal with all cases
+    # Example is 'a' < 2 is a valid python comparison
+    # But what about 2 < '1' which yeilds true! Not intuitive for humans.
+    try:
+        if filter_type == 'exact' and str(value) == filter_value:
+            filtered = False
+        if filter_type == 'iexact' and str(value).lower() == str(filter_value).lower():
+            filtered = False
+        if filter_type == 'contains' and filter_value in value:
+            filtered = False
+        if filter_type == 'icontains' and str(filter_value).lower() in str(value).lower():
+            filtered = False
+        if filter_type == 'in' and value in filter_value:
+            filtered = False
+        # convert dates and datetimes to timestamps in order to compare digits and date/times the same
+        if isinstance(value, datetime.datetime) or isinstance(value, datetime.date): 
+            value = str(time.mktime(value.timetuple())) 
+            try:
+                filter_value_dt = parser.parse(filter_value)
+                filter_value = str(time.mktime(filter_value_dt.timetuple()))
+            except ValueError:
+                pass
+        if filter_type == 'gt' and Decimal(value) > Decimal(filter_value):
+            filtered = False
+        if filter_type == 'gte' and Decimal(value) >= Decimal(filter_value):
+            filtered = False
+        if filter_type == 'lt' and Decimal(value) < Decimal(filter_value):
+            filtered = False
+        if filter_type == 'lte' and Decimal(value) <= Decimal(filter_value):
+            filtered = False
+        if filter_type == 'startswith' and str(value).startswith(str(filter_value)):
+            filtered = False
+        if filter_type == 'istartswith' and str(value).lower().startswith(str(filter_value)):
+            filtered = False
+        if filter_type == 'endswith' and str(value).endswith(str(filter_value)):
+            filtered = False
+        if filter_type == 'iendswith' and str(value).lower().endswith(str(filter_value)):
+            filtered = False
+        if filter_type == 'range' and value in [int(x) for x in filter_value]:
+            filtered = False
+        if filter_type == 'week_day' and WEEKDAY_INTS.get(str(filter_value).lower()) == value.weekday:
+            filtered = False
+        if filter_type == 'isnull' and value == None:
+            filtered = False
+        if filter_type == 'regex' and re.search(filter_value, value):
+            filtered = False
+        if filter_type == 'iregex' and re.search(filter_value, value, re.I):
+            filtered = False
+    except:
+        pass
+
+    if filter_field.exclude:
+        return not filtered
+    return filtered 
+
+
+# ======================================================================================================================
+# COMPILED PROPERTY FILTERS
+# ======================================================================================================================
+
+def date_to_timestamp(value):
+    """ The timestamp string filter_property compares dates and datetimes as """
+    return str(time.mktime(value.timetuple()))
+
+
+def date_filter_value(filter_value):
+    """ filter_value as filter_property compares it with a date value """
+    try:
+        return date_to_timestamp(parser.parse(filter_value))
+    except ValueError:
+        return filter_value
+
+
+def _decimal_test(compare):
+    def build(filter_value):
+        filter_value = Decimal(filter_value)
+        return lambda value: compare(Decimal(value), filter_value)
+    return build
+
+
+def _build_exact(filter_value):
+    return lambda value: str(value) == filter_value
+
+def _build_iexact(filter_value):
+    filter_value = str(filter_value).lower()
+    return lambda value: str(value).lower() == filter_value
+
+def _build_contains(filter_value):
+    return lambda value: filter_value in value
+
+def _build_icontains(filter_value):
+    filter_value = str(filter_value).lower()
+    return lambda value: filter_value in str(value).lower()
+
+def _build_in(filter_value):
+    return lambda value: value in filter_value
+
+def _build_startswith(filter_value):
+    filter_value = str(filter_value)
+    return lambda value: str(value).startswith(filter_value)
+
+def _build_istartswith(filter_value):
+    filter_value = str(filter_value)
+    return lambda value: str(value).lower().startswith(filter_value)
+
+def _build_endswith(filter_value):
+    filter_value = str(filter_value)
+    return lambda value: str(value).endswith(filter_value)
+
+def _build_iendswith(filter_value):
+    filter_value = str(filter_value)
+    return lambda value: str(value).lower().endswith(filter_value)
+
+def _build_range(filter_value):
+    filter_value = [int(x) for x in filter_value]
+    return lambda value: value in filter_value
+
+def _build_isnull(filter_value):
+    return lambda value: value == None
+
+def _build_regex(filter_value):
+    return re.compile(filter_value).search
+
+def _build_iregex(filter_value):
+    return re.compile(filter_value, re.I).search
+
+
+# Tests done on the value as it is
+PROPERTY_FILTER_TESTS = {
+    'exact': _build_exact,
+    'iexact': _build_iexact,
+    'contains': _build_contains,
+    'icontains': _build_icontains,
+    'in': _build_in,
+}
+
+# Tests done after dates and datetimes are converted to timestamps
+DATE_CONVERTED_PROPERTY_FILTER_TESTS = {
+    'gt': _decimal_test(lambda value, filter_value: value > filter_value),
+    'gte': _decimal_test(lambda value, filter_value: value >= filter_value),
+    'lt': _decimal_test(lambda value, filter_value: value < filter_value),
+    'lte': _decimal_test(lambda value, filter_value: value <= filter_value),
+    'startswith': _build_startswith,
+    'istartswith': _build_istartswith,
+    'endswith': _build_endswith,
+    'iendswith': _build_iendswith,
+    'range': _build_range,
+    'isnull': _build_isnull,
+    'regex': _build_regex,
+    'iregex': _build_iregex,
+}
+
+
+class CompiledPropertyFilter(object):
+    """
+    A property filter prepared once per report run, see compile_property_filter
+    Calling it with a value gives the same result as filter_property.
+    """
+    def __init__(self, filter_field):
+        self.filter_field = filter_field
+        self.exclude = filter_field.exclude
+        filter_type = filter_field.filter_type
+        filter_value = filter_field.filter_value
+        self.convert_dates = filter_type in DATE_CONVERTED_PROPERTY_FILTER_TESTS
+        if self.convert_dates:
+            build = DATE_CONVERTED_PROPERTY_FILTER_TESTS[filter_type]
+        else:
+            build = PROPERTY_FILTER_TESTS.get(filter_type)
+        self.generic = build is None
+        # A filter value the test can't be built from never matches, just
+        # like filter_property failing on it for every row
+        self.test = self.date_test = None
+        if build is not None:
+            try:
+                self.test = build(filter_value)
+            except Exception:
+                pass
+            if self.convert_dates:
+                try:
+                    self.date_test = build(date_filter_value(filter_value))
+                except Exception:
+                    pass
+
+    def matches(self, value):
+        if self.convert_dates and isinstance(value, datetime.date):
+            test = self.date_test
+            value = date_to_timestamp(value)
+        else:
+            test = self.test
+        return test is not None and bool(test(value))
+
+    def __call__(self, value):
+        """ True if a row with this value is filtered out """
+        if self.generic:
+            return filter_property(self.filter_field, value)
+        try:
+            matched = self.matches(value)
+        except Exception:
+            matched = False
+        return matched == self.exclude
+
+    def batch(self, values):
+        """ Filter a chunk of values in one call, returns a list of results """
+        if self.generic:
+            return [filter_property(self.filter_field, value) for value in values]
+        matches = self.matches
+        exclude = self.exclude
+        results = []
+        for value in values:
+            try:
+                matched = matches(value)
+            except Exception:
+                matched = False
+            results.append(matched == exclude)
+        return results
+
+
+def compile_property_filter(filter_field):
+    """
+    Prepare a property filter once per report run instead of for every row.
+    The filter value is parsed up front (dates, decimals and regular
+    expressions), and the test is picked from a dispatch table.
+    Types without a specialized test (week_day) go through filter_property.
+    Returns a CompiledPropertyFilter
+    """
+    return CompiledPropertyFilter(filter_field)
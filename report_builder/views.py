@@ -1,6 +1,6 @@
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.base import File
 from django.contrib.admin.views.decorators import staff_member_required
 
 try:
@@ -10,29 +10,29 @@ except ImportError:
     from django.contrib.auth.models import User
 
 from django.contrib.auth.decorators import permission_required
-from django.db.models import Q
 from django.db.models.fields.related import ReverseManyRelatedObjectsDescriptor
 from django.forms.models import inlineformset_factory
-from django.http import HttpResponse, HttpResponseRedirect
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
 from django.shortcuts import (
     redirect,
     get_object_or_404,
     )
 from .models import Report, DisplayField, FilterField, Format
 from .utils import *
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.generic.edit import CreateView, UpdateView
 from django.views.generic import TemplateView, View
 from django import forms
 
 from .mixins import GetFieldsMixin, DataExportMixin
+from .result_cache import get_result_cache
+from . import data_versions
 
 import datetime
-import time
 import re
-from decimal import Decimal
 import copy
-from dateutil import parser
 import json
 
 
@@ -96,76 +96,6 @@ class ReportCreateView(CreateView):
     template_name = 'report_new.html'
     
 
-def filter_property(filter_field, value):
-    filter_type = filter_field.filter_type
-    filter_value = filter_field.filter_value
-    filtered = True 
-    #TODO: i10n
-    WEEKDAY_INTS = {
-        'monday': 0,
-        'tuesday': 1,
-        'wednesday': 2,
-        'thursday': 3,
-        'friday': 4,
-        'saturday': 5,
-        'sunday': 6,
-    }
-    #TODO instead of catch all, deal with all cases
-    # Example is 'a' < 2 is a valid python comparison
-    # But what about 2 < '1' which yeilds true! Not intuitive for humans.
-    try:
-        if filter_type == 'exact' and str(value) == filter_value:
-            filtered = False
-        if filter_type == 'iexact' and str(value).lower() == str(filter_value).lower():
-            filtered = False
-        if filter_type == 'contains' and filter_value in value:
-            filtered = False
-        if filter_type == 'icontains' and str(filter_value).lower() in str(value).lower():
-            filtered = False
-        if filter_type == 'in' and value in filter_value:
-            filtered = False
-        # convert dates and datetimes to timestamps in order to compare digits and date/times the same
-        if isinstance(value, datetime.datetime) or isinstance(value, datetime.date): 
-            value = str(time.mktime(value.timetuple())) 
-            try:
-                filter_value_dt = parser.parse(filter_value)
-                filter_value = str(time.mktime(filter_value_dt.timetuple()))
-            except ValueError:
-                pass
-        if filter_type == 'gt' and Decimal(value) > Decimal(filter_value):
-            filtered = False
-        if filter_type == 'gte' and Decimal(value) >= Decimal(filter_value):
-            filtered = False
-        if filter_type == 'lt' and Decimal(value) < Decimal(filter_value):
-            filtered = False
-        if filter_type == 'lte' and Decimal(value) <= Decimal(filter_value):
-            filtered = False
-        if filter_type == 'startswith' and str(value).startswith(str(filter_value)):
-            filtered = False
-        if filter_type == 'istartswith' and str(value).lower().startswith(str(filter_value)):
-            filtered = False
-        if filter_type == 'endswith' and str(value).endswith(str(filter_value)):
-            filtered = False
-        if filter_type == 'iendswith' and str(value).lower().endswith(str(filter_value)):
-            filtered = False
-        if filter_type == 'range' and value in [int(x) for x in filter_value]:
-            filtered = False
-        if filter_type == 'week_day' and WEEKDAY_INTS.get(str(filter_value).lower()) == value.weekday:
-            filtered = False
-        if filter_type == 'isnull' and value == None:
-            filtered = False
-        if filter_type == 'regex' and re.search(filter_value, value):
-            filtered = False
-        if filter_type == 'iregex' and re.search(filter_value, value, re.I):
-            filtered = False
-    except:
-        pass
-
-    if filter_field.exclude:
-        return not filtered
-    return filtered 
-
-
 class AjaxGetRelated(GetFieldsMixin, TemplateView):
     template_name = "report_builder/report_form_related_li.html"
     
@@ -281,21 +211,18 @@ class AjaxPreview(DataExportMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super(AjaxPreview, self).get_context_data(**kwargs)
         report = get_object_or_404(Report, pk=self.request.POST['report_id'])
-        queryset, message = report.get_query()
-        property_filters = report.filterfield_set.filter(
-            Q(field_verbose__contains='[property]') | Q(field_verbose__contains='[custom')
-        )
-        objects_list, message = self.report_to_list(
-            queryset,
-            report.displayfield_set.all(),
-            self.request.user,
-            property_filters=property_filters,
-            preview=True,)
+        with self.timed(report.pk):
+            objects_list, message = self.get_report_rows(report, self.request.user, preview=True)
+            objects_list = list(objects_list)
     
         context['report'] = report
         context['objects_dict'] = objects_list
         context['message'] = message
         return context
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super(AjaxPreview, self).render_to_response(context, **response_kwargs)
+        return self.finish_timer(response)
     
 
 class ReportUpdateView(GetFieldsMixin, UpdateView):
@@ -368,6 +295,9 @@ class ReportUpdateView(GetFieldsMixin, UpdateView):
             return self.render_to_response(self.get_context_data(form=form))
         
 class DownloadXlsxView(DataExportMixin, View):
+    # True when report_response only reads the rows as it is sent
+    streams_rows = False
+
     @method_decorator(staff_member_required)
     def dispatch(self, *args, **kwargs):
         return super(DownloadXlsxView, self).dispatch(*args, **kwargs)
@@ -375,48 +305,133 @@ class DownloadXlsxView(DataExportMixin, View):
     def process_report(self, report_id, user_id, to_response, queryset=None):
         report = get_object_or_404(Report, pk=report_id)
         user = User.objects.get(pk=user_id)
-        if not queryset:
-            queryset, message = report.get_query()
-        property_filters = report.filterfield_set.filter(
-            Q(field_verbose__contains='[property]') | Q(field_verbose__contains='[custom')
-        )
-        objects_list, message = self.report_to_list(
-            queryset,
-            report.displayfield_set.all(),
-            user,
-            property_filters=property_filters,
-            preview=False,)
-        title = re.sub(r'\W+', '', report.name)[:30]
-        header = []
-        widths = []
-        for field in report.displayfield_set.all():
-            header.append(field.name)
-            widths.append(field.width)
-            
-        if to_response:
-            return self.list_to_xlsx_response(objects_list, title, header, widths)
-        else:
-            self.async_report_save(report, objects_list, title, header, widths)
+        with self.timed(report.pk):
+            if self.progress is not None and queryset is None:
+                # Root objects, an estimate of the rows to come
+                self.progress.total_rows = report.get_query()[0].count()
+            if report.change_tracking_field and queryset is None and not to_response:
+                objects_list, message = self.get_incremental_report_rows(report, user)
+            else:
+                objects_list, message = self.get_report_rows(report, user, queryset=queryset)
+            title = re.sub(r'\W+', '', report.name)[:30]
+            plan = report.compile()
+            header = list(plan.header)
+            widths = list(plan.widths)
+
+            if not to_response:
+                try:
+                    self.async_report_save(report, objects_list, title, header, widths, user=user)
+                finally:
+                    self.finish_timer()
+                return
+            response = self.report_response(objects_list, title, header, widths)
+
+        if self.streams_rows and self.timer is not None:
+            # Headers go out before the rows, too early for Server-Timing
+            response.streaming_content = self.timer.finish_after(
+                response.streaming_content, self.__class__)
+            return response
+        return self.finish_timer(response)
         
-    def async_report_save(self, report, objects_list, title, header, widths):
-        xlsx_file = self.list_to_xlsx_file(objects_list, title, header, widths)
+    def report_response(self, objects_list, title, header, widths):
+        return self.list_to_xlsx_stream_response(objects_list, title, header, widths)
+
+    def async_report_save(self, report, objects_list, title, header, widths, user=None):
+        # Taken before any rows are read, so changes made meanwhile make the file stale
+        report_file_key = report.get_report_file_key()
+        definition_key = report.get_definition_key()
+        if self.progress is not None:
+            objects_list = self.progress.count_rows(objects_list, 'rows_written', 'writing')
+        xlsx_file = self.list_to_xlsx_stream(objects_list, title, header, widths)
         if not title.endswith('.xlsx'):
             title += '.xlsx'
-        report.report_file.save(title, ContentFile(xlsx_file.getvalue()))
-        report.report_file_creation = datetime.datetime.today()
+        if self.progress is not None:
+            self.progress.stage('saving')
+        # Nobody is served the new file until it is known who it was made for
+        data_versions.set_report_file_permissions(report.pk, None)
+        try:
+            with self.time_block('save'):
+                report.report_file.save(title, File(xlsx_file))
+        finally:
+            xlsx_file.close()
+        report.report_file_creation = timezone.now()
         report.save()
+        if report_file_key:
+            data_versions.set_report_file_key(report.pk, report_file_key)
+        data_versions.set_report_file_definition(report.pk, definition_key)
+        # Columns the user may not see are left out of the file
+        data_versions.set_report_file_permissions(
+            report.pk, data_versions.get_permissions_key(user) if user is not None else None)
+        if self.progress is not None:
+            self.progress.stage('done')
     
     def get(self, request, *args, **kwargs):
         report_id = kwargs['pk']
-        if getattr(settings, 'REPORT_BUILDER_ASYNC_REPORT', False):
-            from .tasks import report_builder_async_report_save
-            report_task = report_builder_async_report_save.delay(report_id, request.user.pk)
-            task_id = report_task.task_id
+        report = get_object_or_404(Report, pk=report_id)
+        is_async = getattr(settings, 'REPORT_BUILDER_ASYNC_REPORT', False)
+        if report.report_file_is_fresh(request.user):
+            if is_async:
+                return HttpResponse(json.dumps({'task_id': None, 'link': report.report_file.url}),
+                                    content_type="application/json")
+            return HttpResponseRedirect(report.report_file.url)
+        if is_async:
+            from .tasks import start_report_task
+            task_id = start_report_task(report_id, request.user.pk)
             return HttpResponse(json.dumps({'task_id': task_id}), content_type="application/json")
         else:
             return self.process_report(report_id, request.user.pk, to_response=True)
     
 
+class DownloadCsvView(DownloadXlsxView):
+    """ Stream a report as csv. Never runs asynchronously since rows are
+    sent to the client as soon as they are produced.
+    """
+    streams_rows = True
+
+    def report_response(self, objects_list, title, header, widths):
+        return self.list_to_csv_response(objects_list, title, header)
+
+    def get(self, request, *args, **kwargs):
+        return self.process_report(kwargs['pk'], request.user.pk, to_response=True)
+
+
+class DownloadJsonlView(DownloadCsvView):
+    """ Stream a report as JSON Lines, one JSON array per row """
+    def report_response(self, objects_list, title, header, widths):
+        return self.list_to_jsonl_response(objects_list, title, header)
+
+
+class ReportRowsView(DataExportMixin, View):
+    """ Page through all of a report's rows as JSON
+    GET parameters are page_size and cursor, the next_cursor of the page
+    before. next_cursor is null on the last page.
+    """
+    @method_decorator(staff_member_required)
+    def dispatch(self, *args, **kwargs):
+        return super(ReportRowsView, self).dispatch(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        report = get_object_or_404(Report, pk=kwargs['pk'])
+        max_page_size = getattr(settings, 'REPORT_BUILDER_MAX_PAGE_SIZE', 1000)
+        with self.timed(report.pk):
+            try:
+                page_size = min(int(request.GET.get('page_size', self.preview_rows)), max_page_size)
+                if page_size < 1:
+                    raise ValueError('page_size must be positive')
+                rows, next_cursor, message = self.get_report_page(
+                    report, request.user, page_size, request.GET.get('cursor'))
+            except ValueError as e:
+                return self.finish_timer(HttpResponseBadRequest(str(e)))
+            data = {
+                'header': list(report.compile().header),
+                'rows': rows,
+                'next_cursor': next_cursor,
+                'message': message,
+            }
+            response = HttpResponse(json.dumps(data, cls=DjangoJSONEncoder), content_type="application/json")
+        return self.finish_timer(response)
+
+
 @staff_member_required
 def ajax_add_star(request, pk):
     """ Star or unstar report for user
@@ -489,8 +504,20 @@ def check_status(request, pk, task_id):
     from celery.result import AsyncResult
     res = AsyncResult(task_id)
     link = ''
+    progress = None
     if res.state == 'SUCCESS':
         report = get_object_or_404(Report, pk=pk)
         link = report.report_file.url
-    return HttpResponse(json.dumps({'state': res.state, 'link': link }), content_type="application/json")
+    elif res.state == 'PROGRESS':
+        progress = res.info
+    return HttpResponse(json.dumps({'state': res.state, 'link': link, 'progress': progress}),
+                        content_type="application/json")
+
+
+@staff_member_required
+def result_cache_stats(request):
+    """ Hit and miss counts of the report result cache """
+    result_cache = get_result_cache()
+    stats = result_cache.stats() if result_cache else {}
+    return HttpResponse(json.dumps(stats), content_type="application/json")
 